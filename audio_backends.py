@@ -0,0 +1,248 @@
+import numpy as np
+import threading
+import time
+
+from capture import WavFileCapture
+
+
+# The callback raises these to stop the stream. SoundDeviceBackend turns them
+# into the sounddevice exceptions, so sounddevice (which takes a while to
+# import and load PortAudio) is not needed until a stream is opened.
+class CallbackStop(Exception):
+    pass
+
+
+class CallbackAbort(Exception):
+    pass
+
+
+
+class SoundDeviceBackend():
+    '''
+    Play audio through the sound card with a sounddevice OutputStream.
+    '''
+
+    def create_stream(self, samplerate, blocksize, callback, finished_callback):
+        try:
+            import sounddevice as sd
+        except (ImportError, OSError):
+            # sounddevice is not installed, or PortAudio is missing (e.g. on
+            # a headless server). Only the null and file backends can be used.
+            raise Exception("The sounddevice backend needs the sounddevice library and PortAudio.")
+
+        def sounddevice_callback(outdata, frames, time, status):
+            try:
+                callback(outdata, frames, time, status)
+            except CallbackStop:
+                raise sd.CallbackStop
+            except CallbackAbort:
+                raise sd.CallbackAbort
+
+        # float32 is PortAudio's native sample format, so no conversion is needed
+        return sd.OutputStream(samplerate=samplerate,
+                               blocksize=blocksize,
+                               channels=1,
+                               dtype="float32",
+                               callback=sounddevice_callback,
+                               finished_callback=finished_callback)
+
+
+
+class NullBackend():
+    '''
+    A headless backend with no audio device. The stream calls the callback
+    from its own thread, either as fast as possible (realtime=False) or at
+    the pace a sound card would (realtime=True). The output is discarded.
+
+    If max_blocks is given, the stream finishes by itself after that many
+    blocks.
+    '''
+
+    def __init__(self, realtime=False, max_blocks=None):
+        self.realtime = realtime
+        self.max_blocks = max_blocks
+
+
+    def create_stream(self, samplerate, blocksize, callback, finished_callback):
+        return NullStream(samplerate, blocksize, callback, finished_callback,
+                          realtime=self.realtime, max_blocks=self.max_blocks)
+
+
+
+class FileBackend(NullBackend):
+    '''
+    A headless backend that writes the output to a WAV file at `path`
+    instead of playing it. By default it runs as fast as possible.
+    '''
+
+    def __init__(self, path, realtime=False, max_blocks=None):
+        super().__init__(realtime=realtime, max_blocks=max_blocks)
+        self.path = path
+
+
+    def create_stream(self, samplerate, blocksize, callback, finished_callback):
+        return NullStream(samplerate, blocksize, callback, finished_callback,
+                          realtime=self.realtime, max_blocks=self.max_blocks,
+                          path=self.path)
+
+
+
+class StreamTime():
+    '''
+    Stand-in for the time argument that sounddevice passes to the callback.
+    '''
+
+    def __init__(self):
+        self.currentTime = 0.0
+        self.outputBufferDacTime = 0.0
+        self.inputBufferAdcTime = 0.0
+
+
+
+class StreamStatus():
+    '''
+    Stand-in for sounddevice's CallbackFlags. Like CallbackFlags, it is
+    False when no flags are set.
+    '''
+
+    def __init__(self):
+        self.output_underflow = False
+        self.output_overflow = False
+
+
+    def __bool__(self):
+        return self.output_underflow or self.output_overflow
+
+
+
+class NullStream():
+    '''
+    Clock-driven stream used by NullBackend and FileBackend. It has the parts
+    of the sounddevice OutputStream interface that Metronome uses: start(),
+    stop(), abort(), active, time and latency.
+
+    The stream clock runs from the moment the stream starts. In real-time
+    mode this is the wall clock, otherwise it is the number of samples
+    delivered divided by the sample rate. A block is taken to be heard one
+    block after its callback, which is also reported as the latency. In
+    real-time mode, a callback that finishes after its block should have
+    been heard sets output_underflow for the next callback.
+    '''
+
+    def __init__(self, samplerate, blocksize, callback, finished_callback,
+                 realtime=False, max_blocks=None, path=None):
+        self.samplerate = samplerate
+        self.blocksize = blocksize
+        self.callback = callback
+        self.finished_callback = finished_callback
+        self.realtime = realtime
+        self.max_blocks = max_blocks
+        self.path = path
+
+        self.block_duration = blocksize / samplerate
+        self.latency = self.block_duration
+        self.active = False
+        # Like a PortAudio stream, a stream that has finished by itself is
+        # inactive, but has to be stopped before it can be started again
+        self.stopped = True
+        self.thread = None
+        self.stop_requested = False
+        self.start_time = 0.0
+        self.blocks_delivered = 0
+
+
+    @property
+    def time(self):
+        if self.realtime:
+            return time.perf_counter() - self.start_time
+        return self.blocks_delivered * self.block_duration
+
+
+    def start(self):
+        if self.active:
+            return
+        if not self.stopped:
+            raise Exception("The stream finished by itself, and must be stopped before starting it again.")
+        self.stopped = False
+        self.stop_requested = False
+        self.blocks_delivered = 0
+        self.start_time = time.perf_counter()
+        self.active = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+
+    def abort(self):
+        self.stop_requested = True
+        # stop() may be called from inside the callback, i.e. on our own thread
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+
+    def stop(self):
+        self.abort()
+        self.active = False
+        self.stopped = True
+
+
+    def close(self):
+        self.stop()
+
+
+    def run(self):
+        outdata = np.zeros((self.blocksize, 1), dtype=np.float32)
+        time_info = StreamTime()
+        status = StreamStatus()
+        sink = WavFileCapture(self.path, self.samplerate) if self.path is not None else None
+
+        try:
+            while not self.stop_requested:
+                if self.max_blocks is not None and self.blocks_delivered >= self.max_blocks:
+                    break
+
+                time_info.currentTime = self.time
+                time_info.outputBufferDacTime = (self.blocks_delivered + 1) * self.block_duration
+                try:
+                    self.callback(outdata, self.blocksize, time_info, status)
+                except CallbackStop:
+                    # The final block is still output
+                    if sink is not None:
+                        sink.write(outdata[:, 0])
+                    break
+                except CallbackAbort:
+                    break
+
+                if sink is not None:
+                    sink.write(outdata[:, 0])
+                self.blocks_delivered += 1
+
+                if self.realtime:
+                    # Wait until this block would have been played
+                    deadline = self.start_time + self.blocks_delivered * self.block_duration
+                    remaining = deadline - time.perf_counter()
+                    status.output_underflow = remaining < 0
+                    if remaining > 0:
+                        time.sleep(remaining)
+        finally:
+            if sink is not None:
+                sink.close()
+            self.active = False
+            if self.finished_callback is not None:
+                self.finished_callback()
+
+
+
+def create_backend(backend="sounddevice", **kwargs):
+    '''
+    Create an audio backend by name ("sounddevice", "null" or "file").
+    Keyword arguments are passed on to the backend, e.g. realtime=True for
+    "null", or path="click.wav" for "file".
+    '''
+    if backend == "sounddevice":
+        return SoundDeviceBackend(**kwargs)
+    elif backend == "null":
+        return NullBackend(**kwargs)
+    elif backend == "file":
+        return FileBackend(**kwargs)
+    else:
+        raise Exception(f"Unknown audio backend '{backend}'. Use 'sounddevice', 'null' or 'file'.")
@@ -0,0 +1,288 @@
+'''
+Block generation in a separate process.
+
+Normally get_next_audio_block runs inside the audio callback, so it has to
+share the GIL with Tk's main loop and everything else in the GUI process,
+and on a loaded machine it can be late. In worker mode (Metronome(...,
+worker=True)) a worker process runs its own Metronome, which generates the
+blocks ahead of time into a ring buffer in shared memory. The callback in
+the GUI process only copies the next block out of the ring.
+
+The GUI process keeps its own Metronome for everything the GUI reads (the
+tempo, beats per bar, click sounds...), and every change made to it is also
+sent to the worker over a multiprocessing queue, as the name of the method
+and its arguments, so both stay in step. The worker makes each change at
+the next beat, as it would while playing.
+
+The beat log (see event_log.py) is recorded by the worker, stamped with
+each beat's DAC time by the callback and read by the GUI, so it is in
+shared memory too, as is a small header of numbers the two processes
+share: the ring indices, how full the worker should keep the ring, the
+sample at which the output ends (once it is known), which start() the
+ring's contents are for, and the timing of the last tempo or beats per bar
+change.
+
+The shared memory is laid out as plain NumPy arrays, and is used exactly as
+BlockRingBuffer and BeatLog use their own arrays, so the classes here only
+change where the arrays and indices live.
+
+The worker only helps if it has a core of its own to run on. Capturing the
+output (capture_mode) is not supported in worker mode, as the blocks never
+pass through the GUI process's get_next_audio_block.
+'''
+import multiprocessing
+import queue
+import time
+import numpy as np
+from multiprocessing import shared_memory
+
+from ring_buffer import BlockRingBuffer
+from event_log import BeatLog, BEAT_LOG_DTYPE
+from instrumentation import ChangeTiming
+
+
+# Metronome methods that the worker repeats when they are called in the GUI
+# process. See Metronome.forward_to_worker.
+FORWARDED_METHODS = ("set_new_tempo", "increase_beats_per_bar", "decrease_beats_per_bar",
+                     "update_beat_sample_dict", "set_beat_pattern", "enable_gap_clicks",
+                     "disable_gap_clicks", "set_tempo_map", "enable_trainer", "disable_trainer")
+
+HEADER_LENGTH = 16
+# The timing of the last tempo or beats per bar change (see ChangeTiming)
+# is kept in the ring's header, from this slot
+CHANGE_TIMING_SLOT = 8
+
+
+def shared_int_property(slot):
+    '''
+    A property kept in slot of self.header, an int64 array in shared memory.
+    '''
+    def get(self):
+        return int(self.header[slot])
+
+    def set(self, value):
+        self.header[slot] = value
+
+    return property(get, set)
+
+
+
+class SharedBlockRing(BlockRingBuffer):
+    '''
+    A BlockRingBuffer in shared memory. The worker process is the producer
+    and the callback in the GUI process is the consumer. Pass name to attach
+    to a ring created by the other process.
+
+    As with BlockRingBuffer, each side only moves its own index, after it
+    has finished with the block, and the indices are single aligned 64-bit
+    values, so no locks are needed.
+    '''
+
+    read_index = shared_int_property(0)
+    write_index = shared_int_property(1)
+    # How many blocks ahead the worker keeps the ring filled (the callback
+    # sets this from its buffer depth)
+    target_depth = shared_int_property(2)
+    # The sample at which the output ends, or -1 if it is not known yet
+    shared_end_sample = shared_int_property(3)
+    # The number of the start() that the blocks in the ring are for
+    generation = shared_int_property(4)
+    # 1 once the worker has generated the final block
+    finished = shared_int_property(5)
+
+    def __init__(self, capacity, blocksize, dtype=np.float32, name=None):
+        self.capacity = capacity
+        self.blocksize = blocksize
+        dtype = np.dtype(dtype)
+        header_bytes = HEADER_LENGTH * 8
+        beats_bytes = capacity * 8
+        size = header_bytes + beats_bytes + capacity * blocksize * dtype.itemsize
+
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=size)
+        self.name = self.shm.name
+        self.header = np.ndarray(HEADER_LENGTH, dtype=np.int64, buffer=self.shm.buf)
+        self.beats = np.ndarray(capacity, dtype=np.int64, buffer=self.shm.buf, offset=header_bytes)
+        self.blocks = np.ndarray((capacity, blocksize), dtype=dtype, buffer=self.shm.buf,
+                                 offset=header_bytes + beats_bytes)
+        if name is None:
+            self.header[:] = 0
+            self.target_depth = capacity
+            self.shared_end_sample = -1
+        self.change_timing = ChangeTiming(self.header[CHANGE_TIMING_SLOT:CHANGE_TIMING_SLOT + ChangeTiming.LENGTH])
+
+
+    @property
+    def end_sample(self):
+        end_sample = self.shared_end_sample
+        return None if end_sample < 0 else end_sample
+
+
+    def close(self, unlink=False):
+        '''
+        Detach from the shared memory, and free it if unlink is True (only
+        the process that created it should do this).
+        '''
+        self.header = self.beats = self.blocks = self.change_timing = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+
+class SharedBeatLog(BeatLog):
+    '''
+    A BeatLog in shared memory. The worker records the beats, and the
+    callback and the GUI in the other process stamp and read them.
+    '''
+
+    write_index = shared_int_property(0)
+    stamped_index = shared_int_property(1)
+
+    def __init__(self, capacity=65536, name=None):
+        header_bytes = HEADER_LENGTH * 8
+        size = header_bytes + capacity * BEAT_LOG_DTYPE.itemsize
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=size)
+        self.name = self.shm.name
+        self.header = np.ndarray(HEADER_LENGTH, dtype=np.int64, buffer=self.shm.buf)
+        self.capacity = capacity
+        self.use_records(np.ndarray(capacity, dtype=BEAT_LOG_DTYPE, buffer=self.shm.buf, offset=header_bytes))
+        if name is None:
+            self.reset()
+
+
+    def close(self, unlink=False):
+        self.header = self.records = None
+        self.samples = self.dac_times = self.bars = self.beats = self.sounds = self.tempos = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+
+class AudioWorker():
+    '''
+    The GUI process's handle on the worker process. The process is started
+    straight away, and is a daemon, so it never outlives the GUI.
+
+    The process is spawned rather than forked, as forking a process that
+    already has Tk or PortAudio threads running is not safe.
+    '''
+
+    def __init__(self, settings, ring, beat_log):
+        self.ring = ring
+        self.generation = 0
+        context = multiprocessing.get_context("spawn")
+        self.control = context.Queue()
+        self.process = context.Process(target=run_worker,
+                                       args=(settings, ring.name, beat_log.name, beat_log.capacity, self.control),
+                                       daemon=True)
+        self.process.start()
+
+
+    def send(self, name, *args, **kwargs):
+        '''
+        Ask the worker to call one of its Metronome's methods. The queue is
+        thread-safe, so this can be called from the audio thread too.
+        '''
+        self.control.put((name, args, kwargs))
+
+
+    def start_generating(self, min_blocks, bars_to_play=None, timeout=10.0):
+        '''
+        Ask the worker to start generating from the first beat, and wait
+        until it has put min_blocks blocks in the ring (or all of them, if
+        there are fewer), so the stream can be started. The first call also
+        waits for the worker process to finish starting up.
+        '''
+        self.generation += 1
+        self.send("start", self.generation, bars_to_play)
+        deadline = time.perf_counter() + timeout
+        while not (self.ring.generation == self.generation
+                   and (len(self.ring) >= min_blocks or self.ring.finished)):
+            if time.perf_counter() > deadline or not self.process.is_alive():
+                raise Exception("The audio worker process did not start generating.")
+            time.sleep(0.001)
+
+
+    def stop_generating(self):
+        self.send("stop")
+
+
+    def close(self, timeout=2.0):
+        '''
+        Shut the worker process down.
+        '''
+        if self.process.is_alive():
+            self.send("quit")
+            self.process.join(timeout)
+            if self.process.is_alive():
+                self.process.terminate()
+
+
+
+def run_worker(settings, ring_name, log_name, log_capacity, control):
+    '''
+    The worker process. It runs a Metronome of its own, with no output
+    stream, and keeps the shared ring filled until it is told to stop.
+    '''
+    # Imported here, in the new process, to avoid a circular import
+    from metronome_master_GH import Metronome
+
+    metro = Metronome(backend="null", **settings)
+    metro.ring = SharedBlockRing(metro.BUFFERSIZE, metro.BLOCKSIZE, dtype=metro.dtype, name=ring_name)
+    metro.beat_log = SharedBeatLog(log_capacity, name=log_name)
+    ring = metro.ring
+    metro.change_timing = ring.change_timing
+    # When the ring is full, wait this long (a quarter of a block) for a
+    # control message before checking again
+    poll_interval = 0.25 * metro.BLOCKSIZE / metro.fs
+    generating = False
+
+    while True:
+        ring_has_room = generating and not metro.bars_finished and len(ring) < ring.target_depth
+        try:
+            if ring_has_room:
+                message = control.get_nowait()
+            else:
+                message = control.get(timeout=poll_interval)
+        except queue.Empty:
+            message = None
+
+        if message is not None:
+            name, args, kwargs = message
+            if name == "quit":
+                break
+            elif name == "start":
+                generation, bars_to_play = args
+                metro.running = False
+                metro.reset_position()
+                metro.prepare_to_play()
+                if bars_to_play is not None:
+                    metro.bars_to_play_at_tempo = bars_to_play
+                    metro.beats_to_play_at_tempo = bars_to_play * metro.beats_per_bar
+                ring.shared_end_sample = -1 if metro.end_sample is None else metro.end_sample
+                ring.finished = 0
+                metro.running = True
+                generating = True
+                # The ring is empty and ready for this start()
+                ring.generation = generation
+            elif name == "stop":
+                generating = False
+                metro.running = False
+                metro.reset_position()
+            elif name in FORWARDED_METHODS:
+                getattr(metro, name)(*args, **kwargs)
+            continue
+
+        # Generate until the ring is as full as the callback wants it
+        while generating and not metro.bars_finished and len(ring) < ring.target_depth:
+            metro.get_next_audio_block(ring.get_write_block())
+            # Publish the end as soon as it is known, before the block
+            if metro.end_sample is not None:
+                ring.shared_end_sample = metro.end_sample
+            ring.commit_write(metro.current_beat)
+            if metro.bars_finished:
+                ring.finished = 1
+
+    ring.close()
+    metro.beat_log.close()
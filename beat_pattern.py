@@ -0,0 +1,152 @@
+import numpy as np
+from fractions import Fraction
+
+
+class PatternLayer():
+    '''
+    One layer of a BeatPattern: pulses clicks, evenly spaced, in every group
+    of beats beats. For example:
+
+        PatternLayer(2)                 quavers (eighth notes)
+        PatternLayer(3)                 triplets
+        PatternLayer(4)                 semiquavers (sixteenth notes)
+        PatternLayer(3, beats=4)        three against four, over a 4/4 bar
+
+    The groups start again at the start of every bar. If beats does not
+    divide the beats per bar, the last group of the bar is cut short.
+
+    sound is a click sound index (1: lo, 2: hi) or an array of samples at
+    the Metronome's sample rate, and gain scales it. Clicks that land
+    exactly on a beat are left out, because the beat has its own click,
+    unless on_beats is True.
+    '''
+
+    def __init__(self, pulses, beats=1, sound=1, gain=1.0, on_beats=False):
+        if pulses < 1 or beats < 1:
+            raise Exception("A pattern layer needs at least one pulse over at least one beat.")
+        self.pulses = int(pulses)
+        self.beats = int(beats)
+        self.sound = sound
+        self.gain = gain
+        self.on_beats = on_beats
+
+
+    def positions(self, beats_per_bar):
+        '''
+        The exact position of every click of this layer in one bar, in beats
+        from the start of the bar, as Fractions.
+        '''
+        positions = []
+        for group_start in range(0, beats_per_bar, self.beats):
+            for pulse in range(self.pulses):
+                position = group_start + Fraction(pulse * self.beats, self.pulses)
+                if position >= beats_per_bar:
+                    break
+                if position.denominator == 1 and not self.on_beats:
+                    continue
+                positions.append(position)
+        return positions
+
+
+
+class BeatPattern():
+    '''
+    A set of PatternLayers, played on top of the beat clicks chosen with
+    update_beat_sample_dict. For example, semiquavers with a quieter lo
+    click, and a hi click three against four:
+
+        BeatPattern([PatternLayer(4, gain=0.5), PatternLayer(3, beats=4, sound=2)])
+
+    A pattern is compiled (see compile) into a CompiledPattern for the beats
+    per bar and click sounds in use, which is what the audio thread plays.
+    '''
+
+    def __init__(self, layers=()):
+        self.layers = list(layers)
+
+
+    def compile(self, beats_per_bar, click_sounds, max_click_length, dtype=np.float32):
+        '''
+        Compile the pattern for a bar of beats_per_bar beats. Sound indices
+        are looked up in click_sounds, and every sound is cut to
+        max_click_length samples.
+        '''
+        sounds = []
+        onsets = [[] for _ in range(beats_per_bar)]
+        for sound_id, layer in enumerate(self.layers):
+            if isinstance(layer.sound, (int, np.integer)):
+                sound = click_sounds[layer.sound]
+            else:
+                sound = np.asarray(layer.sound)
+            sounds.append((sound[:max_click_length] * layer.gain).astype(dtype))
+            for position in layer.positions(beats_per_bar):
+                beat = int(position)
+                fraction = position - beat
+                onsets[beat].append((fraction, sound_id))
+
+        return CompiledPattern(sounds, [sorted(beat_onsets) for beat_onsets in onsets])
+
+
+
+class CompiledPattern():
+    '''
+    A BeatPattern compiled for one bar: the onset table of each beat in the
+    bar, and the (gain-scaled) sound of each layer, indexed by sound id.
+
+    Each beat's onset table holds the position of every click within the
+    beat as an exact fraction of the beat, numerator / denominator, in
+    order. The sample offsets are only worked out when the exact length of
+    the beat is known, by beat_onsets:
+
+        offset = (numerator * beat_length) // denominator
+
+    so a subdivision click lands exactly on the beat onsets the scheduler
+    gives, at any tempo, and follows tempo ramps beat by beat.
+    '''
+
+    def __init__(self, sounds, beat_onsets):
+        self.sounds = sounds
+        self.numerators = []
+        self.denominators = []
+        self.sound_ids = []
+        # Preallocated sample offsets for each beat, filled in by beat_onsets
+        self.offsets = []
+        for onsets in beat_onsets:
+            self.numerators.append(np.array([fraction.numerator for fraction, _ in onsets], dtype=np.int64))
+            self.denominators.append(np.array([fraction.denominator for fraction, _ in onsets], dtype=np.int64))
+            self.sound_ids.append(np.array([sound_id for _, sound_id in onsets], dtype=np.int64))
+            self.offsets.append(np.zeros(len(onsets), dtype=np.int64))
+
+        self.max_onsets_per_beat = max(len(onsets) for onsets in beat_onsets)
+        self.max_click_length = max((len(sound) for sound in sounds), default=0)
+
+
+    def beat_onsets(self, beat_index, beat_length):
+        '''
+        Audio thread. Return the sample offsets (from the beat onset) and
+        sound ids of the clicks in beat beat_index (zero-based) of the bar,
+        for a beat of beat_length samples. The offsets are worked out in a
+        preallocated array, which is overwritten the next time this beat of
+        the bar starts.
+        '''
+        offsets = self.offsets[beat_index]
+        np.multiply(self.numerators[beat_index], beat_length, out=offsets)
+        np.floor_divide(offsets, self.denominators[beat_index], out=offsets)
+        return offsets, self.sound_ids[beat_index]
+
+
+    def onsets(self, beat_onsets, beat_lengths, beat_indices):
+        '''
+        Vectorised version of beat_onsets, for offline rendering. Given the
+        onset, length and (zero-based) index in the bar of every beat,
+        return the sample position and sound id of every click of the
+        pattern, in no particular order.
+        '''
+        positions = []
+        sound_ids = []
+        for beat_index in range(len(self.offsets)):
+            selected = beat_indices == beat_index
+            offsets = (self.numerators[beat_index][None, :] * beat_lengths[selected][:, None]) // self.denominators[beat_index][None, :]
+            positions.append((beat_onsets[selected][:, None] + offsets).ravel())
+            sound_ids.append(np.broadcast_to(self.sound_ids[beat_index], offsets.shape).ravel())
+        return np.concatenate(positions), np.concatenate(sound_ids)
@@ -0,0 +1,102 @@
+import numpy as np
+from fractions import Fraction
+
+
+def tempo_step(fs, tempo):
+    '''
+    The exact number of samples per beat at tempo, as the fraction
+    numerator / denominator, and as whole samples (interval) plus a
+    remainder. Returns (tempo, numerator, denominator, interval,
+    remainder_per_beat), for BeatScheduler.use_tempo.
+    '''
+    samples_per_beat = Fraction(fs * 60) / Fraction(tempo)
+    numerator = samples_per_beat.numerator
+    denominator = samples_per_beat.denominator
+    # Whole samples per beat, and the fractional part as a remainder
+    interval, remainder_per_beat = divmod(numerator, denominator)
+    return tempo, numerator, denominator, interval, remainder_per_beat
+
+
+
+class BeatScheduler():
+    '''
+    Schedules beat onsets as exact sample positions, using only integers.
+
+    At a given tempo, the exact number of samples per beat is the rational
+    number fs * 60 / tempo = numerator / denominator. The k-th beat after the
+    start of a tempo segment begins at sample
+
+        segment_start + floor(k * numerator / denominator)
+
+    which is never more than one sample before the exact onset time, and never
+    after it, however long the metronome runs. Rather than multiplying by k
+    every beat, the onsets are stepped through with an integer remainder
+    (like Bresenham's line algorithm), so each beat costs one addition and
+    one comparison.
+
+    When the tempo changes, a new segment starts at the onset of the next
+    beat, so there is no phase jump and no error carried over.
+    '''
+
+    def __init__(self, fs, tempo, start=0):
+        self.fs = fs
+        # The first beat starts at sample `start`
+        self.next_onset = start
+        self.set_tempo(tempo)
+
+
+    def set_tempo(self, tempo):
+        '''
+        Use a new tempo (an int, or anything Fraction accepts) from the next
+        beat onwards. The next beat starts a new tempo segment.
+        '''
+        self.use_tempo(tempo_step(self.fs, tempo))
+
+
+    def use_tempo(self, step):
+        '''
+        Like set_tempo, with the step from tempo_step worked out ahead of
+        time, so that the audio thread can change tempo without any Fraction
+        arithmetic.
+        '''
+        self.tempo, self.numerator, self.denominator, self.interval, self.remainder_per_beat = step
+        self.remainder = 0
+        self.beats_in_segment = 0
+        self.segment_start = self.next_onset
+
+
+    def reset(self):
+        '''
+        Go back to sample zero, keeping the current tempo.
+        '''
+        self.next_onset = 0
+        self.segment_start = 0
+        self.remainder = 0
+        self.beats_in_segment = 0
+
+
+    def next_beat_length(self):
+        '''
+        Advance by one beat. Returns the number of samples from the onset of
+        this beat to the onset of the next one.
+        '''
+        beat_length = self.interval
+        self.remainder += self.remainder_per_beat
+        if self.remainder >= self.denominator:
+            self.remainder -= self.denominator
+            beat_length += 1
+
+        self.beats_in_segment += 1
+        self.next_onset += beat_length
+        return beat_length
+
+
+    def segment_onsets(self, num_beats, segment_start=0):
+        '''
+        Vectorised version of next_beat_length for the current tempo.
+        Returns the onsets of num_beats beats starting at segment_start, and
+        the sample at which the following beat would start.
+        '''
+        k = np.arange(num_beats + 1, dtype=np.int64)
+        onsets = segment_start + (k * self.numerator) // self.denominator
+        return onsets[:-1], int(onsets[-1])
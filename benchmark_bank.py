@@ -0,0 +1,119 @@
+'''
+Benchmark for MetronomeBank (see metronome_bank.py): how many sessions one
+core can render in real time.
+
+For each number of sessions, the bank renders blocks for sessions with
+random tempos and click indices, with a tempo change somewhere every few
+blocks, and the time per block is compared with the length of a block.
+For comparison, the same number of separate Metronomes are timed filling
+a block each with get_next_audio_block, as one Metronome per listener
+would.
+
+Before timing, every session is checked against Metronome.render at the
+same settings, sample for sample.
+
+Example:
+    python benchmark_bank.py --sessions 1 10 100 300 1000
+    python benchmark_bank.py --fs 48000 --blocksize 256 --seconds 5
+'''
+import argparse
+import time
+import numpy as np
+
+from metronome_bank import MetronomeBank
+from metronome_master_GH import Metronome
+
+
+def random_sessions(bank, num_sessions, rng):
+    '''
+    Add num_sessions sessions with random tempos and click indices.
+    Returns their (tempo, click_indices) settings.
+    '''
+    settings = []
+    for _ in range(num_sessions):
+        tempo = int(rng.integers(bank.min_tempo, bank.max_tempo + 1))
+        click_indices = rng.integers(0, 3, size=int(rng.integers(1, bank.max_beats_per_bar + 1)))
+        bank.add_session(tempo, click_indices)
+        settings.append((tempo, click_indices))
+    return settings
+
+
+def check_against_render(fs, blocksize, num_sessions, seconds, rng):
+    '''
+    Render a few seconds of num_sessions sessions, and check each one
+    against Metronome.render. Returns the number of sessions that match.
+    '''
+    bank = MetronomeBank(capacity=num_sessions, fs=fs, blocksize=blocksize)
+    settings = random_sessions(bank, num_sessions, rng)
+    num_blocks = int(seconds * fs / blocksize)
+    output = np.concatenate([bank.render_block().copy() for _ in range(num_blocks)], axis=1)
+
+    num_matching = 0
+    for session, (tempo, click_indices) in enumerate(settings):
+        metro = Metronome(tempo=tempo, beats_per_bar=len(click_indices), fs=fs, blocksize=blocksize, backend="null")
+        metro.update_beat_sample_dict(click_indices)
+        reference = metro.render(duration=output.shape[1] / fs)
+        num_matching += np.array_equal(output[session, :len(reference)], reference)
+    return num_matching
+
+
+def time_bank(fs, blocksize, num_sessions, seconds, rng):
+    '''
+    Time render_block for num_sessions sessions. Returns the time per block
+    in seconds, as p50 and max.
+    '''
+    bank = MetronomeBank(capacity=num_sessions, fs=fs, blocksize=blocksize)
+    random_sessions(bank, num_sessions, rng)
+    num_blocks = max(1, int(seconds * fs / blocksize))
+    times = []
+    for block_num in range(num_blocks):
+        # Somebody changes their tempo every few blocks
+        if block_num % 4 == 0:
+            bank.set_tempo(int(rng.integers(num_sessions)), int(rng.integers(bank.min_tempo, bank.max_tempo + 1)))
+        start = time.perf_counter()
+        bank.render_block()
+        times.append(time.perf_counter() - start)
+    return float(np.percentile(times, 50)), float(np.max(times))
+
+
+def time_separate_metronomes(fs, blocksize, num_sessions, num_blocks, rng):
+    '''
+    Time filling one block each for num_sessions separate Metronomes.
+    Returns the time per block for all of them, in seconds (p50).
+    '''
+    metros = []
+    for _ in range(num_sessions):
+        metro = Metronome(tempo=int(rng.integers(10, 351)), fs=fs, blocksize=blocksize, backend="null")
+        metro.running = True
+        metros.append(metro)
+    times = []
+    for _ in range(num_blocks):
+        start = time.perf_counter()
+        for metro in metros:
+            metro.get_next_audio_block()
+        times.append(time.perf_counter() - start)
+    return float(np.percentile(times, 50))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark rendering many sessions with a MetronomeBank.")
+    parser.add_argument("--sessions", type=int, nargs="+", default=[1, 10, 100, 300, 1000])
+    parser.add_argument("--fs", type=int, default=16000)
+    parser.add_argument("--blocksize", type=int, default=512)
+    parser.add_argument("--seconds", type=float, default=10.0, help="audio to render for each number of sessions")
+    parser.add_argument("--check-sessions", type=int, default=20, help="sessions to check against Metronome.render")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    num_matching = check_against_render(args.fs, args.blocksize, args.check_sessions, 5.0, rng)
+    print(f"{num_matching} of {args.check_sessions} sessions match Metronome.render sample for sample")
+
+    block_time = args.blocksize / args.fs
+    for num_sessions in args.sessions:
+        p50, worst = time_bank(args.fs, args.blocksize, num_sessions, args.seconds, rng)
+        separate = time_separate_metronomes(args.fs, args.blocksize, num_sessions, 200, rng)
+        # How many sessions one core could keep up with, at this cost per session
+        sessions_per_core = num_sessions * block_time / p50
+        print(f"{num_sessions:>5} sessions: block p50 {p50 * 1e3:7.3f} ms, max {worst * 1e3:7.3f} ms "
+              f"({100 * p50 / block_time:5.1f}% of real time, about {sessions_per_core:6.0f} sessions per core); "
+              f"separate Metronomes {separate * 1e3:7.3f} ms")
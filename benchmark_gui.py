@@ -0,0 +1,63 @@
+'''
+Benchmark for the beat indicator labels in the Tk App.
+
+Beats are shown one after another, as they would be while playing, and for
+each beats-per-bar setting this reports:
+    - label config calls (Tk calls) per beat
+    - the time taken to show a beat and redraw the labels, in microseconds
+    - the number of config calls per beat before labels were only redrawn
+      when they changed (two full passes over every label), for comparison
+
+The metronome uses the null backend, so no sound card is needed, but Tk
+does need a display. On a headless machine, run it under xvfb-run. Run it
+from the project directory, so that the images can be found.
+
+Example:
+    python benchmark_gui.py --beats-per-bar 4 8 --beats 1000
+'''
+import argparse
+import time
+import numpy as np
+
+from metronome_master_GH import Metronome
+from metronome_tkinter_master_GH import App
+from audio_backends import NullBackend
+
+
+def run_gui_benchmark(beats_per_bar, num_beats):
+    metro = Metronome(beats_per_bar=beats_per_bar, backend=NullBackend())
+    app = App(metro)
+    app.root.update()
+    app.label_config_calls = 0
+
+    times = []
+    for beat_num in range(num_beats):
+        beat = beat_num % beats_per_bar + 1
+        start = time.perf_counter_ns()
+        app.increment_active_beat_label(beat)
+        # Run the pending label render, as Tk would when it next goes idle
+        app.root.update_idletasks()
+        times.append(time.perf_counter_ns() - start)
+
+    result = {"beats_per_bar": beats_per_bar,
+              "beats": num_beats,
+              "config_calls_per_beat": app.label_config_calls / num_beats,
+              "full_redraw_calls_per_beat": 2 * len(app.labels),
+              "us_per_beat_p50": float(np.percentile(times, 50)) / 1000.0,
+              "us_per_beat_max": float(np.max(times)) / 1000.0}
+    app.root.destroy()
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the beat indicator labels in the Tk App.")
+    parser.add_argument("--beats-per-bar", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--beats", type=int, default=500)
+    args = parser.parse_args()
+
+    for beats_per_bar in args.beats_per_bar:
+        result = run_gui_benchmark(beats_per_bar, args.beats)
+        print(f"{result['beats_per_bar']} beats per bar: "
+              f"{result['config_calls_per_beat']:.2f} config calls/beat "
+              f"(was {result['full_redraw_calls_per_beat']}), "
+              f"p50 {result['us_per_beat_p50']:.1f} us, max {result['us_per_beat_max']:.1f} us per beat")
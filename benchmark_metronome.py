@@ -0,0 +1,333 @@
+'''
+Benchmarks for the audio hot path (get_next_audio_block and callback).
+
+No sound card is needed: the metronome uses the null backend, and the
+callback is called directly in a loop, as PortAudio would call it.
+
+For each sample rate, block size, scenario and tempo this reports:
+    - per-block latency percentiles (p50/p99/max, in microseconds) for both
+      get_next_audio_block and callback
+    - blocks generated per second
+    - allocations per block (peak transient bytes, and net memory blocks
+      retained, measured with tracemalloc/sys.getallocatedblocks)
+    - onset timing accuracy: the largest distance, in samples, between a
+      click in the output and its exact position
+    - float32 accuracy: the largest difference between the float32 output
+      and a float64 reference built independently of the engine
+
+Results are printed, and written as JSON with --output so they can be
+compared between runs.
+
+Example:
+    python benchmark_metronome.py --tempos 10 120 350 --blocks 5000 --output bench.json
+    python benchmark_metronome.py --sample-rates 48000 96000 --blocksizes 64 128
+'''
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+import numpy as np
+
+import os
+import audiofile
+from metronome_master_GH import Metronome
+from audio_backends import NullBackend, StreamStatus, StreamTime, CallbackAbort, CallbackStop
+from beat_scheduler import BeatScheduler
+from beat_pattern import PatternLayer
+from click_bank import SAMPLE_DIR, CLICK_FILES, resample
+
+
+SCENARIOS = ["steady", "tempo_changes", "pattern_edits", "play_for_num_bars", "tempo_map", "subdivisions", "gap_clicks"]
+
+
+def percentiles(times_ns):
+    '''
+    Summarise a list of timings (in ns) as p50/p99/max in microseconds.
+    '''
+    times_us = np.array(times_ns) / 1000.0
+    return {"p50": float(np.percentile(times_us, 50)),
+            "p99": float(np.percentile(times_us, 99)),
+            "max": float(times_us.max())}
+
+
+def make_metronome(tempo, fs, blocksize, capture_mode="ring"):
+    # The output is captured so that onset timing can be checked afterwards
+    return Metronome(tempo=tempo, fs=fs, blocksize=blocksize, backend=NullBackend(),
+                     capture_mode=capture_mode, capture_seconds=600)
+
+
+def scenario_events(scenario, metro, num_blocks, rng, change_timings=None):
+    '''
+    Build a dict of {block number: function} for changes to make mid-stream.
+    For tempo changes, the timing of each change (see get_change_timing) is
+    appended to change_timings just before the next one is made.
+    '''
+    events = {}
+    if scenario == "tempo_changes":
+        def change_tempo(m, new_tempo):
+            if change_timings is not None:
+                change_timings.append(m.get_change_timing())
+            m.set_new_tempo(new_tempo)
+
+        for block_num in range(100, num_blocks, 100):
+            new_tempo = int(rng.integers(metro.min_tempo, metro.max_tempo + 1))
+            events[block_num] = lambda m, t=new_tempo: change_tempo(m, t)
+    elif scenario == "pattern_edits":
+        for block_num in range(25, num_blocks, 25):
+            new_pattern = rng.integers(0, 3, size=metro.beats_per_bar)
+            events[block_num] = lambda m, p=new_pattern: m.update_beat_sample_dict(p)
+    return events
+
+
+def random_tempo_map(metro, rng, num_segments=1000):
+    '''
+    A long tempo map of random tempos and curves, one segment per bar, to
+    show that the cost of a block does not depend on the size of the map.
+    '''
+    tempos = rng.integers(metro.min_tempo, metro.max_tempo + 1, size=num_segments)
+    curves = rng.choice(["constant", "step", "linear"], size=num_segments)
+    return [(bar, int(tempo), str(curve)) for bar, (tempo, curve) in enumerate(zip(tempos, curves))]
+
+
+def time_get_next_audio_block(tempo, fs, blocksize, num_blocks):
+    '''
+    Time get_next_audio_block on its own, filling a block from the ring.
+    '''
+    metro = make_metronome(tempo, fs, blocksize, capture_mode="off")
+    metro.running = True
+    block = metro.ring.get_write_block()
+    times = []
+    for _ in range(num_blocks):
+        start = time.perf_counter_ns()
+        metro.get_next_audio_block(block)
+        times.append(time.perf_counter_ns() - start)
+    return times
+
+
+def run_callback_loop(metro, num_blocks, events):
+    '''
+    Call metro.callback num_blocks times (or until it aborts), as the output
+    stream would. Returns the per-callback times in ns.
+    '''
+    # float32, like the buffers the output stream passes to the callback
+    outdata = np.zeros((metro.BLOCKSIZE, 1), dtype=np.float32)
+    time_info = StreamTime()
+    status = StreamStatus()
+    times = []
+
+    metro.pre_fill_queue()
+    metro.running = True
+    for block_num in range(num_blocks):
+        if block_num in events:
+            events[block_num](metro)
+        start = time.perf_counter_ns()
+        try:
+            metro.callback(outdata, metro.BLOCKSIZE, time_info, status)
+        except (CallbackAbort, CallbackStop):
+            break
+        times.append(time.perf_counter_ns() - start)
+    return times
+
+
+def measure_allocations(tempo, fs, blocksize, num_blocks):
+    '''
+    Measure memory allocated by the callback. Returns the mean peak number of
+    bytes allocated during one callback, and the net number of memory blocks
+    still allocated per callback at the end of the run.
+    '''
+    metro = make_metronome(tempo, fs, blocksize, capture_mode="off")
+    # float32, like the buffers the output stream passes to the callback
+    outdata = np.zeros((metro.BLOCKSIZE, 1), dtype=np.float32)
+    time_info = StreamTime()
+    status = StreamStatus()
+    metro.pre_fill_queue()
+    metro.running = True
+
+    # Warm up, so one-off allocations are not counted
+    for _ in range(100):
+        metro.callback(outdata, metro.BLOCKSIZE, time_info, status)
+
+    tracemalloc.start()
+    peak_bytes = []
+    blocks_before = sys.getallocatedblocks()
+    for _ in range(num_blocks):
+        tracemalloc.reset_peak()
+        current_before, _ = tracemalloc.get_traced_memory()
+        metro.callback(outdata, metro.BLOCKSIZE, time_info, status)
+        _, peak = tracemalloc.get_traced_memory()
+        peak_bytes.append(peak - current_before)
+    blocks_after = sys.getallocatedblocks()
+    tracemalloc.stop()
+
+    return float(np.mean(peak_bytes)), (blocks_after - blocks_before) / num_blocks
+
+
+def onset_error(metro, audio):
+    '''
+    Find the start of every click in the captured audio, and return the
+    largest distance (in samples) from the exact onset of the same beat at a
+    constant tempo of metro.tempo.
+    '''
+    non_zero = np.flatnonzero(audio)
+    if not len(non_zero):
+        return None
+    # A gap longer than any click separates two clicks
+    gap = max(len(click) for click in metro.click_sounds)
+    starts = non_zero[np.concatenate(([True], np.diff(non_zero) > gap))]
+    # Clicks may start with silent samples, which we cannot see
+    first_sound = min(np.flatnonzero(click)[0] for click in metro.click_sounds if np.any(click))
+    starts = starts - first_sound
+
+    samples_per_beat = metro.fs * 60.0 / metro.tempo
+    beat_numbers = np.round(starts / samples_per_beat)
+    return float(np.max(np.abs(starts - beat_numbers * samples_per_beat)))
+
+
+def float32_error(tempo, fs, blocksize, num_blocks):
+    '''
+    Compare the float32 output of the live engine with a float64 reference,
+    made by placing float64 copies of the click samples at the exact onsets
+    from BeatScheduler. Returns the largest absolute difference, and the
+    largest difference allowed by float32 precision (one unit in the last
+    place of the loudest sample).
+    '''
+    metro = make_metronome(tempo, fs, blocksize, capture_mode="off")
+    metro.running = True
+    live = np.concatenate([metro.get_next_audio_block()[0].copy() for _ in range(num_blocks)])
+
+    clicks = {}
+    for name in CLICK_FILES:
+        samples, file_fs = audiofile.read(os.path.join(SAMPLE_DIR, CLICK_FILES[name]), always_2d=False)
+        clicks[name] = resample(samples.astype(np.float64), file_fs, fs)
+
+    reference = np.zeros(len(live) + len(clicks["hi"]))
+    onsets, _ = BeatScheduler(fs, tempo).segment_onsets(len(live) // metro.interval + 1)
+    for beat_num, onset in enumerate(onsets):
+        click = clicks["hi"] if beat_num % metro.beats_per_bar == 0 else clicks["lo"]
+        reference[onset:onset + len(click)] = click
+    reference = reference[:len(live)]
+
+    tolerance = float(np.spacing(np.float32(np.abs(reference).max())))
+    return float(np.abs(live.astype(np.float64) - reference).max()), tolerance
+
+
+def run_scenario(scenario, tempo, fs, blocksize, num_blocks, rng):
+    metro = make_metronome(tempo, fs, blocksize)
+    change_timings = []
+    events = scenario_events(scenario, metro, num_blocks, rng, change_timings)
+    if scenario == "play_for_num_bars":
+        # Enough bars to last about half of the run
+        samples_per_bar = metro.fs * 60.0 / tempo * metro.beats_per_bar
+        num_bars = max(1, int(num_blocks * metro.BLOCKSIZE / 2 / samples_per_bar))
+        metro.bars_to_play_at_tempo = num_bars
+        metro.beats_to_play_at_tempo = num_bars * metro.beats_per_bar
+    elif scenario == "tempo_map":
+        metro.set_tempo_map(random_tempo_map(metro, rng))
+    elif scenario == "subdivisions":
+        # 16 clicks per beat plus three against the bar, to show the cost
+        # of a block stays bounded with many overlapping pattern clicks
+        metro.set_beat_pattern([PatternLayer(16, gain=0.5), PatternLayer(3, beats=metro.beats_per_bar, sound=2)])
+    elif scenario == "gap_clicks":
+        metro.enable_gap_clicks(probability=0.3, seed=int(rng.integers(2**32)))
+
+    start = time.perf_counter()
+    callback_times = run_callback_loop(metro, num_blocks, events)
+    elapsed = time.perf_counter() - start
+
+    result = {"scenario": scenario,
+              "tempo": tempo,
+              "fs": metro.fs,
+              "blocksize": metro.BLOCKSIZE,
+              "blocks": len(callback_times),
+              "callback_us": percentiles(callback_times),
+              "blocks_per_second": len(callback_times) / elapsed}
+
+    # How late each tempo change was, compared with the beat it was
+    # scheduled for (a change is late when its beat had already been
+    # generated into the ring buffer), and how long after it was made it
+    # was heard. A change is timestamped with the end of the audio
+    # generated so far, which is the buffer latency ahead of what is being
+    # heard, so it should be heard within that plus one beat.
+    change_timings.append(metro.get_change_timing())
+    change_timings = [timing for timing in change_timings if timing is not None]
+    if change_timings:
+        delays = [timing["delay_ms"] for timing in change_timings]
+        buffer_latency_ms = 1000 * metro.get_latency()["buffer_latency"]
+        latencies = [buffer_latency_ms + 1000 * (timing["actual_onset"] - timing["requested_sample"]) / metro.fs
+                     for timing in change_timings]
+        result["changes_on_scheduled_beat"] = sum(delay == 0 for delay in delays) / len(delays)
+        result["max_change_delay_ms"] = max(delays)
+        result["max_change_latency_ms"] = max(latencies)
+
+    # Timing accuracy only makes sense while the tempo is constant, and
+    # with only the beat clicks playing
+    if scenario not in ("tempo_changes", "tempo_map", "subdivisions"):
+        result["onset_error_samples"] = onset_error(metro, metro.full_output)
+    return result
+
+
+def run_benchmarks(tempos, num_blocks, scenarios=SCENARIOS, sample_rates=(16000,), blocksizes=(512,), seed=0):
+    rng = np.random.default_rng(seed)
+    results = []
+    for fs in sample_rates:
+        for blocksize in blocksizes:
+            for tempo in tempos:
+                block_times = time_get_next_audio_block(tempo, fs, blocksize, num_blocks)
+                alloc_bytes, net_blocks = measure_allocations(tempo, fs, blocksize, min(num_blocks, 1000))
+                max_error, tolerance = float32_error(tempo, fs, blocksize, num_blocks)
+                for scenario in scenarios:
+                    result = run_scenario(scenario, tempo, fs, blocksize, num_blocks, rng)
+                    if scenario == "steady":
+                        result["get_next_audio_block_us"] = percentiles(block_times)
+                        result["alloc_peak_bytes_per_block"] = alloc_bytes
+                        result["net_allocated_blocks_per_block"] = net_blocks
+                        result["float32_max_error"] = max_error
+                        result["float32_within_precision"] = max_error <= tolerance
+                    results.append(result)
+    return results
+
+
+def print_results(results):
+    for result in results:
+        callback = result["callback_us"]
+        line = (f"{result['fs']:>6} Hz {result['blocksize']:>5} {result['scenario']:>18} {result['tempo']:>4} BPM  "
+                f"callback p50 {callback['p50']:7.1f} us  p99 {callback['p99']:7.1f} us  "
+                f"max {callback['max']:8.1f} us  {result['blocks_per_second']:9.0f} blocks/s")
+        if result.get("onset_error_samples") is not None:
+            line += f"  onset error {result['onset_error_samples']:.2f} samples"
+        if "max_change_delay_ms" in result:
+            line += f"  on scheduled beat {100 * result['changes_on_scheduled_beat']:.0f}%"
+            line += f"  max change delay {result['max_change_delay_ms']:.1f} ms"
+            line += f"  max change latency {result['max_change_latency_ms']:.1f} ms"
+        if "alloc_peak_bytes_per_block" in result:
+            line += f"  alloc {result['alloc_peak_bytes_per_block']:.0f} B/block"
+            line += f"  float32 error {result['float32_max_error']:.1e}"
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the metronome audio hot path.")
+    parser.add_argument("--tempos", type=int, nargs="+", default=[10, 60, 120, 180, 240, 350])
+    parser.add_argument("--blocks", type=int, default=3000, help="blocks per scenario")
+    parser.add_argument("--scenarios", nargs="+", default=SCENARIOS, choices=SCENARIOS)
+    parser.add_argument("--sample-rates", type=int, nargs="+", default=[16000])
+    parser.add_argument("--blocksizes", type=int, nargs="+", default=[512])
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.tempos, args.blocks, scenarios=args.scenarios,
+                             sample_rates=args.sample_rates, blocksizes=args.blocksizes)
+    print_results(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    # A loss of precision is a failure, not just a number in the results
+    imprecise = [result for result in results if result.get("float32_within_precision") is False]
+    for result in imprecise:
+        print(f"float32 output at {result['tempo']} BPM, {result['fs']} Hz differs from the float64 "
+              f"reference by {result['float32_max_error']:.1e}, more than float32 precision allows",
+              file=sys.stderr)
+    if imprecise:
+        sys.exit(1)
@@ -0,0 +1,72 @@
+'''
+Benchmark for application startup time.
+
+Each run starts a fresh Python interpreter (so nothing is already imported
+or cached in memory), which then times:
+    - importing the metronome and GUI modules
+    - creating the Metronome
+    - creating the App, up to the window first being drawn
+The total, from launching the interpreter to the first window, is timed
+from outside. The median of each over all runs is reported.
+
+Opening the audio device is not included, as it now happens on the first
+start(). The GUI needs a display; with --no-gui only the metronome is
+created, e.g. on a headless machine. Run it from the project directory.
+
+Example:
+    python benchmark_startup.py --runs 10
+    python benchmark_startup.py --no-gui --backend null
+'''
+import argparse
+import json
+import subprocess
+import sys
+import time
+import numpy as np
+
+
+STARTUP_SCRIPT = """
+import json, time
+start = time.perf_counter()
+from metronome_master_GH import Metronome
+if {gui}:
+    from metronome_tkinter_master_GH import App
+imported = time.perf_counter()
+metro = Metronome(tempo=180, beats_per_bar=4, backend={backend!r})
+created = time.perf_counter()
+if {gui}:
+    app = App(metro)
+    app.root.update()
+window = time.perf_counter()
+print(json.dumps({{"import_ms": (imported - start) * 1000,
+                  "metronome_ms": (created - imported) * 1000,
+                  "app_ms": (window - created) * 1000}}))
+"""
+
+
+def time_startup(gui=True, backend="sounddevice"):
+    script = STARTUP_SCRIPT.format(gui=gui, backend=backend)
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True)
+    total_ms = (time.perf_counter() - start) * 1000
+    result = json.loads(output.stdout.strip().splitlines()[-1])
+    result["total_ms"] = total_ms
+    return result
+
+
+def run_startup_benchmark(runs, gui=True, backend="sounddevice"):
+    results = [time_startup(gui, backend) for _ in range(runs)]
+    return {key: float(np.median([result[key] for result in results])) for key in results[0]}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the time to the first window.")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--no-gui", action="store_true", help="only create the Metronome")
+    parser.add_argument("--backend", default="sounddevice")
+    args = parser.parse_args()
+
+    medians = run_startup_benchmark(args.runs, gui=not args.no_gui, backend=args.backend)
+    print(f"imports {medians['import_ms']:.1f} ms, Metronome {medians['metronome_ms']:.1f} ms, "
+          f"App {medians['app_ms']:.1f} ms, total to first window {medians['total_ms']:.1f} ms "
+          f"(median of {args.runs} runs)")
@@ -0,0 +1,129 @@
+'''
+Benchmark for worker mode (see audio_worker.py) under load.
+
+The metronome plays for a while on a real-time null stream, which calls the
+callback at the pace a sound card would, with blocks generated either in
+the callback (thread mode, the default) or by the worker process (worker
+mode). Meanwhile, a synthetic load runs:
+    none    nothing else
+    gui     a thread in the same process doing pure-Python work in bursts,
+            holding the GIL, as Tk redraws and image work do
+    cpu     processes keeping every core busy
+    both    gui and cpu together
+
+For each mode and load this reports the callback's underflows (callbacks
+that finished after their block should have been heard) and missed
+deadlines per 1000 callbacks, whether the ring buffer ever ran dry, and the
+callback time percentiles. The beat pattern has 16 clicks per beat, so that
+generating a block is not trivial.
+
+The buffer depth is fixed, so that both modes have the same latency, and
+underflows are counted rather than stopping the stream.
+
+Example:
+    python benchmark_worker.py --seconds 10 --loads none gui cpu both
+    python benchmark_worker.py --fs 48000 --blocksize 64 --buffersize 8
+'''
+import argparse
+import multiprocessing
+import os
+import threading
+import time
+
+from metronome_master_GH import Metronome
+from audio_backends import NullBackend
+from beat_pattern import PatternLayer
+
+
+LOADS = ["none", "gui", "cpu", "both"]
+
+
+def gui_load(stop_event, burst_ms=20, idle_ms=5):
+    '''
+    Hold the GIL with pure-Python work for burst_ms at a time, with short
+    idle gaps, like a busy GUI thread.
+    '''
+    while not stop_event.is_set():
+        end = time.perf_counter() + burst_ms / 1000.0
+        total = 0
+        while time.perf_counter() < end:
+            total += sum(i * i for i in range(200))
+        time.sleep(idle_ms / 1000.0)
+
+
+def cpu_load(stop_event):
+    while not stop_event.is_set():
+        sum(i * i for i in range(10000))
+
+
+def start_load(load):
+    '''
+    Start the given load. Returns a function that stops it.
+    '''
+    stop_thread = threading.Event()
+    context = multiprocessing.get_context("spawn")
+    stop_processes = context.Event()
+    threads = []
+    processes = []
+    if load in ("gui", "both"):
+        threads.append(threading.Thread(target=gui_load, args=(stop_thread,), daemon=True))
+    if load in ("cpu", "both"):
+        for _ in range(os.cpu_count() or 1):
+            processes.append(context.Process(target=cpu_load, args=(stop_processes,), daemon=True))
+    for worker in threads + processes:
+        worker.start()
+
+    def stop():
+        stop_thread.set()
+        stop_processes.set()
+        for worker in threads + processes:
+            worker.join()
+    return stop
+
+
+def run_worker_benchmark(worker, load, seconds, fs, blocksize, buffersize):
+    metro = Metronome(tempo=200, fs=fs, blocksize=blocksize, buffersize=buffersize,
+                      backend=NullBackend(realtime=True), low_latency=True,
+                      min_buffer_depth=buffersize, worker=worker)
+    metro.set_beat_pattern([PatternLayer(16, gain=0.5), PatternLayer(3, beats=4, sound=2)])
+
+    stop_load = start_load(load)
+    # Let the load get going first
+    time.sleep(0.5)
+    metro.start()
+    start = time.perf_counter()
+    while metro.running and time.perf_counter() - start < seconds:
+        time.sleep(0.05)
+    ran_dry = not metro.running
+    stats = metro.get_stats()
+    metro.close()
+    stop_load()
+
+    callbacks = max(1, stats["num_callbacks"])
+    return {"mode": "worker" if worker else "thread",
+            "load": load,
+            "callbacks": stats["num_callbacks"],
+            "underflows_per_1000": 1000.0 * stats["output_underflows"] / callbacks,
+            "missed_deadlines_per_1000": 1000.0 * stats["missed_deadlines"] / callbacks,
+            "ring_ran_dry": ran_dry or stats["ring_empty"] > 0,
+            "callback_us_p50": stats["callback_time_us_p50"],
+            "callback_us_p99": stats["callback_time_us_p99"]}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare thread and worker mode under load.")
+    parser.add_argument("--seconds", type=float, default=5.0, help="playing time for each run")
+    parser.add_argument("--loads", nargs="+", default=LOADS, choices=LOADS)
+    parser.add_argument("--fs", type=int, default=48000)
+    parser.add_argument("--blocksize", type=int, default=128)
+    parser.add_argument("--buffersize", type=int, default=4)
+    args = parser.parse_args()
+
+    for load in args.loads:
+        for worker in (False, True):
+            result = run_worker_benchmark(worker, load, args.seconds, args.fs, args.blocksize, args.buffersize)
+            print(f"{result['load']:>5} load, {result['mode']:>6} mode: "
+                  f"{result['underflows_per_1000']:6.1f} underflows and "
+                  f"{result['missed_deadlines_per_1000']:6.1f} missed deadlines per 1000 callbacks, "
+                  f"callback p50 {result['callback_us_p50']:.0f} us p99 {result['callback_us_p99']:.0f} us"
+                  + ("  (ring buffer ran dry)" if result["ring_ran_dry"] else ""))
@@ -0,0 +1,103 @@
+'''
+Build step for the GUI images.
+
+The images in ./images are JPEGs of various sizes. Decoding them and
+resizing them with PIL every time the App starts is slow, so this script
+writes a pre-scaled PNG copy of every image the App uses, keyed by the
+size it is shown at:
+
+    images/cache/<width>x<height>/<name>.png
+    images/cache/full/<name>.png        (images shown at their own size)
+
+tkinter can load PNGs itself, so the App loads these with tk.PhotoImage and
+does not need to import PIL at all. If an image is missing from the cache,
+or its source image has changed since, the App builds it on demand (which
+does need PIL), so running this script is optional but makes the first
+launch quicker too.
+
+Example:
+    python build_image_atlas.py
+'''
+import os
+import glob
+
+
+IMAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "images")
+CACHE_DIR = os.path.join(IMAGE_DIR, "cache")
+
+# Every image the App shows, and the size it is shown at (None for the
+# image's own size). Keep these in step with App.load_images and
+# App.create_label_image_dict.
+BUTTON_SIZE = (80, int(0.676 * 80))
+LABEL_SIZE = (80, 120)
+GUI_IMAGES = [("play_button.jpg", None),
+              ("stop_button.jpg", None),
+              ("plus_button.jpg", BUTTON_SIZE),
+              ("minus_button.jpg", BUTTON_SIZE),
+              ("minus_5_button.jpg", BUTTON_SIZE),
+              ("minus_10_button.jpg", BUTTON_SIZE),
+              ("plus_5_button.jpg", BUTTON_SIZE),
+              ("plus_10_button.jpg", BUTTON_SIZE),
+              ("on/*.jpg", LABEL_SIZE),
+              ("off/*.jpg", LABEL_SIZE)]
+
+
+def find_images(pattern):
+    '''
+    Return the sorted paths of the images in IMAGE_DIR matching pattern,
+    ignoring the case of the file extension (some images are .JPG).
+    '''
+    root, ext = os.path.splitext(pattern)
+    paths = set()
+    for candidate_ext in (ext.lower(), ext.upper()):
+        paths.update(glob.glob(os.path.join(IMAGE_DIR, root + candidate_ext)))
+    return sorted(paths)
+
+
+def cached_image_path(path, size=None):
+    '''
+    Path of the cached PNG for the image at path, scaled to size.
+    '''
+    size_key = "full" if size is None else f"{size[0]}x{size[1]}"
+    name = os.path.splitext(os.path.relpath(path, IMAGE_DIR))[0] + ".png"
+    return os.path.join(CACHE_DIR, size_key, name)
+
+
+def build_scaled_image(path, size=None):
+    '''
+    Write the cached PNG for the image at path, resized to size.
+    '''
+    # PIL is only needed here, never when the cache is up to date
+    from PIL import Image
+
+    image = Image.open(path)
+    if size is not None:
+        image = image.resize(size, Image.LANCZOS)
+    cache_path = cached_image_path(path, size)
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    image.save(cache_path)
+    return cache_path
+
+
+def scaled_image_path(path, size=None):
+    '''
+    Return the path of a PNG of the image at path, scaled to size, building
+    it first if it is missing or out of date.
+    '''
+    cache_path = cached_image_path(path, size)
+    if not os.path.exists(cache_path) or os.path.getmtime(cache_path) < os.path.getmtime(path):
+        build_scaled_image(path, size)
+    return cache_path
+
+
+def build_all():
+    built = []
+    for pattern, size in GUI_IMAGES:
+        for path in find_images(pattern):
+            built.append(build_scaled_image(path, size))
+    return built
+
+
+if __name__ == "__main__":
+    for cache_path in build_all():
+        print(os.path.relpath(cache_path, IMAGE_DIR))
@@ -0,0 +1,268 @@
+import numpy as np
+import struct
+import threading
+
+
+class NullCapture():
+    '''
+    Capture sink that discards everything. This is the default, so a
+    Metronome left running all day uses no extra memory for capture.
+    '''
+
+    def write(self, block):
+        pass
+
+
+    def get_audio(self):
+        return np.zeros(0, dtype=np.float32)
+
+
+    def close(self):
+        pass
+
+
+
+class RingCapture():
+    '''
+    Keep the last `seconds` of output audio in a fixed-size array. Older audio
+    is overwritten, so memory use does not grow however long the stream runs.
+    '''
+
+    def __init__(self, fs, seconds=60, dtype=np.float32):
+        self.fs = fs
+        self.buffer = np.zeros(int(fs * seconds), dtype=dtype)
+        self.write_index = 0
+        self.num_samples_written = 0
+
+
+    def write(self, block):
+        size = len(self.buffer)
+        num_samples = len(block)
+        # Only the end of a block longer than the ring can survive anyway
+        if num_samples > size:
+            block = block[-size:]
+            num_samples = size
+
+        # Copy the block in, wrapping around the end of the ring if required
+        first_part = min(num_samples, size - self.write_index)
+        self.buffer[self.write_index:self.write_index + first_part] = block[:first_part]
+        self.buffer[:num_samples - first_part] = block[first_part:]
+
+        self.write_index = (self.write_index + num_samples) % size
+        self.num_samples_written += num_samples
+
+
+    def get_audio(self):
+        '''
+        Return a copy of the captured audio in playback order (oldest first).
+        '''
+        if self.num_samples_written < len(self.buffer):
+            return self.buffer[:self.write_index].copy()
+        return np.concatenate((self.buffer[self.write_index:], self.buffer[:self.write_index]))
+
+
+    def close(self):
+        pass
+
+
+
+class WavFileCapture():
+    '''
+    Write output audio to a 32-bit float WAV file on disk, through a memory
+    map. The file is grown in chunks of `chunk_seconds`, and only the mapped
+    chunks are ever touched, so memory use stays constant while the file
+    grows.
+
+    write() is called on the audio thread, so it never grows the file or
+    creates a memory map itself. A helper thread maps the next chunk while
+    the current one is being written, and write() only swaps it in. The
+    helper has a whole chunk's worth of time to do this, so write() only has
+    to wait for it if the disk is that far behind.
+
+    Call close() when finished to write the final header sizes.
+    '''
+
+    HEADER_SIZE = 44
+
+    def __init__(self, path, fs, chunk_seconds=60):
+        self.path = path
+        self.fs = fs
+        self.chunk_size = int(fs * chunk_seconds)
+        self.num_samples_written = 0
+
+        self.file = open(path, "w+b")
+        self.file.write(self.build_header(0))
+        self.chunk_start = 0
+        self.chunk = self.map_chunk(self.chunk_start)
+        self.chunk_index = 0
+
+        # Set by write() when it moves on to the next chunk, so the helper
+        # thread maps the one after it, and flushes old_chunk
+        self.chunk_needed = threading.Event()
+        # Set by the helper thread once next_chunk is mapped
+        self.chunk_ready = threading.Event()
+        self.next_chunk = None
+        self.old_chunk = None
+        self.closing = False
+        self.mapper = threading.Thread(target=self.map_chunks, daemon=True)
+        self.chunk_needed.set()
+        self.mapper.start()
+
+
+    def build_header(self, num_samples):
+        '''
+        Build a WAV header for mono 32-bit IEEE float audio.
+        '''
+        data_size = num_samples * 4
+        return struct.pack("<4sI4s4sIHHIIHH4sI",
+                           b"RIFF", 36 + data_size, b"WAVE",
+                           b"fmt ", 16, 3, 1, self.fs, self.fs * 4, 4, 32,
+                           b"data", data_size)
+
+
+    def map_chunk(self, chunk_start):
+        '''
+        Extend the file to the end of the chunk starting at sample
+        chunk_start, and map that chunk into memory.
+        '''
+        self.file.truncate(self.HEADER_SIZE + 4 * (chunk_start + self.chunk_size))
+        return np.memmap(self.file, dtype="<f4", mode="r+",
+                         offset=self.HEADER_SIZE + 4 * chunk_start,
+                         shape=(self.chunk_size,))
+
+
+    def map_chunks(self):
+        '''
+        Helper thread. Each time write() moves on to a new chunk, flush the
+        chunk it has finished with and map the one after the new chunk.
+        '''
+        while True:
+            self.chunk_needed.wait()
+            self.chunk_needed.clear()
+            if self.closing:
+                return
+            if self.old_chunk is not None:
+                self.old_chunk.flush()
+                self.old_chunk = None
+            self.next_chunk = self.map_chunk(self.chunk_start + self.chunk_size)
+            self.chunk_ready.set()
+
+
+    def write(self, block):
+        while len(block):
+            if self.chunk_index == self.chunk_size:
+                # Normally the helper thread mapped the next chunk long ago
+                self.chunk_ready.wait()
+                self.chunk_ready.clear()
+                self.old_chunk = self.chunk
+                self.chunk = self.next_chunk
+                self.chunk_start += self.chunk_size
+                self.chunk_index = 0
+                self.chunk_needed.set()
+
+            num_samples = min(len(block), self.chunk_size - self.chunk_index)
+            self.chunk[self.chunk_index:self.chunk_index + num_samples] = block[:num_samples]
+            self.chunk_index += num_samples
+            self.num_samples_written += num_samples
+            block = block[num_samples:]
+
+
+    def get_audio(self):
+        '''
+        Read back the audio written so far.
+        '''
+        if not self.file.closed:
+            self.chunk.flush()
+        return np.fromfile(self.path, dtype="<f4", offset=self.HEADER_SIZE)[:self.num_samples_written]
+
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.closing = True
+        self.chunk_needed.set()
+        self.mapper.join()
+        for chunk in (self.old_chunk, self.chunk):
+            if chunk is not None:
+                chunk.flush()
+        self.old_chunk = self.chunk = self.next_chunk = None
+        # Drop the unused end of the file and fill in the real sizes
+        self.file.truncate(self.HEADER_SIZE + 4 * self.num_samples_written)
+        self.file.seek(0)
+        self.file.write(self.build_header(self.num_samples_written))
+        self.file.close()
+
+
+
+def pcm_dtype(dtype):
+    '''
+    The little-endian NumPy dtype for raw PCM samples of dtype: a float type
+    (samples from -1 to 1) or a signed integer type such as "int16".
+    '''
+    dtype = np.dtype(dtype).newbyteorder("<")
+    if dtype.kind not in "fi":
+        raise Exception("PCM samples must be a float or signed integer type.")
+    return dtype
+
+
+def pcm_bytes(block, dtype):
+    '''
+    Convert a block of float audio to raw PCM bytes of dtype (from
+    pcm_dtype). Integer samples are scaled to the type's full range.
+    '''
+    if dtype.kind == "f":
+        return block.astype(dtype).tobytes()
+    full_scale = np.iinfo(dtype).max
+    samples = np.clip(np.rint(block * np.float64(full_scale)), -full_scale - 1, full_scale)
+    return samples.astype(dtype).tobytes()
+
+
+
+class PcmStreamSink():
+    '''
+    Write output audio as raw PCM to a binary file object or a connected
+    socket, e.g. one listener of a MetronomeBank (see metronome_bank.py).
+    '''
+
+    def __init__(self, stream, dtype="int16"):
+        self.stream = stream
+        self.dtype = pcm_dtype(dtype)
+        self.num_samples_written = 0
+
+
+    def write(self, block):
+        data = pcm_bytes(block, self.dtype)
+        # Sockets have sendall, which keeps going until everything is sent
+        if hasattr(self.stream, "sendall"):
+            self.stream.sendall(data)
+        else:
+            self.stream.write(data)
+        self.num_samples_written += len(block)
+
+
+    def get_audio(self):
+        return np.zeros(0, dtype=np.float32)
+
+
+    def close(self):
+        self.stream.close()
+
+
+
+def create_capture_sink(mode="off", fs=16000, seconds=60, path=None):
+    '''
+    Create a capture sink for a Metronome. The modes are:
+        "off":  discard the output (NullCapture)
+        "ring": keep the last `seconds` of output in memory (RingCapture)
+        "wav":  write all output to the WAV file at `path` (WavFileCapture)
+    '''
+    if mode == "off":
+        return NullCapture()
+    elif mode == "ring":
+        return RingCapture(fs, seconds=seconds)
+    elif mode == "wav":
+        if path is None:
+            raise Exception("A path is required for capture mode 'wav'.")
+        return WavFileCapture(path, fs)
+    else:
+        raise Exception(f"Unknown capture mode '{mode}'. Use 'off', 'ring' or 'wav'.")
@@ -0,0 +1,184 @@
+import os
+import wave
+from functools import lru_cache
+import numpy as np
+
+
+# The click samples are stored next to this file, so they can be found
+# whatever the current working directory is
+SAMPLE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "samples")
+CLICK_FILES = {"hi": "hi.wav", "lo": "lo.wav"}
+
+# Resampled click samples, keyed by (name, sample rate)
+click_sample_cache = {}
+
+# Parameters of synthesize_click, with their defaults: a short 1 kHz beep.
+# Times are in seconds, and levels are relative.
+SYNTH_DEFAULTS = {"frequency": 1000.0,     # of the tone, in Hz
+                  "tone": 1.0,             # level of the tone
+                  "noise": 0.0,            # level of the noise burst
+                  "attack": 0.0005,        # linear fade in of both
+                  "tone_decay": 0.01,      # exponential decay time constant of the tone
+                  "noise_decay": 0.003,    # ...and of the noise
+                  "length": 0.03,          # of the whole click
+                  "gain": 0.5,             # peak level of the click
+                  "seed": 0}               # for the noise, so a click is always the same
+
+# Some ready-made synthesized clicks, which can be used by name in a click
+# set (see load_click_set)
+CLICK_PRESETS = {"beep_hi": {"frequency": 1600.0},
+                 "beep_lo": {"frequency": 1000.0},
+                 "wood_hi": {"frequency": 1900.0, "noise": 0.4, "tone_decay": 0.006, "length": 0.025},
+                 "wood_lo": {"frequency": 1250.0, "noise": 0.4, "tone_decay": 0.008, "length": 0.025},
+                 "tick": {"tone": 0.0, "noise": 1.0, "noise_decay": 0.002, "length": 0.01}}
+
+# The number of synthesized clicks to keep. The least recently used click
+# is dropped when the cache is full.
+SYNTH_CACHE_SIZE = 64
+
+
+def read_sound_file(path):
+    '''
+    Read a mono sound file, returning the samples (float64, between -1 and
+    1) and the sample rate. 16-bit WAV files, like the click samples, are
+    read with the standard library's wave module, which is much quicker to
+    import than audiofile. Anything else is read with audiofile, which is
+    only imported when it is needed.
+    '''
+    try:
+        with wave.open(path, "rb") as wav:
+            if wav.getsampwidth() == 2 and wav.getnchannels() == 1:
+                frames = wav.readframes(wav.getnframes())
+                return np.frombuffer(frames, dtype="<i2") / 32768.0, wav.getframerate()
+    except wave.Error:
+        pass
+    import audiofile
+    return audiofile.read(path)
+
+
+def resample(samples, fs_in, fs_out):
+    '''
+    Resample a short sound from fs_in to fs_out, using the FFT. The sound is
+    padded with silence first, so that the end of the sound does not wrap
+    around onto the start. The calculation is done in float64.
+    '''
+    if fs_in == fs_out:
+        return samples.copy()
+
+    padded = np.concatenate((samples, np.zeros(len(samples))))
+    num_out = int(round(len(padded) * fs_out / fs_in))
+
+    spectrum = np.fft.rfft(padded)
+    num_bins = num_out // 2 + 1
+    if num_bins > len(spectrum):
+        spectrum = np.concatenate((spectrum, np.zeros(num_bins - len(spectrum), dtype=complex)))
+    else:
+        spectrum = spectrum[:num_bins]
+
+    resampled = np.fft.irfft(spectrum, n=num_out) * (num_out / len(padded))
+    return resampled[:int(round(len(samples) * fs_out / fs_in))]
+
+
+def load_click_sample(name, fs):
+    '''
+    Return the click sample called `name` ("hi" or "lo") at sample rate fs.
+    Each sample is read and resampled only once per sample rate; after that
+    the cached array is returned. Samples are stored as float32, the same
+    as every other buffer in the engine.
+    '''
+    key = (name, fs)
+    if key not in click_sample_cache:
+        samples, file_fs = read_sound_file(os.path.join(SAMPLE_DIR, CLICK_FILES[name]))
+        samples = resample(samples, file_fs, fs).astype(np.float32)
+        # The cached array is shared between Metronome instances
+        samples.flags.writeable = False
+        click_sample_cache[key] = samples
+    return click_sample_cache[key]
+
+
+def synthesize_click(fs, **params):
+    '''
+    Synthesize a click at sample rate fs from a tone and a burst of noise,
+    each with its own exponential decay after a short linear attack (see
+    SYNTH_DEFAULTS for the parameters). Returns a read-only float32 array.
+
+    Clicks are cached by their parameters and sample rate, so asking for
+    the same click again costs a dictionary lookup, and the same array is
+    shared by everything that uses it.
+    '''
+    unknown = set(params) - set(SYNTH_DEFAULTS)
+    if unknown:
+        raise Exception(f"Unknown click parameters: {', '.join(sorted(unknown))}.")
+    values = dict(SYNTH_DEFAULTS, **params)
+    if values["length"] <= 0 or values["frequency"] <= 0 or values["frequency"] >= fs / 2:
+        raise Exception("A click needs a positive length, and a frequency below half the sample rate.")
+    # Always the same order, so equal parameters make equal cache keys
+    return cached_click(fs, *(float(values[name]) for name in SYNTH_DEFAULTS))
+
+
+@lru_cache(maxsize=SYNTH_CACHE_SIZE)
+def cached_click(fs, frequency, tone, noise, attack, tone_decay, noise_decay, length, gain, seed):
+    '''
+    The cached part of synthesize_click. Every sample of the click is
+    worked out at once, in float64.
+    '''
+    t = np.arange(int(round(length * fs))) / fs
+    attack_envelope = np.minimum(1.0, t / attack) if attack > 0 else np.ones_like(t)
+    after_attack = np.maximum(t - attack, 0.0)
+
+    click = tone * np.sin(2 * np.pi * frequency * t) * np.exp(-after_attack / max(tone_decay, 1e-9))
+    if noise:
+        rng = np.random.default_rng(int(seed))
+        click += noise * rng.uniform(-1.0, 1.0, len(t)) * np.exp(-after_attack / max(noise_decay, 1e-9))
+    click *= attack_envelope
+
+    # Fade out over the last millisecond, so the click never ends on a jump
+    fade_length = min(len(t), max(1, int(0.001 * fs)))
+    click[len(t) - fade_length:] *= np.linspace(1.0, 0.0, fade_length)
+
+    peak = np.abs(click).max() if len(click) else 0.0
+    if peak > 0:
+        click *= gain / peak
+    click = click.astype(np.float32)
+    click.flags.writeable = False
+    return click
+
+
+def synth_cache_info():
+    '''
+    Hits, misses and size of the synthesized click cache.
+    '''
+    return cached_click.cache_info()
+
+
+def load_click_sound(sound, fs):
+    '''
+    Return one click sound at sample rate fs, as a float32 array. sound is
+    one of:
+        None                silence
+        "hi" or "lo"        a click sample (see load_click_sample)
+        a preset name       a synthesized click from CLICK_PRESETS
+        a dict              parameters for synthesize_click
+        an array            samples, already at fs
+    '''
+    if sound is None:
+        return np.zeros(0, dtype=np.float32)
+    if isinstance(sound, str):
+        if sound in CLICK_FILES:
+            return load_click_sample(sound, fs)
+        if sound in CLICK_PRESETS:
+            return synthesize_click(fs, **CLICK_PRESETS[sound])
+        raise Exception(f"Unknown click sound '{sound}'.")
+    if isinstance(sound, dict):
+        return synthesize_click(fs, **sound)
+    return np.asarray(sound, dtype=np.float32)
+
+
+def load_click_set(click_set, fs):
+    '''
+    Load a click set: a list of click sounds (see load_click_sound), where
+    entry i is the sound played for click index i. Entry 0 is normally
+    None, so that index 0 is silent, as with the default set, which is
+    [None, "lo", "hi"].
+    '''
+    return [load_click_sound(sound, fs) for sound in click_set]
@@ -0,0 +1,196 @@
+import numpy as np
+
+
+# One record per beat. sound is the click index played (0 if the beat was
+# silent, e.g. silenced by gap clicks), bar counts from 0 at start(), and
+# dac_time is NaN until the beat's block has been given to the stream.
+BEAT_LOG_DTYPE = np.dtype([("sample", np.int64),
+                           ("dac_time", np.float64),
+                           ("bar", np.int64),
+                           ("beat", np.int16),
+                           ("sound", np.int16),
+                           ("tempo", np.float64)])
+
+
+class BeatLog():
+    '''
+    A record of every beat played, for the GUI's beat display, and for
+    aligning recordings and analysis to the click without scanning the
+    audio.
+
+    The records are kept in a preallocated NumPy structured array (see
+    BEAT_LOG_DTYPE), so the log never grows: once it is full, each new
+    record overwrites the oldest. The default capacity of 65536 beats is
+    2.4 MB, and holds over three hours at 350 BPM.
+
+    Records are written in two steps by the audio thread. When a beat
+    starts in a generated block, record() stores it. Its DAC time is not
+    known yet, because the block has not been given to the stream. The next
+    callback knows the DAC time of the block it is outputting, so it calls
+    stamp() to work out the DAC time of every beat recorded since, which
+    publishes them to read(). Like BlockRingBuffer, the indices count up
+    forever and are wrapped with % capacity when used. Only the audio thread
+    writes.
+
+    read() gives the GUI one beat at a time, as it is published. views() and
+    to_numpy() give the records as NumPy arrays without copying them, and
+    tofile() writes them to a .npy file straight from the log. Finding the
+    beat at any sample position is then a binary search over the beats (see
+    align), rather than a scan over the samples.
+    '''
+
+    def __init__(self, capacity=65536, records=None):
+        self.capacity = capacity
+        if records is None:
+            records = np.zeros(capacity, dtype=BEAT_LOG_DTYPE)
+        self.use_records(records)
+        self.reset()
+
+
+    def use_records(self, records):
+        '''
+        Keep the records in the given structured array of BEAT_LOG_DTYPE.
+        '''
+        self.records = records
+        # Views of each field, so the audio thread writes single numbers
+        self.samples = records["sample"]
+        self.dac_times = records["dac_time"]
+        self.bars = records["bar"]
+        self.beats = records["beat"]
+        self.sounds = records["sound"]
+        self.tempos = records["tempo"]
+
+
+    def reset(self):
+        # Only call this when the audio thread is not running
+        self.write_index = 0        # beats recorded
+        self.stamped_index = 0      # beats with a DAC time
+
+
+    def record(self, sample_position, bar, beat, sound, tempo):
+        '''
+        Audio thread. Record a beat starting at sample_position.
+        '''
+        slot = self.write_index % self.capacity
+        self.samples[slot] = sample_position
+        self.dac_times[slot] = np.nan
+        self.bars[slot] = bar
+        self.beats[slot] = beat
+        self.sounds[slot] = sound
+        self.tempos[slot] = tempo
+        self.write_index += 1
+
+
+    def stamp(self, dac_time, block_start, fs):
+        '''
+        Audio thread. Called once per callback, where block_start is the
+        sample position of the block being output and dac_time is the time
+        its first sample leaves the DAC. The blocks behind it follow on
+        without gaps, so every recorded beat's DAC time can be worked out
+        from its distance to block_start.
+        '''
+        while self.stamped_index < self.write_index:
+            slot = self.stamped_index % self.capacity
+            self.dac_times[slot] = dac_time + (self.samples[slot] - block_start) / fs
+            self.stamped_index += 1
+
+
+    def read(self, index):
+        '''
+        Return (index, beat, dac_time) for beat number index, or None if it
+        has not been published yet. If the record has been overwritten, the
+        oldest record still held is returned instead, with its own index: a
+        reader that falls that far behind simply skips ahead, as old beats
+        are of no use to the GUI anyway.
+        '''
+        while True:
+            # Slots are reused by record(), so skip beats that are too old
+            index = max(index, self.write_index - self.capacity + 1)
+            if index >= self.stamped_index:
+                return None
+            slot = index % self.capacity
+            beat = int(self.beats[slot])
+            dac_time = float(self.dac_times[slot])
+            # If the slot was reused while we read it, try again
+            if self.write_index - index < self.capacity:
+                return index, beat, dac_time
+
+
+    def first_onset_at_or_after(self, sample_position):
+        '''
+        Audio thread. Return the sample position of the earliest recorded
+        beat starting at or after sample_position, or None if there is none.
+        Only the beats still held are searched, newest first.
+        '''
+        first = None
+        index = self.write_index - 1
+        while index >= 0 and index >= self.write_index - self.capacity:
+            onset = int(self.samples[index % self.capacity])
+            if onset < sample_position:
+                break
+            first = onset
+            index -= 1
+        return first
+
+
+    def __len__(self):
+        return min(self.write_index, self.capacity)
+
+
+    def views(self):
+        '''
+        The records held, oldest first, as one or two views of the log (two
+        once it has wrapped round). Nothing is copied, so while playing the
+        views change as beats are recorded; copy them, or read them while
+        stopped, for a fixed snapshot. Beats in the ring buffer that have
+        not been heard yet are included, with a dac_time of NaN.
+        '''
+        write_index = self.write_index
+        if write_index <= self.capacity:
+            return (self.records[:write_index],)
+        split = write_index % self.capacity
+        return self.records[split:], self.records[:split]
+
+
+    def to_numpy(self):
+        '''
+        The records held, oldest first, as a single structured array. This
+        is a view of the log (no copy) unless it has wrapped round.
+        '''
+        views = self.views()
+        if len(views) == 1:
+            return views[0]
+        return np.concatenate(views)
+
+
+    def tofile(self, path):
+        '''
+        Write the records held to a .npy file (read it back with np.load,
+        or np.load(path, mmap_mode="r")). The records are written straight
+        from the log, without copying them into one array first.
+        '''
+        views = self.views()
+        header = {"descr": np.lib.format.dtype_to_descr(BEAT_LOG_DTYPE),
+                  "fortran_order": False,
+                  "shape": (sum(len(view) for view in views),)}
+        with open(path, "wb") as f:
+            np.lib.format.write_array_header_2_0(f, header)
+            for view in views:
+                view.tofile(f)
+        return path
+
+
+
+def align(records, sample_positions):
+    '''
+    Align sample positions (e.g. of onsets found in a recording) to the
+    click grid in records (from BeatLog.to_numpy, or loaded from a file).
+    Returns, for each position, the index of the record of the beat it
+    falls in (the last beat starting at or before it, or -1 if it is
+    before the first beat) and its offset from that beat's onset, in
+    samples. The records must be in order, as the log keeps them.
+    '''
+    sample_positions = np.asarray(sample_positions, dtype=np.int64)
+    indices = np.searchsorted(records["sample"], sample_positions, side="right") - 1
+    offsets = sample_positions - records["sample"][np.maximum(indices, 0)]
+    return indices, offsets
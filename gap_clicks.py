@@ -0,0 +1,118 @@
+import numpy as np
+
+
+class GapClicks():
+    '''
+    Randomly silences beats, to help develop internal timing. Either every
+    beat is silenced independently with the given probability, or the
+    given number of beats is silenced in every bar (all of them, if there
+    are fewer beats in the bar).
+
+    The random choices come from a NumPy Generator seeded with seed, so the
+    same seed always silences the same beats of the same bars, and a
+    session can be replayed. If no seed is given, one is picked at random
+    and kept in self.seed.
+
+    The masks saying which beats to silence are generated ahead of time,
+    batch_bars bars at a time, into a preallocated ring of two batches. As
+    the audio thread moves into one batch, the other is refilled with the
+    bars after it, so the audio thread only ever reads a mask by index.
+
+    Each bar's mask holds a row for every possible beats per bar, so the
+    beats per bar can be changed while playing. For a count, the beats of
+    a bar are given random priorities, and the count beats with the lowest
+    priorities (among the beats in the bar) are silenced.
+    '''
+
+    def __init__(self, probability=None, count=None, seed=None, max_beats_per_bar=8, batch_bars=16):
+        if (probability is None) == (count is None):
+            raise Exception("Specify exactly one of probability or count.")
+        if probability is not None and not 0 <= probability <= 1:
+            raise Exception("The probability of silencing a beat must be between 0 and 1.")
+        if count is not None and count < 0:
+            raise Exception("The number of beats to silence cannot be negative.")
+
+        self.probability = probability
+        self.count = count
+        if seed is None:
+            seed = np.random.SeedSequence().entropy
+        self.seed = seed
+        self.max_beats_per_bar = max_beats_per_bar
+        self.batch_bars = batch_bars
+
+        # masks[slot, beats_per_bar - 1, beat - 1] is True if the beat is
+        # silenced, for the bar at that slot of the ring
+        self.masks = np.zeros((2 * batch_bars, max_beats_per_bar, max_beats_per_bar), dtype=bool)
+        # Work arrays for fill()
+        self.priorities = np.zeros((batch_bars, max_beats_per_bar))
+        self.lower = np.zeros((batch_bars, max_beats_per_bar, max_beats_per_bar), dtype=bool)
+        self.ranks = np.zeros((batch_bars, max_beats_per_bar, max_beats_per_bar), dtype=np.int64)
+        # A bar of b beats only has beats 1 to b
+        self.beat_in_bar = np.tri(max_beats_per_bar, dtype=bool)
+        self.reset()
+
+
+    def reset(self):
+        '''
+        Go back to the first bar, with the random generator freshly seeded.
+        '''
+        self.rng = np.random.default_rng(self.seed)
+        self.bar = -1
+        self.fill(0)
+        self.fill(1)
+
+
+    def fill(self, batch):
+        '''
+        Generate the masks for the next batch_bars bars into batch 0 or 1 of
+        the ring. Every step works in the preallocated arrays.
+        '''
+        masks = self.masks[batch * self.batch_bars:(batch + 1) * self.batch_bars]
+        self.rng.random(out=self.priorities)
+        if self.probability is not None:
+            # The same beats are silenced whatever the beats per bar
+            np.less(self.priorities[:, None, :], self.probability, out=masks)
+        else:
+            # lower[bar, beat, other] is True if other has a lower priority
+            # than beat, so ranks[bar, beat, b - 1] is the rank of beat among
+            # the first b beats
+            np.less(self.priorities[:, None, :], self.priorities[:, :, None], out=self.lower)
+            np.cumsum(self.lower, axis=2, out=self.ranks)
+            np.less(self.ranks.transpose(0, 2, 1), self.count, out=masks)
+        np.logical_and(masks, self.beat_in_bar, out=masks)
+
+
+    def next_bar(self):
+        '''
+        Audio thread. Move on to the next bar. When a batch has just been
+        finished with, it is refilled with the bars after the other batch.
+        '''
+        self.bar += 1
+        slot = self.bar % (2 * self.batch_bars)
+        if slot == 0 and self.bar > 0:
+            self.fill(1)
+        elif slot == self.batch_bars:
+            self.fill(0)
+
+
+    def is_silent(self, beats_per_bar, beat):
+        '''
+        Audio thread. True if beat (1 to beats_per_bar) of the current bar
+        is silenced.
+        '''
+        return self.masks[self.bar % (2 * self.batch_bars), beats_per_bar - 1, beat - 1]
+
+
+    def bar_masks(self, num_bars, beats_per_bar):
+        '''
+        The masks of the first num_bars bars, as an array of shape
+        (num_bars, beats_per_bar), for offline rendering. These are the same
+        beats that are silenced live, from the same seed. This does not
+        change the position of this GapClicks.
+        '''
+        replay = GapClicks(self.probability, self.count, self.seed, self.max_beats_per_bar, self.batch_bars)
+        masks = []
+        for bar in range(num_bars):
+            replay.next_bar()
+            masks.append(replay.masks[replay.bar % (2 * replay.batch_bars), beats_per_bar - 1, :beats_per_bar].copy())
+        return np.array(masks, dtype=bool).reshape(num_bars, beats_per_bar)
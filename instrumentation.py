@@ -0,0 +1,227 @@
+import numpy as np
+import time
+
+
+class CallbackStats():
+    '''
+    Low-overhead counters and histograms for the audio callback.
+
+    Everything is preallocated, and the audio thread only ever increments
+    numbers in place, so recording never locks or grows anything. Other
+    threads (e.g. the GUI) read the values with snapshot().
+
+    A sequence number is incremented before and after every update. It is
+    odd while an update is in progress, so snapshot() can tell when it has
+    read a half-finished update and simply read again (a seqlock). The audio
+    thread never waits for a reader.
+
+    Histograms have fixed-width bins, with the last bin also counting
+    everything larger:
+        callback_time:      execution time of the callback, in microseconds
+        headroom:           time left before the block's deadline when the
+                            callback finished, in milliseconds
+        fill_level:         number of blocks in the ring buffer
+    '''
+
+    def __init__(self, ring_capacity, time_bin_us=10, num_time_bins=200,
+                 headroom_bin_ms=1, num_headroom_bins=100):
+        self.time_bin_us = time_bin_us
+        self.headroom_bin_ms = headroom_bin_ms
+
+        self.callback_time_hist = np.zeros(num_time_bins, dtype=np.int64)
+        self.headroom_hist = np.zeros(num_headroom_bins, dtype=np.int64)
+        self.fill_level_hist = np.zeros(ring_capacity + 1, dtype=np.int64)
+        self.reset()
+
+
+    def reset(self):
+        self.sequence = 0
+        self.callback_time_hist.fill(0)
+        self.headroom_hist.fill(0)
+        self.fill_level_hist.fill(0)
+
+        self.num_callbacks = 0
+        self.output_underflows = 0
+        self.output_overflows = 0
+        self.ring_empty = 0
+        self.missed_deadlines = 0
+        self.max_callback_time = 0.0
+        self.min_headroom = float("inf")
+        self.last_fill_level = 0
+
+        self.num_tempo_changes = 0
+        self.last_tempo_change_latency = 0.0
+        self.max_tempo_change_latency = 0.0
+
+
+    def record_callback(self, callback_time, headroom, fill_level):
+        '''
+        Called by the audio thread at the end of every callback. Times are
+        in seconds. headroom is negative if the deadline was missed.
+        '''
+        self.sequence += 1
+
+        self.num_callbacks += 1
+        time_bin = int(callback_time * 1e6 / self.time_bin_us)
+        self.callback_time_hist[min(time_bin, len(self.callback_time_hist) - 1)] += 1
+        if callback_time > self.max_callback_time:
+            self.max_callback_time = callback_time
+
+        if headroom < 0:
+            self.missed_deadlines += 1
+            headroom_bin = 0
+        else:
+            headroom_bin = min(int(headroom * 1e3 / self.headroom_bin_ms), len(self.headroom_hist) - 1)
+        self.headroom_hist[headroom_bin] += 1
+        if headroom < self.min_headroom:
+            self.min_headroom = headroom
+
+        self.fill_level_hist[fill_level] += 1
+        self.last_fill_level = fill_level
+
+        self.sequence += 1
+
+
+    def record_status(self, status):
+        '''
+        Count the underflow/overflow flags reported by the output stream.
+        '''
+        self.sequence += 1
+        if status.output_underflow:
+            self.output_underflows += 1
+        if status.output_overflow:
+            self.output_overflows += 1
+        self.sequence += 1
+
+
+    def record_ring_empty(self):
+        self.sequence += 1
+        self.ring_empty += 1
+        self.sequence += 1
+
+
+    def record_tempo_change(self, latency):
+        '''
+        Record how long (in seconds) a tempo change took to be applied by
+        the audio thread after set_new_tempo was called.
+        '''
+        self.sequence += 1
+        self.num_tempo_changes += 1
+        self.last_tempo_change_latency = latency
+        if latency > self.max_tempo_change_latency:
+            self.max_tempo_change_latency = latency
+        self.sequence += 1
+
+
+    def histogram_percentile(self, hist, bin_width, percentile):
+        '''
+        Approximate a percentile from a histogram, as the upper edge of the
+        bin that contains it.
+        '''
+        total = hist.sum()
+        if total == 0:
+            return 0.0
+        index = int(np.searchsorted(np.cumsum(hist), total * percentile / 100.0))
+        return (index + 1) * bin_width
+
+
+    def snapshot(self):
+        '''
+        Return a consistent copy of all the statistics as a dict. Safe to
+        call from any thread while the audio thread is running.
+        '''
+        while True:
+            sequence = self.sequence
+            if sequence % 2:
+                # The audio thread is part way through an update. Let it finish.
+                time.sleep(0)
+                continue
+
+            callback_time_hist = self.callback_time_hist.copy()
+            headroom_hist = self.headroom_hist.copy()
+            fill_level_hist = self.fill_level_hist.copy()
+            stats = {"num_callbacks": self.num_callbacks,
+                     "output_underflows": self.output_underflows,
+                     "output_overflows": self.output_overflows,
+                     "ring_empty": self.ring_empty,
+                     "missed_deadlines": self.missed_deadlines,
+                     "max_callback_time_us": self.max_callback_time * 1e6,
+                     "min_headroom_ms": self.min_headroom * 1e3 if self.num_callbacks else None,
+                     "fill_level": self.last_fill_level,
+                     "num_tempo_changes": self.num_tempo_changes,
+                     "last_tempo_change_latency_ms": self.last_tempo_change_latency * 1e3,
+                     "max_tempo_change_latency_ms": self.max_tempo_change_latency * 1e3}
+
+            if sequence == self.sequence:
+                break
+
+        stats["callback_time_us_p50"] = self.histogram_percentile(callback_time_hist, self.time_bin_us, 50)
+        stats["callback_time_us_p99"] = self.histogram_percentile(callback_time_hist, self.time_bin_us, 99)
+        stats["callback_time_hist"] = callback_time_hist
+        stats["headroom_hist"] = headroom_hist
+        stats["fill_level_hist"] = fill_level_hist
+        return stats
+
+
+
+class ChangeTiming():
+    '''
+    When the last tempo or beats per bar change made while playing was
+    scheduled to be heard, and when it actually was.
+
+    A change is timestamped with a sample position when it is requested
+    (see Metronome.timestamp_change), and should start at the first beat
+    onset at or after it: the scheduled onset. The audio thread can only
+    make it at the first beat that has not been generated yet: the actual
+    onset. They are the same unless the scheduled beat was already in the
+    ring buffer, in which case the difference is the cost of generating
+    ahead.
+
+    The values are kept in a small int64 array, which can be in shared
+    memory (see audio_worker.py), with a sequence number in front as in
+    CallbackStats, so snapshot() never sees a half-written record.
+    '''
+
+    FIELDS = ("requested_sample", "scheduled_onset", "actual_onset", "tempo", "beats_per_bar")
+    LENGTH = 1 + len(FIELDS)
+
+    def __init__(self, values=None):
+        if values is None:
+            values = np.zeros(self.LENGTH, dtype=np.int64)
+        self.values = values
+
+
+    def record(self, requested_sample, scheduled_onset, actual_onset, tempo, beats_per_bar):
+        '''
+        Audio thread. Record a change that has just been made.
+        '''
+        self.values[0] += 1
+        self.values[1] = requested_sample
+        self.values[2] = scheduled_onset
+        self.values[3] = actual_onset
+        self.values[4] = tempo
+        self.values[5] = beats_per_bar
+        self.values[0] += 1
+
+
+    def snapshot(self, fs):
+        '''
+        Return the last change as a dict, or None if no change has been
+        made while playing. Safe to call from any thread (or process).
+        '''
+        while True:
+            sequence = int(self.values[0])
+            if sequence % 2:
+                time.sleep(0)
+                continue
+            values = [int(value) for value in self.values[1:]]
+            if sequence == int(self.values[0]):
+                break
+
+        if sequence == 0:
+            return None
+        timing = dict(zip(self.FIELDS, values))
+        timing["num_changes"] = sequence // 2
+        timing["delay_samples"] = timing["actual_onset"] - timing["scheduled_onset"]
+        timing["delay_ms"] = timing["delay_samples"] * 1e3 / fs
+        return timing
@@ -1,7 +1,12 @@
+import sys
 from metronome_master_GH import Metronome
 from metronome_tkinter_master_GH import App
 
 
-metronome = Metronome(tempo=180, beats_per_bar=4)
-app = App(metronome)
-app.root.mainloop()
\ No newline at end of file
+# The worker process is spawned, and imports this module, so only start the
+# App when run as a script. Run with --worker to generate the audio in a
+# separate process (see audio_worker.py).
+if __name__ == "__main__":
+    metronome = Metronome(tempo=180, beats_per_bar=4, worker="--worker" in sys.argv)
+    app = App(metronome)
+    app.root.mainloop()
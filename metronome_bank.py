@@ -0,0 +1,290 @@
+import numpy as np
+from fractions import Fraction
+
+from click_bank import load_click_sample
+
+
+class MetronomeBank():
+    '''
+    Many independent click streams rendered together, for serving a
+    metronome to each of a number of listeners (e.g. a class of students)
+    from one process.
+
+    A Metronome renders a single stream, with an output stream of its own.
+    A MetronomeBank holds the state of up to capacity sessions as arrays,
+    with one element per session: the exact samples per beat, the sample
+    of the next beat, the beat in the bar, the click sound of each beat and
+    so on. render_block() then renders the next block of every session at
+    once, into a (capacity, blocksize) array, with a handful of NumPy
+    operations over all of the sessions rather than a loop over them. Each
+    row is then sent on to wherever that session is listening (see
+    fan_out and capture.py for file and socket sinks).
+
+    The timing is that of the Metronome: each beat starts on the exact
+    sample worked out with integer arithmetic, as in BeatScheduler, so a
+    session never drifts, and changes to the tempo, beats per bar or click
+    sounds are made at the session's next beat. A session sounds exactly
+    like Metronome.render at the same tempo and click indices.
+
+    Sessions are numbered by their row in the block. A bank is used by one
+    thread, which makes changes between calls to render_block.
+    '''
+
+    def __init__(self, capacity=64, fs=16000, blocksize=512, dtype=np.float32):
+        self.min_tempo = 10
+        self.max_tempo = 350
+        self.max_beats_per_bar = 8
+
+        self.capacity = capacity
+        self.fs = fs
+        self.BLOCKSIZE = blocksize
+        self.dtype = dtype
+        # The sample position of the start of the next block, shared by
+        # every session
+        self.position = 0
+
+        # The click sounds (0: no sound, 1: lo, 2: hi), one row each, laid
+        # out so that sample k of a click started at onset is at column
+        # blocksize + k. The zeros either side mean that any block's worth
+        # of a click can be looked up without checking where it starts or
+        # ends: columns before it are silence, and so is the last column,
+        # which everything after the click is clipped to. Clicks are cut to
+        # the shortest beat, so a click always ends before the next one.
+        hi = load_click_sample("hi", fs)
+        lo = load_click_sample("lo", fs)
+        click_length = min(max(len(hi), len(lo)), int(fs * 60.0 / self.max_tempo) + 1)
+        self.click_length = click_length
+        self.sound_length = blocksize + click_length + 1
+        self.sounds = np.zeros((3, self.sound_length), dtype=dtype)
+        for row, click in ((1, lo), (2, hi)):
+            click = click[:click_length]
+            self.sounds[row, blocksize:blocksize + len(click)] = click
+        self.flat_sounds = self.sounds.ravel()
+
+        # Session state, one element per session
+        self.active = np.zeros(capacity, dtype=bool)
+        self.tempo = np.zeros(capacity, dtype=np.float64)
+        # Samples per beat, as the fraction numerator / denominator. As in
+        # BeatScheduler, beat k of a tempo segment starts at sample
+        # segment_start + (k * numerator) // denominator.
+        self.numerator = np.ones(capacity, dtype=np.int64)
+        self.denominator = np.ones(capacity, dtype=np.int64)
+        self.segment_start = np.zeros(capacity, dtype=np.int64)
+        self.beats_in_segment = np.zeros(capacity, dtype=np.int64)
+        self.next_onset = np.zeros(capacity, dtype=np.int64)
+        # The beat being heard (1 to beats_per_bar, or 0 before the first),
+        # when it started and its click sound
+        self.beat = np.zeros(capacity, dtype=np.int64)
+        self.onset = np.zeros(capacity, dtype=np.int64)
+        self.sound = np.zeros(capacity, dtype=np.int64)
+        self.beats_per_bar = np.ones(capacity, dtype=np.int64)
+        self.click_indices = np.zeros((capacity, self.max_beats_per_bar), dtype=np.int64)
+        # Changes waiting for the next beat. A denominator or beats per bar
+        # of 0 means there is no change waiting.
+        self.pending_tempo = np.zeros(capacity, dtype=np.float64)
+        self.pending_numerator = np.zeros(capacity, dtype=np.int64)
+        self.pending_denominator = np.zeros(capacity, dtype=np.int64)
+        self.pending_beats_per_bar = np.zeros(capacity, dtype=np.int64)
+        self.pending_click_indices = np.zeros((capacity, self.max_beats_per_bar), dtype=np.int64)
+
+        # The rendered block, and work arrays for render_block
+        self.block = np.zeros((capacity, blocksize), dtype=dtype)
+        self.gathered = np.zeros((capacity, blocksize), dtype=dtype)
+        self.sample_indices = np.zeros((capacity, blocksize), dtype=np.int64)
+        self.block_samples = np.arange(blocksize, dtype=np.int64)
+
+
+    def add_session(self, tempo=120, click_indices=None, beats_per_bar=4):
+        '''
+        Start a new session, whose first beat is the first sample of the
+        next block. click_indices has the click sound of each beat of the
+        bar (by default hi then lo, as in the Metronome), and sets the beats
+        per bar. Returns the session number.
+        '''
+        free = np.flatnonzero(~self.active)
+        if len(free) == 0:
+            raise Exception(f"All {self.capacity} sessions are in use.")
+        session = int(free[0])
+
+        self.numerator[session], self.denominator[session] = self.samples_per_beat(tempo)
+        self.tempo[session] = tempo
+        self.segment_start[session] = self.position
+        self.beats_in_segment[session] = 0
+        self.next_onset[session] = self.position
+        self.beat[session] = 0
+        self.sound[session] = 0
+        self.onset[session] = self.position
+        click_indices = self.check_click_indices(click_indices, beats_per_bar)
+        self.click_indices[session] = 0
+        self.click_indices[session, :len(click_indices)] = click_indices
+        self.beats_per_bar[session] = len(click_indices)
+        self.pending_beats_per_bar[session] = 0
+        self.pending_denominator[session] = 0
+        self.active[session] = True
+        return session
+
+
+    def remove_session(self, session):
+        '''
+        End a session. Its row of the block is silent from the next block.
+        '''
+        self.active[session] = False
+        self.sound[session] = 0
+        self.pending_denominator[session] = 0
+        self.pending_beats_per_bar[session] = 0
+
+
+    def samples_per_beat(self, tempo):
+        '''
+        The exact number of samples per beat at tempo, as (numerator,
+        denominator). Tempos that are not whole numbers are rounded to the
+        nearest 1/1000 BPM, to keep the integers small.
+        '''
+        if tempo < self.min_tempo or tempo > self.max_tempo:
+            raise Exception(f"Tempo must be between {self.min_tempo} and {self.max_tempo}.")
+        samples = Fraction(self.fs * 60) / Fraction(tempo).limit_denominator(1000)
+        return samples.numerator, samples.denominator
+
+
+    def check_click_indices(self, click_indices, beats_per_bar):
+        if click_indices is None:
+            click_indices = [2] + [1] * (beats_per_bar - 1)
+        click_indices = np.asarray(click_indices, dtype=np.int64)
+        if not 1 <= len(click_indices) <= self.max_beats_per_bar:
+            raise Exception(f"Value for beats_per_bar must be between 1 and {self.max_beats_per_bar}.")
+        if np.any((click_indices < 0) | (click_indices > 2)):
+            raise Exception("Click indices must be 0 (no sound), 1 (lo) or 2 (hi).")
+        return click_indices
+
+
+    def set_tempo(self, session, tempo):
+        '''
+        Change a session's tempo from its next beat.
+        '''
+        numerator, denominator = self.samples_per_beat(tempo)
+        self.pending_tempo[session] = tempo
+        self.pending_numerator[session] = numerator
+        self.pending_denominator[session] = denominator
+
+
+    def set_click_indices(self, session, click_indices):
+        '''
+        Change a session's click sounds, and with them its beats per bar,
+        from its next beat. If the bar gets shorter than the beat being
+        played, a new bar starts at the next beat.
+        '''
+        click_indices = self.check_click_indices(click_indices, None)
+        self.pending_click_indices[session] = 0
+        self.pending_click_indices[session, :len(click_indices)] = click_indices
+        self.pending_beats_per_bar[session] = len(click_indices)
+
+
+    def set_beats_per_bar(self, session, beats_per_bar):
+        '''
+        Change a session's beats per bar from its next beat, with the
+        default click sounds.
+        '''
+        self.set_click_indices(session, self.check_click_indices(None, beats_per_bar))
+
+
+    def start_beats(self, sessions):
+        '''
+        Start the next beat of each of the given sessions, making any
+        changes that are waiting for it.
+        '''
+        # A new tempo starts a new segment at this beat
+        changing = sessions[self.pending_denominator[sessions] != 0]
+        if len(changing):
+            self.tempo[changing] = self.pending_tempo[changing]
+            self.numerator[changing] = self.pending_numerator[changing]
+            self.denominator[changing] = self.pending_denominator[changing]
+            self.segment_start[changing] = self.next_onset[changing]
+            self.beats_in_segment[changing] = 0
+            self.pending_denominator[changing] = 0
+        changing = sessions[self.pending_beats_per_bar[sessions] != 0]
+        if len(changing):
+            self.beats_per_bar[changing] = self.pending_beats_per_bar[changing]
+            self.click_indices[changing] = self.pending_click_indices[changing]
+            self.pending_beats_per_bar[changing] = 0
+
+        beat = self.beat[sessions]
+        beat = np.where(beat < self.beats_per_bar[sessions], beat + 1, 1)
+        self.beat[sessions] = beat
+        self.sound[sessions] = self.click_indices[sessions, beat - 1]
+        self.onset[sessions] = self.next_onset[sessions]
+
+        self.beats_in_segment[sessions] += 1
+        self.next_onset[sessions] = (self.segment_start[sessions]
+                                     + (self.beats_in_segment[sessions] * self.numerator[sessions])
+                                     // self.denominator[sessions])
+
+
+    def look_up_clicks(self, out, sample_indices, onsets, sounds):
+        '''
+        Fill out (one row per session) with the block's worth of each
+        session's click that starts at onsets, from the sounds table.
+        '''
+        # Sample k of the click is at column blocksize + k of its sound
+        start_columns = self.BLOCKSIZE + self.position - onsets + sounds * self.sound_length
+        end_columns = sounds * self.sound_length + self.sound_length - 1
+        np.add(self.block_samples, start_columns[:, None], out=sample_indices)
+        np.minimum(sample_indices, end_columns[:, None], out=sample_indices)
+        np.take(self.flat_sounds, sample_indices, out=out)
+
+
+    def render_block(self):
+        '''
+        Render the next block of every session into self.block, and return
+        it. Rows of sessions that are not in use are silent.
+
+        A click is much shorter than a beat, so most of the time most rows
+        are silent. The block starts out silent, and the clicks still
+        sounding at its start are looked up for just the sessions that have
+        one, all in one go. Then the clicks of the beats that start within
+        the block are added, for all of the sessions with a beat starting,
+        again in one go (there is only ever more than one round of these if
+        a beat can be shorter than a block).
+        '''
+        self.block.fill(0)
+        sounding = np.flatnonzero((self.sound != 0) & (self.position - self.onset < self.click_length))
+        if len(sounding):
+            num_sounding = len(sounding)
+            gathered = self.gathered[:num_sounding]
+            self.look_up_clicks(gathered, self.sample_indices[:num_sounding],
+                                self.onset[sounding], self.sound[sounding])
+            self.block[sounding] = gathered
+
+        block_end = self.position + self.BLOCKSIZE
+        while True:
+            starting = np.flatnonzero(self.active & (self.next_onset < block_end))
+            if len(starting) == 0:
+                break
+            self.start_beats(starting)
+            num_starting = len(starting)
+            gathered = self.gathered[:num_starting]
+            self.look_up_clicks(gathered, self.sample_indices[:num_starting],
+                                self.onset[starting], self.sound[starting])
+            self.block[starting] += gathered
+
+        self.position = block_end
+        return self.block
+
+
+    def fan_out(self, sinks):
+        '''
+        Send each session's row of the last block to its sink. sinks is a
+        dict of {session: sink}, where a sink is anything with a
+        write(block) method, e.g. from capture.py: a WavFileCapture for a
+        file, or a PcmStreamSink for a socket.
+        '''
+        for session, sink in sinks.items():
+            sink.write(self.block[session])
+
+
+    def render_to(self, sinks, num_blocks=1):
+        '''
+        Render num_blocks blocks, sending each one out to sinks.
+        '''
+        for _ in range(num_blocks):
+            self.render_block()
+            self.fan_out(sinks)
@@ -1,13 +1,52 @@
-import sounddevice as sd
 import numpy as np
-import audiofile
 import sys
-import queue
 import threading
+from functools import wraps
+from time import perf_counter
+from audio_backends import create_backend, CallbackAbort, CallbackStop
+from capture import create_capture_sink, pcm_dtype, pcm_bytes
+from beat_scheduler import BeatScheduler, tempo_step
+from tempo_map import TempoMap
+from ring_buffer import BlockRingBuffer
+from instrumentation import CallbackStats, ChangeTiming
+from event_log import BeatLog
+from beat_pattern import BeatPattern
+from gap_clicks import GapClicks
+from midi_export import write_click_track
+from click_bank import load_click_sample, load_click_set
+
+
+def forward_to_worker(method):
+    '''
+    Decorator for the Metronome methods that change what is played. In
+    worker mode, a call made in the GUI process is repeated by the worker
+    process's Metronome (see audio_worker.py). Calls made from inside
+    another forwarded method are not forwarded again, as the worker makes
+    them itself.
+    
+    A change made without an at_sample (see timestamp_change) is
+    timestamped by the worker when it gets the call, as only the worker
+    knows how far ahead it has generated.
+    '''
+    @wraps(method)
+    def forwarding_method(self, *args, **kwargs):
+        if self.worker is None or self.forwarding:
+            return method(self, *args, **kwargs)
+        self.forwarding = True
+        try:
+            result = method(self, *args, **kwargs)
+        finally:
+            self.forwarding = False
+        self.worker.send(method.__name__, *args, **kwargs)
+        return result
+    return forwarding_method
+
 
 
 class Metronome():
-    def __init__(self, tempo=180, beats_per_bar=4):
+    def __init__(self, tempo=180, beats_per_bar=4, capture_mode="off", capture_seconds=60, capture_path=None,
+                 backend="sounddevice", fs=16000, blocksize=512, buffersize=10,
+                 low_latency=False, min_buffer_depth=1, worker=False, backend_options=None):
         # Define limits for tempo and beats_per_bar
         self.min_tempo = 10
         self.max_tempo = 350
@@ -21,6 +60,11 @@ class Metronome():
         if beats_per_bar < self.min_beats_per_bar or beats_per_bar > self.max_beats_per_bar:
             raise Exception(f"Value for beats_per_bar must be between {self.min_beats_per_bar} and {self.max_beats_per_bar}.")
         
+        # In worker mode the blocks are generated in the worker process, so
+        # this process never sees them to capture them
+        if worker and capture_mode != "off":
+            raise Exception("Capture is not available in worker mode.")
+        
         
         self.tempo = tempo
         self.beats_per_bar = beats_per_bar
@@ -28,39 +72,129 @@ class Metronome():
         # State attribute
         self.running = False
         
+        # True while generate_blocks is producing the audio, instead of the
+        # output stream
+        self.generating = False
+        
         # Used for changing tempo while playing
         self.new_tempo = None   
         self.tempo_change_pending = False
         
-        # Load and define the arrays of samples for different click sounds
-        self.fs = 16000     # sample rate of audio, in Hz
-        self.hi, _ = audiofile.read("./samples/hi.wav")
-        self.lo, _ = audiofile.read("./samples/lo.wav")
+        # All audio in the engine is float32, from the click samples through
+        # to the stream, so no block ever needs converting
+        self.dtype = np.float32
+        
+        # Load and define the arrays of samples for different click sounds.
+        # The samples are resampled to fs once, and cached (see click_bank.py).
+        # Other click sets, including synthesized clicks, can be chosen with
+        # update_beat_sample_dict.
+        self.fs = fs     # sample rate of audio, in Hz
+        self.hi = load_click_sample("hi", self.fs)
+        self.lo = load_click_sample("lo", self.fs)
         self.empty_click = np.zeros_like(self.lo)
         
         
-        # Define attributes for use with audio stream
-        self.BLOCKSIZE = 512    # samples per block of audio
-        # TODO - write code to pre-fill the queue
-        self.BUFFERSIZE = 10    # blocks of audio to pre-fill queue with
+        # Define attributes for use with audio stream. Clicks are sliced out
+        # of the bar cache, so a click may span any number of blocks and
+        # small block sizes are fine.
+        self.BLOCKSIZE = blocksize    # samples per block of audio
+        self.BUFFERSIZE = buffersize    # blocks of audio to pre-fill the ring buffer with
         self.TIMEOUT = self.BLOCKSIZE * self.BUFFERSIZE / self.fs
         
-        self.q = queue.Queue(maxsize=self.BUFFERSIZE)
+        # Buffer depth is the number of blocks in the ring buffer when the
+        # callback reads from it, i.e. how far generation runs ahead of what
+        # is heard. Normally this is always BUFFERSIZE. In low-latency mode
+        # it starts at min_buffer_depth. In worker mode it is then adapted
+        # while playing (see adapt_buffer_depth), between min_buffer_depth
+        # and BUFFERSIZE. Without a worker it stays at min_buffer_depth, as
+        # the callback generates the blocks it plays, so a deeper buffer
+        # would only add latency.
+        if min_buffer_depth < 1 or min_buffer_depth > self.BUFFERSIZE:
+            raise Exception(f"Value for min_buffer_depth must be between 1 and {self.BUFFERSIZE}.")
+        self.low_latency = low_latency
+        self.min_buffer_depth = min_buffer_depth
+        self.max_buffer_depth = self.BUFFERSIZE
+        self.buffer_depth = self.min_buffer_depth if self.low_latency else self.BUFFERSIZE
+        # Grow the buffer if a callback finishes with less than this much
+        # time (in seconds) left before its deadline...
+        self.min_headroom = 0.5 * self.BLOCKSIZE / self.fs
+        # ...and shrink it again after this many callbacks in a row (about
+        # 2 seconds' worth) without an underflow or a close call
+        self.shrink_after_callbacks = max(1, int(2 * self.fs / self.BLOCKSIZE))
+        self.healthy_callbacks = 0
+        
+        # In worker mode, blocks are generated by a separate process (see
+        # audio_worker.py), which is started at the end of __init__. Until
+        # then, and without a worker, worker is None.
+        self.worker = None
+        self.forwarding = False
+        if worker:
+            # Only imported when needed, to keep startup quick
+            from audio_worker import SharedBlockRing, SharedBeatLog
+        
+        # Lock-free ring of audio blocks (and their beat numbers) between
+        # get_next_audio_block and the output stream. In worker mode it is
+        # in shared memory, and filled by the worker process.
+        if worker:
+            self.ring = SharedBlockRing(self.BUFFERSIZE, self.BLOCKSIZE, dtype=self.dtype)
+        else:
+            self.ring = BlockRingBuffer(self.BUFFERSIZE, self.BLOCKSIZE, dtype=self.dtype)
+        # Counters and histograms recorded by the callback. Read them from
+        # other threads with get_stats().
+        self.stats = CallbackStats(self.BUFFERSIZE)
+        # A record of every beat played since start(), with its bar, sound,
+        # tempo and the time it is heard, for the GUI and for analysis. See
+        # event_log.py, get_beat_event and get_beat_log.
+        if worker:
+            self.beat_log = SharedBeatLog()
+        else:
+            self.beat_log = BeatLog()
+        # Bars started since start(), less one (the first bar is bar 0)
+        self.bar_number = -1
+        self.tempo_change_requested_at = 0.0
+        # Tempo and beats per bar changes made while playing are timestamped
+        # with a sample position, and are made at the first beat onset at or
+        # after it (see timestamp_change). change_timing records when the
+        # last one was scheduled and actually made. In worker mode it is in
+        # shared memory, as the worker makes the changes.
+        self.change_at_sample = 0
+        self.change_requested = False
+        if worker:
+            self.change_timing = self.ring.change_timing
+        else:
+            self.change_timing = ChangeTiming()
         self.event = threading.Event()
-        self.stream = self.create_stream()
+        # The backend provides the output stream. See audio_backends.py for
+        # the available backends ("sounddevice", "null" or "file").
+        # backend_options are passed on to a backend given by name, e.g.
+        # {"path": "click.wav"} for "file", which needs one.
+        if isinstance(backend, str):
+            backend = create_backend(backend, **(backend_options or {}))
+        elif backend_options:
+            raise Exception("backend_options can only be used with a backend given by name.")
+        self.backend = backend
+        # The output stream (and with it the audio device) is only opened
+        # on the first call to start(), so creating a Metronome is quick
+        self.stream = None
         
         
         # Instantiate attributes related to click timing
         self.num_samples_until_next_click = 0
         self.float_interval = self.fs * 60.0 / self.tempo
         self.interval = int(self.fs * 60.0 / self.tempo)
-        self.interval_samples_elapsed = 0
         
-        # Create a block of zeros to deliver to the stream between clicks
-        self.zero_array = np.zeros(self.BLOCKSIZE)
+        # Block filled by get_next_audio_block when it is not given one to fill
+        self.scratch_block = np.zeros(self.BLOCKSIZE, dtype=self.dtype)
+        # Set when all of the audio has been generated, i.e. play_for_num_bars
+        # or the speed trainer has reached end_sample (the sample position at
+        # which the output ends, or None to play until stopped)
+        self.bars_finished = False
+        self.end_sample = None
         
         # Instantiate some counters
         self.total_samples_delivered = 0
+        self.samples_generated = 0      # samples written by get_next_audio_block since start
+        self.samples_output = 0         # samples read from the ring buffer by the callback since start
         self.current_beat = 0
         self.beat_to_show = 0
         self.beats_at_tempo = 0
@@ -68,87 +202,240 @@ class Metronome():
         
         # Set up the array that determines which click sound to use for each beat
         self.beat_click_indices = self.create_beat_click_index_array()
-        self.click_sounds = np.array([self.empty_click, self.lo, self.hi])
-        # Initialise a dictionary with click sound choice for each beat, using default values
+        # click_sounds[i] is the sound of click index i. It is a list, as
+        # the sounds of a custom click set can be of any length.
+        self.click_set = None
+        self.click_sounds = [self.empty_click, self.lo, self.hi]
+        
+        # Drift error compensation. The scheduler works out the exact length
+        # of each beat using integer arithmetic (see beat_scheduler.py).
+        # With tempo automation (see set_tempo_map), a TempoMapScheduler is
+        # used instead.
+        self.tempo_map = None
+        self.scheduler = BeatScheduler(self.fs, self.tempo)
+        # The scheduler used without a tempo map. It is kept while a tempo
+        # map is used, so that a tempo change can go back to it without a
+        # new scheduler being made on the audio thread.
+        self.constant_scheduler = self.scheduler
+        
+        # The bar cache holds one pre-rendered bar of audio, with one row per
+        # beat. next_bar_cache is replaced whenever the tempo or beat pattern
+        # changes, and the audio thread swaps it in at the next beat boundary.
+        self.bar_cache = None
+        self.active_bar_cache = None
+        self.next_bar_cache = None
+        # The beats per bar of the bar cache being played. While a change is
+        # waiting, this is not the same as beats_per_bar.
+        self.playing_beats_per_bar = beats_per_bar
+        # Length (in samples) of the beat currently being delivered
+        self.beat_length = 0
+        
+        # Subdivision and polyrhythm layers (see set_beat_pattern). The
+        # pattern is compiled into each bar cache, and its clicks are mixed
+        # into pattern_mix, which is longer than a block so that a click can
+        # carry on into the following blocks. pattern_mix_length is how much
+        # of it is in use. Pattern clicks are cut to the shortest beat.
+        self.beat_pattern = None
+        self.compiled_pattern = None
+        self.max_pattern_click_length = int(self.fs * 60.0 / self.max_tempo) + 1
+        self.pattern_mix = np.zeros(self.BLOCKSIZE + self.max_pattern_click_length, dtype=self.dtype)
+        self.pattern_mix_length = 0
+        # Sample offsets and sound ids of the current beat's pattern clicks,
+        # and the next one to be mixed
+        self.no_pattern_onsets = np.zeros(0, dtype=np.int64)
+        self.pattern_onsets = self.no_pattern_onsets
+        self.pattern_sound_ids = self.no_pattern_onsets
+        self.pattern_cursor = 0
+        
+        # Gap click mode (see enable_gap_clicks). gap_clicks is swapped in
+        # as active_gap_clicks at the start of a bar. A silenced beat is
+        # played from silent_row, which is as long as the slowest beat.
+        self.gap_clicks = None
+        self.active_gap_clicks = None
+        self.beat_silenced = False
+        self.silent_row = np.zeros(int(self.fs * 60.0 / self.min_tempo) + 1, dtype=self.dtype)
+        
+        # Initialise a dictionary with click sound choice for each beat, using default values.
+        # This also renders the first bar cache.
         self.update_beat_sample_dict(self.beat_click_indices)
-        # bool for improved code readability
-        self.click_is_due_in_this_block = False  
         
-        # Drift error compensation
-        self.accumulated_drift_error = 0.0
-        self.drift_error_per_block = self.compute_drift_error_per_block()
-        self.samples_to_shift = 0
+        # For plotting and saving to WAV for analysis. See capture.py for the
+        # available modes ("off", "ring" or "wav").
+        self.capture = create_capture_sink(capture_mode, fs=self.fs,
+                                           seconds=capture_seconds, path=capture_path)
         
-        # For plotting and saving to WAV for analysis
-        self.full_output = []
-        # Store the "tail" of a click that spans 2 adjacent arrays of size self.BLOCKSIZE
-        self.tail_array = None  
         
+        # Speed trainer (see enable_trainer)
+        self.trainer_enabled = False
+        self.trainer_schedule = None
+        self.trainer_index = 0
+        # The tempo of the audio being heard right now. This follows the
+        # speed trainer; otherwise it is the tempo playing started at.
+        self.playing_tempo = self.tempo
         
-    # TODO - Speed trainer is in development
-    # def enable_trainer(self, start_tempo, bars_at_tempo, bpm_increase, num_increases):
-    #     self.trainer_enabled = True
-    #     self.trainer_start_tempo = start_tempo
-    #     self.trainer_bars_at_tempo = bars_at_tempo
-    #     self.trainer_bpm_increase = bpm_increase
-    #     self.trainer_num_increases = num_increases
+        if worker:
+            from audio_worker import AudioWorker
+            settings = {"tempo": tempo, "beats_per_bar": beats_per_bar, "fs": fs,
+                        "blocksize": blocksize, "buffersize": buffersize}
+            self.worker = AudioWorker(settings, self.ring, self.beat_log)
         
-    #     self.trainer_end_tempo = self.trainer_start_tempo + (self.trainer_num_increases * self.trainer_bpm_increase)
         
-
-    # def disable_trainer(self):
-    #     self.trainer_active = False
+    @forward_to_worker
+    def enable_trainer(self, start_tempo, bars_at_tempo, bpm_increase, num_increases):
+        '''
+        Speed trainer. Play bars_at_tempo bars at start_tempo, then the same
+        number of bars at each of num_increases faster tempos, bpm_increase
+        BPM apart, and then stop. Only call this while stopped; the trainer
+        runs the next time the metronome is started.
+        
+        The trainer is a tempo map (see set_tempo_map) of constant tempo
+        segments, so every tempo change happens exactly at the start of a
+        bar. Changing the tempo with set_new_tempo ends the trainer.
+        '''
+        if self.running:
+            raise Exception("Stop the metronome before enabling the speed trainer.")
+        if bars_at_tempo < 1 or num_increases < 0:
+            raise Exception("The speed trainer needs at least one bar at each tempo.")
+        
+        self.trainer_start_tempo = start_tempo
+        self.trainer_bars_at_tempo = bars_at_tempo
+        self.trainer_bpm_increase = bpm_increase
+        self.trainer_num_increases = num_increases
+        self.trainer_end_tempo = self.trainer_start_tempo + (self.trainer_num_increases * self.trainer_bpm_increase)
+        
+        tempo_map = [(i * bars_at_tempo, start_tempo + i * bpm_increase) for i in range(num_increases + 1)]
+        self.set_tempo_map(tempo_map)
+        self.trainer_enabled = True
+    
+    
+    @forward_to_worker
+    def disable_trainer(self):
+        '''
+        Go back to playing at a constant tempo until stopped. Only call this
+        while stopped.
+        '''
+        if self.trainer_enabled:
+            self.trainer_enabled = False
+            self.set_tempo_map(None)
+    
+    
+    def compile_trainer_schedule(self):
+        '''
+        Compile the speed trainer into a practice schedule: a structured
+        array of (start_sample, tempo), one entry per tempo, plus a final
+        entry with a tempo of 0 whose start_sample is the sample at which
+        the trainer ends. The callback walks through it with an index
+        (trainer_index) to know which tempo is being heard.
+        '''
+        beats_per_bar = self.beats_per_bar
+        scheduler = self.tempo_map.scheduler(self.fs, beats_per_bar)
+        num_beats = (self.trainer_num_increases + 1) * self.trainer_bars_at_tempo * beats_per_bar
+        _, end_sample = self.tempo_map.onsets(self.fs, beats_per_bar, num_beats=num_beats)
         
+        schedule = np.zeros(self.trainer_num_increases + 2, dtype=[("start_sample", np.int64), ("tempo", np.float64)])
+        schedule["start_sample"][:-1] = scheduler.segment_starts + [scheduler.final_start]
+        schedule["tempo"][:-1] = self.tempo_map.tempos()
+        schedule[-1] = (end_sample, 0)
+        return schedule
+    
+    
+    def enable_gap_clicks(self, probability=None, count=None, seed=None):
+        '''
+        Gap click mode: randomly silence beats, either each beat with the
+        given probability, or count beats in every bar. The same seed always
+        silences the same beats, from the start of playing, so a session can
+        be replayed (the seed used is kept in self.gap_clicks.seed). The
+        beat pattern's clicks are silenced along with the beat.
         
+        This can be done while playing, and takes effect at the next bar.
+        '''
+        self.gap_clicks = GapClicks(probability=probability, count=count, seed=seed,
+                                    max_beats_per_bar=self.max_beats_per_bar)
+        # The worker must use the same seed, even if it was picked at random
+        if self.worker is not None:
+            self.worker.send("enable_gap_clicks", probability=probability, count=count, seed=self.gap_clicks.seed)
+    
+    
+    @forward_to_worker
+    def disable_gap_clicks(self):
+        '''
+        Play every beat again, from the next bar.
+        '''
+        self.gap_clicks = None
+    
     
     def pre_fill_queue(self):
-        # Range is (BUFFERSIZE-1) because the first callback will add a block too
-        # and otherwise we get an exception because the queue is already full.
-        for _ in range(self.BUFFERSIZE-1):
-            next_audio_block, beat = self.get_next_audio_block()
-            # Debugging print statements to check output
-            # print(f"Mean: {np.mean(next_audio_block)}")
-            # print(f"Queue size before putting: {self.q.qsize()}")
-            if not len(next_audio_block):
+        # Range is (buffer_depth-1) because the first callback will add a block too
+        # and otherwise there would be no room for it in the ring buffer.
+        for _ in range(self.buffer_depth-1):
+            next_audio_block, beat = self.get_next_audio_block(self.ring.get_write_block())
+            self.ring.commit_write(beat)
+            # Pass the new audio block to the capture sink for later examination
+            self.capture.write(next_audio_block)
+            if self.bars_finished:
                 break
-            self.q.put_nowait([next_audio_block, beat])
-            # Append the new audio block to full_output for later examination
-            self.full_output.append(next_audio_block)
+    
+    
+    @property
+    def full_output(self):
+        '''
+        The audio captured so far by the capture sink, as a single array.
+        '''
+        return self.capture.get_audio()
+    
+    
+    def set_capture_sink(self, sink):
+        '''
+        Replace the capture sink. Any object with write(block), get_audio()
+        and close() methods can be used. The old sink is closed.
+        '''
+        old_sink = self.capture
+        self.capture = sink
+        old_sink.close()
     
     
     def create_stream(self):        
-        # Create an OutputStream instance
-        return sd.OutputStream(samplerate=self.fs,
-                                     blocksize=self.BLOCKSIZE,
-                                     channels=1,
-                                     callback=self.callback,
-                                     finished_callback=self.event.set)
+        # Create an output stream instance using the audio backend
+        return self.backend.create_stream(samplerate=self.fs,
+                                          blocksize=self.BLOCKSIZE,
+                                          callback=self.callback,
+                                          finished_callback=self.stream_finished)
     
     
     # TODO - these increase and decrease methods may be combined (DRY)
     # and would just require an additional parameter
-    def increase_beats_per_bar(self):
+    @forward_to_worker
+    def increase_beats_per_bar(self, at_sample=None):
         if self.beats_per_bar < self.max_beats_per_bar:
+            if self.running:
+                self.timestamp_change(at_sample)
             self.beats_per_bar += 1
-            new_click_indices = np.append(self.beat_click_indices, [1])
+            # The new beat keeps any click index it had before the bar was
+            # shortened (or was given by the GUI), and is "lo" otherwise
+            new_click_indices = self.beat_click_indices
+            if len(new_click_indices) < self.beats_per_bar:
+                new_click_indices = np.append(new_click_indices, [1])
             self.update_beat_sample_dict(new_click_indices)
         
     
-    def decrease_beats_per_bar(self):
+    @forward_to_worker
+    def decrease_beats_per_bar(self, at_sample=None):
+        # If beats_per_bar is reduced below the current beat while playing,
+        # the bar ends after the current beat (see start_next_beat)
         if self.beats_per_bar > 1:
+            if self.running:
+                self.timestamp_change(at_sample)
             self.beats_per_bar -= 1
-            new_click_indices = self.beat_click_indices[:-1]
-            self.update_beat_sample_dict(new_click_indices)
-            
-            # Handle quick consecutive calls. If beats_per_bar is reduced below
-            # the current beat while playing, reset the current beat to 1.
-            if self.current_beat > self.beats_per_bar:
-                self.current_beat = 1
+            # The dropped beat's click index is kept, for if it comes back
+            self.update_beat_sample_dict(self.beat_click_indices)
     
     
-    def set_new_tempo(self, new_tempo_value):
+    @forward_to_worker
+    def set_new_tempo(self, new_tempo_value, at_sample=None):
         # This would be called by a Controller after the View has been updated
-        # by the user to select a new tempo value using the Scale widget
+        # by the user to select a new tempo value using the Scale widget.
+        # While playing, the new tempo starts at the first beat at or after
+        # at_sample (see timestamp_change).
         new_tempo_value = int(new_tempo_value)
         
         # Check new tempo is in valid range
@@ -156,13 +443,92 @@ class Metronome():
             # If not running, recompute values and reset counters for updated tempo
             if self.running == False:
                 self.tempo = new_tempo_value
+                self.new_tempo = None
                 self.update_values_for_new_tempo()
+                self.next_bar_cache = self.render_bar_cache()
+                self.apply_bar_cache(self.next_bar_cache)
             
-            # If running, instruct a tempo change to occur at next beat
-            else:
-                if new_tempo_value != self.tempo:    
+            # In worker mode, the worker process makes the change at the
+            # right beat. This process only keeps its tempo up to date for
+            # the GUI, and renders its bar cache when playing stops (see
+            # reset_position).
+            elif self.worker is not None:
+                if new_tempo_value != self.tempo:
                     self.new_tempo = new_tempo_value
-                    self.tempo_change_pending = True
+                    self.update_values_for_new_tempo()
+            
+            # If running, instruct a tempo change to occur at next beat.
+            # The bar cache for the new tempo is rendered here, so the audio
+            # thread only has to swap it in. A tempo already waiting to be
+            # used is replaced, and going back to the tempo being played
+            # cancels it.
+            else:
+                waiting_tempo = self.new_tempo if self.tempo_change_pending else self.tempo
+                if new_tempo_value != waiting_tempo:
+                    self.timestamp_change(at_sample)
+                    if new_tempo_value != self.tempo:
+                        self.new_tempo = new_tempo_value
+                        self.tempo_change_pending = True
+                        self.tempo_change_requested_at = perf_counter()
+                    else:
+                        self.new_tempo = None
+                        self.tempo_change_pending = False
+                    self.next_bar_cache = self.render_bar_cache(tempo=new_tempo_value)
+    
+    
+    def timestamp_change_sample(self):
+        '''
+        The sample position to timestamp a change with by default: the end
+        of the audio generated so far. Everything before it is already in
+        the ring buffer, waiting to be heard.
+        '''
+        return self.samples_generated
+    
+    
+    def timestamp_change(self, at_sample=None):
+        '''
+        Timestamp a tempo or beats per bar change made while playing. The
+        change is made at the first beat onset at or after at_sample (a
+        sample position since start(), by default the end of the audio
+        generated so far), exactly on that beat's sample, and the beats
+        carry on from there without any jump in phase. at_sample can be in
+        the future, to schedule a change ahead of time.
+        
+        The audio is generated up to buffer_depth blocks ahead of what is
+        being heard, and blocks already generated are not changed. So by
+        default a change is heard at the first beat that has not been
+        generated yet: at most the total latency (see get_latency; 288 ms
+        plus the stream's own latency at the default 16 kHz, 512 sample
+        blocks and buffer depth of 10) plus one beat after it was made. Low-latency mode keeps the buffer
+        shorter. If at_sample is given and its beat has already been
+        generated, the change is made at the first beat after that instead;
+        get_change_timing reports both.
+        
+        Any other change made while one is waiting (e.g. to the click
+        sounds) is made with it.
+        '''
+        if at_sample is None:
+            at_sample = self.timestamp_change_sample()
+        self.change_at_sample = at_sample
+        self.change_requested = True
+    
+    
+    def get_change_timing(self):
+        '''
+        Return the timing of the last tempo or beats per bar change made
+        while playing, or None if there has not been one, as a dict:
+            requested_sample    the sample the change was timestamped with
+            scheduled_onset     the first beat onset at or after it
+            actual_onset        the onset of the first beat at the new tempo
+                                (or beats per bar)
+            delay_samples       actual_onset - scheduled_onset (0 when the
+                                change is made exactly when scheduled)
+            delay_ms            the same, in milliseconds
+            tempo, beats_per_bar and num_changes
+        Sample positions count from start(). Safe to call from the GUI
+        thread while playing.
+        '''
+        return self.change_timing.snapshot(self.fs)
     
     
     def create_beat_click_index_array(self):
@@ -176,18 +542,158 @@ class Metronome():
         return np.concatenate(([2], [1 for i in range(self.beats_per_bar - 1)])).astype(int)
     
     
-    def update_beat_sample_dict(self, new_click_indices):
+    @forward_to_worker
+    def update_beat_sample_dict(self, new_click_indices, click_set=None):
         '''
         Create a dictionary containing click sample audio data (zeros, lo, hi).
         This allows us to obtain the correct samples for the sound which
-        should be played at each beat in a bar.
+        should be played at each beat in a bar. new_click_indices has the
+        click index of each beat. It can have more than beats_per_bar (the
+        GUI passes one for every beat it can show): those beyond the bar
+        are not played, but are kept for when beats are added to the bar.
+        
+        click_set, if given, replaces the click sounds with a custom set:
+        a list whose entry i is the sound for click index i, e.g.
+        [None, "wood_lo", {"frequency": 2000, "noise": 0.3}]. Sounds can be
+        the click samples, synthesized presets or parameters, or arrays
+        (see click_bank.load_click_set). Synthesized clicks are made here,
+        in the calling thread, and cached, so the audio thread only ever
+        sees the finished bar cache, and using the same set again later
+        costs next to nothing.
         '''
+        # A copy, as the caller may change its array later
+        new_click_indices = np.array(new_click_indices)
+        if len(new_click_indices) < self.beats_per_bar:
+            raise Exception(f"A click index is needed for each of the {self.beats_per_bar} beats in the bar.")
+        click_sounds = self.click_sounds if click_set is None else load_click_set(click_set, self.fs)
+        if np.max(new_click_indices) >= len(click_sounds):
+            raise Exception(f"Click indices must be less than {len(click_sounds)}, the number of click sounds.")
+        if click_set is not None:
+            self.click_sounds = click_sounds
+            self.click_set = click_set
         # Update the beat_click_indices attribute 
         self.beat_click_indices = new_click_indices
         # Get a list that contains the click sound we want to use for every beat
-        samples = [self.click_sounds[idx] for idx in self.beat_click_indices]
+        samples = [self.click_sounds[idx] for idx in self.beat_click_indices[:self.beats_per_bar]]
         # Create a dictionary whose keys are the beat numbers
         self.beat_sample_dict = {i+1: samples[i] for i in range(self.beats_per_bar)}
+        
+        # In worker mode the worker process renders the bar caches it plays,
+        # and this process renders one when playing stops
+        if self.worker is not None and self.running:
+            return
+        
+        # Re-render the bar cache for the new beat pattern. If a tempo change
+        # is still waiting to be applied, render at the new tempo.
+        if self.tempo_change_pending:
+            self.next_bar_cache = self.render_bar_cache(tempo=self.new_tempo)
+        else:
+            self.next_bar_cache = self.render_bar_cache()
+        
+        # Nothing is being played, so the new cache can be used straight away
+        if not self.running:
+            self.apply_bar_cache(self.next_bar_cache)
+    
+    
+    @forward_to_worker
+    def set_beat_pattern(self, beat_pattern):
+        '''
+        Play subdivisions or polyrhythms on top of the beat clicks: a
+        BeatPattern, or a list of PatternLayers to make one from (see
+        beat_pattern.py). Pass None to play just the beat clicks again.
+        
+        Like a change to the beat clicks, this can be done while playing,
+        and the new pattern starts at the next beat.
+        '''
+        if beat_pattern is not None and not isinstance(beat_pattern, BeatPattern):
+            beat_pattern = BeatPattern(beat_pattern)
+        self.beat_pattern = beat_pattern
+        # Re-render the bar cache, which holds the compiled pattern
+        self.update_beat_sample_dict(self.beat_click_indices)
+    
+    
+    def render_bar_cache(self, tempo=None):
+        '''
+        Render one bar of audio for the given tempo (default self.tempo) and
+        the current beat_click_indices.
+        
+        Row i of the cache holds the audio for beat i+1: the click sound for
+        that beat, followed by silence. Each row is one sample longer than
+        the integer interval, so that a beat lengthened by one sample of
+        the scheduler can still be sliced straight out of the cache.
+        
+        If a tempo map is in use (and no other tempo is given), the rows are
+        long enough for a beat at the slowest tempo in the map, and clicks
+        are cut to fit a beat at the fastest tempo.
+        
+        The beat pattern, if there is one, is compiled for the same bar.
+        
+        Returns a tuple of (cache, tempo step, compiled pattern, click
+        indices, beats per bar) so that the audio thread knows which tempo,
+        click sounds and bar length the cache was rendered for, and swaps in
+        the matching pattern with it. The tempo step (see
+        beat_scheduler.tempo_step) is the tempo and its exact samples per
+        beat, worked out here so the audio thread only has to use them.
+        '''
+        if tempo is None and self.tempo_map is not None:
+            row_length = int(self.fs * 60.0 / self.tempo_map.min_tempo()) + 1
+            click_length = int(self.fs * 60.0 / self.tempo_map.max_tempo()) + 1
+            tempo = self.tempo
+        else:
+            if tempo is None:
+                tempo = self.tempo
+            row_length = click_length = int(self.fs * 60.0 / tempo) + 1
+        
+        bar_click_indices = self.beat_click_indices[:self.beats_per_bar]
+        cache = np.zeros((self.beats_per_bar, row_length), dtype=self.dtype)
+        for row, click_idx in zip(cache, bar_click_indices):
+            click = self.click_sounds[click_idx][:click_length]
+            row[:len(click)] = click
+        
+        return (cache, tempo_step(self.fs, tempo), self.compile_beat_pattern(),
+                np.array(bar_click_indices), self.beats_per_bar)
+    
+    
+    def compile_beat_pattern(self):
+        '''
+        Compile self.beat_pattern for the current beats per bar and click
+        sounds, or return None if there is no pattern.
+        '''
+        if self.beat_pattern is None:
+            return None
+        return self.beat_pattern.compile(self.beats_per_bar, self.click_sounds,
+                                         self.max_pattern_click_length, dtype=self.dtype)
+    
+    
+    def apply_bar_cache(self, cache_state):
+        '''
+        Start using a bar cache produced by render_bar_cache. While playing,
+        this is only ever called from get_next_audio_block at a beat boundary,
+        so a click is never cut off part way through.
+        '''
+        self.active_bar_cache = cache_state
+        (self.bar_cache, step, self.compiled_pattern, self.bar_click_indices,
+         self.playing_beats_per_bar) = cache_state
+        
+        if step[0] != self.tempo:
+            self.new_tempo = step[0]
+            self.update_values_for_new_tempo(step)
+            if self.running:
+                self.stats.record_tempo_change(perf_counter() - self.tempo_change_requested_at)
+        self.tempo_change_pending = False
+        
+        # The first beat of a timestamped change starts at the scheduler's
+        # next onset. It should have started at the first beat at or after
+        # the timestamp, which may already have been generated.
+        if self.change_requested and self.running:
+            actual_onset = self.scheduler.next_onset
+            scheduled_onset = self.beat_log.first_onset_at_or_after(self.change_at_sample)
+            if scheduled_onset is None:
+                scheduled_onset = actual_onset
+            self.change_timing.record(self.change_at_sample, scheduled_onset, actual_onset,
+                                      self.tempo, self.playing_beats_per_bar)
+        self.change_requested = False
+        self.change_at_sample = 0
     
     
     def start(self):
@@ -195,58 +701,171 @@ class Metronome():
         if self.running:
             return
         else:
-            #print(f"Queue is empty?: {self.q.empty()}")
-            # TODO - pre-fill the queue with some audio blocks
             try:
-                # New - fill the queue with BUFFERSIZE blocks before playing
-                self.pre_fill_queue()
-                self.stream.start()
+                # Open the output stream the first time we play
+                if self.stream is None:
+                    self.stream = self.create_stream()
+                elif not self.stream.active:
+                    # The stream may have finished by itself last time, at
+                    # the end of play_for_num_bars or the trainer, or after
+                    # an underflow. It has to be stopped before it can be
+                    # started again (stopping a stopped stream does nothing).
+                    self.stream.stop()
+                # Set again by stream_finished when this stream finishes
+                self.event.clear()
+                self.prepare_to_play()
+                # Fill the ring buffer with audio blocks before playing
+                self.stats.reset()
+                if self.low_latency:
+                    self.buffer_depth = self.min_buffer_depth
+                    self.healthy_callbacks = 0
+                if self.worker is not None:
+                    # The worker process fills the ring buffer instead
+                    self.ring.target_depth = self.buffer_depth
+                    self.worker.start_generating(self.buffer_depth - 1, bars_to_play=self.bars_to_play_at_tempo)
+                else:
+                    self.pre_fill_queue()
+                # Running before the stream starts, in case it finishes
+                # straight away and stream_finished is called
                 self.running = True
+                self.stream.start()
             except:
+                self.running = False
                 print("Error starting stream")
             
             
+    def prepare_to_play(self):
+        '''
+        Get ready to generate audio from the first beat, for start() or
+        generate_blocks().
+        '''
+        # The beat log is kept after stopping, for exporting, until now
+        self.beat_log.reset()
+        # Count the tempo map's bars with the current beats per bar
+        self.end_sample = None
+        if self.tempo_map is not None:
+            self.scheduler = self.tempo_map.scheduler(self.fs, self.beats_per_bar)
+            if self.trainer_enabled:
+                self.trainer_schedule = self.compile_trainer_schedule()
+                self.trainer_index = 0
+                self.end_sample = int(self.trainer_schedule["start_sample"][-1])
+        self.playing_tempo = self.scheduler.tempo
+        self.bars_finished = False
+    
+    
     def stop(self):
         if not self.running:
             return
         else:
             #print("Stopping...")
             self.running = False
-            self.stream.abort()     # ends the stream quicker than stream.stop()
-            self.stream.stop()      # sets the stream's active attribute to False (abort does not do this)
-            self.current_beat = 0
-            self.beats_at_tempo = 0
-            self.bars_to_play_at_tempo = None
-            self.total_samples_delivered = 0
-            self.num_samples_until_next_click = 0
-            # Delete the queue and make a new one to clear out the contents
-            del self.q
-            self.q = queue.Queue(self.BUFFERSIZE)
-       
-            
-    def compute_drift_error_per_block(self):
+            # generate_blocks finishes at its next block, and goes back to
+            # the start itself
+            if self.generating:
+                return
+            # The stream may not have been opened if blocks were generated
+            # without start() (e.g. by benchmark_metronome.py)
+            if self.stream is not None:
+                self.stream.abort()     # ends the stream quicker than stream.stop()
+                self.stream.stop()      # sets the stream's active attribute to False (abort does not do this)
+            self.reset_position()
+    
+    
+    def close(self):
         '''
-        For the current tempo, calculate the drift error that occurs for every
-        audio block of size self.BLOCKSIZE that is passed to the output stream.
-        
-        The drift error per sample is first calculated, then multiplied by
-        self.BLOCKSIZE to get the total drift error for the whole audio block.
+        Stop playing, close the output stream and the capture sink, and in
+        worker mode shut down the worker process and free the shared memory.
+        The Metronome cannot be used after this.
         '''
-        
-        samples_per_beat, decimal_component = divmod(self.fs * 60.0 / self.tempo, 1)
-        error_per_sample = decimal_component / samples_per_beat
-        return self.BLOCKSIZE * error_per_sample
+        self.stop()
+        if self.stream is not None:
+            self.stream.close()
+        # Make sure any audio being captured to a file is finalised
+        self.capture.close()
+        if self.worker is not None:
+            self.worker.close()
+            self.worker = None
+            self.ring.close(unlink=True)
+            self.beat_log.close(unlink=True)
     
-        
-    def update_values_for_new_tempo(self):
+    
+    def stream_finished(self):
+        '''
+        Called by the output stream when it finishes. If it finished by
+        itself, at the end of play_for_num_bars or the speed trainer, go back
+        to the start, as stop() would. The stream has already stopped
+        playing, and is stopped properly by the next start().
+        '''
+        if self.running:
+            self.running = False
+            self.reset_position()
+        self.event.set()
+    
+    
+    def reset_position(self):
+        '''
+        Go back to the first beat, ready to play from the start again. Only
+        call this when the stream is not playing.
+        '''
+        self.current_beat = 0
+        self.beats_at_tempo = 0
+        self.bars_to_play_at_tempo = None
+        self.total_samples_delivered = 0
+        self.samples_generated = 0
+        self.samples_output = 0
+        self.num_samples_until_next_click = 0
+        self.scheduler.reset()
+        self.bar_number = -1
+        # The worker process goes back to the start too
+        if self.worker is not None:
+            self.worker.stop_generating()
+        # Use any pending tempo or beat pattern change from the start. In
+        # worker mode, changes made while playing were only made by the
+        # worker, so render the cache for them now.
+        if self.worker is not None:
+            self.next_bar_cache = self.render_bar_cache()
+        self.apply_bar_cache(self.next_bar_cache)
+        # Play any gap clicks from their first bar again
+        if self.gap_clicks is not None:
+            self.gap_clicks.reset()
+        self.active_gap_clicks = None
+        self.beat_silenced = False
+        # Forget any pattern clicks still to be played
+        self.pattern_mix[:] = 0
+        self.pattern_mix_length = 0
+        self.pattern_onsets = self.no_pattern_onsets
+        self.pattern_cursor = 0
+        # Clear out the ring buffer. The stream has been stopped, so
+        # nothing else is reading from or writing to it.
+        self.ring.reset()
+       
+            
+    def update_values_for_new_tempo(self, step=None):
         '''
         Call this whenever the tempo is changed. A number of tempo-specific
-        values are recalculated, and tempo-specific counters are reset.
+        values are recalculated, and tempo-specific counters are reset. The
+        sample counters carry on, so there is no jump in phase.
+        
+        On the audio thread, step is the new tempo's tempo_step from the bar
+        cache, so that no Fraction arithmetic or new scheduler is needed
+        there. Otherwise it is worked out here.
         '''
         if self.new_tempo is not None:
             self.tempo = self.new_tempo
-        self.total_samples_delivered = 0
-        self.drift_error_per_block = self.compute_drift_error_per_block()
+            self.new_tempo = None
+        if step is None:
+            step = tempo_step(self.fs, self.tempo)
+        # The new tempo starts from the onset of the next beat
+        if self.tempo_map is not None:
+            # Changing the tempo by hand ends any tempo automation,
+            # including the speed trainer
+            self.tempo_map = None
+            if self.trainer_enabled:
+                self.trainer_enabled = False
+                self.end_sample = None
+            self.constant_scheduler.next_onset = self.scheduler.next_onset
+            self.scheduler = self.constant_scheduler
+        self.scheduler.use_tempo(step)
         self.beats_at_tempo = 0
         self.float_interval = self.fs * 60.0 / self.tempo
         self.interval = int(self.fs * 60.0 / self.tempo)
@@ -254,183 +873,387 @@ class Metronome():
     
     def callback(self, outdata, frames, time, status):
         '''
-        This is called repeatedly by the sounddevice OutputStream.
+        This is called repeatedly by the output stream (a sounddevice
+        OutputStream, or one of the headless streams in audio_backends.py).
         See sounddevice docs for specifics.
         
-        Blocks of audio are generated and passed to the queue, to later be
-        removed from the queue as required by the OutputStream. The same data
-        that is sent to the queue is also appended to self.full_output in order
-        to allow analysis of the output.
+        Blocks of audio are generated straight into the ring buffer, to later
+        be read from the ring buffer as required by the OutputStream. The same
+        data that is written to the ring buffer is also passed to self.capture
+        in order to allow analysis of the output.
+        
+        The execution time, deadline headroom and ring buffer fill level of
+        every callback are recorded in self.stats.
+        
+        Blocks are generated until the ring buffer holds buffer_depth blocks.
+        In worker mode they are generated by the worker process instead, and
+        the callback only copies a block out of the ring.
+        Usually that is one block per callback (in low-latency worker mode
+        the worker generates two when the buffer has just grown, and none
+        when it has just shrunk).
+        
+        When play_for_num_bars or the speed trainer has generated its final
+        block, no more blocks are generated, but the blocks already in the
+        ring buffer are still played. Once the block holding end_sample has
+        been output, the stream is stopped with CallbackStop, so the output
+        ends exactly at end_sample.
         
         '''
-
-        next_audio_block, beat = self.get_next_audio_block()
-        # If the next_audio_block array contains all -1 values, we don't want
-        # to actually output this one. So don't add it to the queue, and abort the callback
-        # to avoid queue.Empty
-        if np.all(next_audio_block==-1):
-            raise sd.CallbackAbort()
+        callback_start = perf_counter()
+        
+        if self.worker is None:
+            while len(self.ring) < self.buffer_depth and not self.bars_finished:
+                write_block = self.ring.get_write_block()
+                if write_block is None:
+                    break
+                next_audio_block, beat = self.get_next_audio_block(write_block)
+                self.ring.commit_write(beat)
+                # Pass the new audio block to the capture sink for later examination
+                self.capture.write(next_audio_block)
         else:
-            self.q.put_nowait([next_audio_block, beat])
-            # Append the new audio block to full_output for later examination
-            self.full_output.append(next_audio_block)
+            # The worker process generates the blocks. Tell it how far ahead
+            # to keep the ring filled, and find out where the output ends
+            # once it knows.
+            self.ring.target_depth = self.buffer_depth
+            self.end_sample = self.ring.end_sample
         
         assert frames == self.BLOCKSIZE
-        if status.output_underflow:
+        if status:
+            self.stats.record_status(status)
+        # In low-latency mode an underflow is counted and playing carries on.
+        # In worker mode adapt_buffer_depth makes the buffer deeper.
+        if status.output_underflow and not self.low_latency:
             print('Output underflow: increase blocksize?', file=sys.stderr)
-            raise sd.CallbackAbort
-        assert not status
-        try:
-            # Set the beat_to_show attribute here so UI matches audio output
-            data, self.beat_to_show = self.q.get_nowait()
-        except queue.Empty:
+            raise CallbackAbort
+        assert self.low_latency or not status
+        
+        # Set the beat_to_show attribute here so UI matches audio output
+        beat = self.ring.read_into(outdata[:, 0])
+        if beat is None:
+            self.stats.record_ring_empty()
             print('Buffer is empty: increase buffersize?', file=sys.stderr)
-            raise sd.CallbackAbort
-        if len(data) < len(outdata):
-            outdata[:len(data)] = data.reshape((-1, 1))
-            outdata[len(data):].fill(0)
-            raise sd.CallbackStop
+            raise CallbackAbort
+        self.beat_to_show = beat
+        # Work out when each beat generated since the last callback will be
+        # heard, now that the DAC time of this block is known
+        self.beat_log.stamp(time.outputBufferDacTime, self.samples_output, self.fs)
+        
+        # Follow the speed trainer's practice schedule to the tempo being
+        # played at the start of this block
+        if self.trainer_enabled:
+            # The final entry only marks the end, so never move on to it
+            while (self.trainer_index + 2 < len(self.trainer_schedule)
+                   and self.samples_output >= self.trainer_schedule["start_sample"][self.trainer_index + 1]):
+                self.trainer_index += 1
+                self.playing_tempo = self.trainer_schedule["tempo"][self.trainer_index]
+        self.samples_output += self.BLOCKSIZE
+        
+        callback_time = perf_counter() - callback_start
+        headroom = time.outputBufferDacTime - time.currentTime - callback_time
+        self.stats.record_callback(callback_time, headroom, len(self.ring))
+        if self.low_latency and self.worker is not None:
+            self.adapt_buffer_depth(status, headroom)
+        
+        # This block holds the final sample. Stop once it has been played.
+        if self.end_sample is not None and self.samples_output >= self.end_sample:
+            raise CallbackStop
+    
+    
+    def adapt_buffer_depth(self, status, headroom):
+        '''
+        Low-latency worker mode only. Called by the audio thread at the end
+        of each callback to grow or shrink the buffer depth.
+        
+        A deeper buffer only helps when the blocks are generated somewhere
+        other than the callback. Without a worker, the callback is both
+        producer and consumer: growing the buffer would make the late
+        callback generate an extra block, adding work and latency without
+        preventing any underflows, so the depth is left alone.
+        
+        The depth goes up by one block straight away after an underflow, or
+        when the callback came within min_headroom of its deadline. It comes
+        down by one block after shrink_after_callbacks clean callbacks in a
+        row. The new depth takes effect in the next callback.
+        '''
+        if status.output_underflow or headroom < self.min_headroom:
+            self.healthy_callbacks = 0
+            if self.buffer_depth < self.max_buffer_depth:
+                self.buffer_depth += 1
         else:
-            outdata[:] = data.reshape((-1, 1))
+            self.healthy_callbacks += 1
+            if self.healthy_callbacks >= self.shrink_after_callbacks:
+                self.healthy_callbacks = 0
+                if self.buffer_depth > self.min_buffer_depth:
+                    self.buffer_depth -= 1
+    
+    
+    def get_latency(self):
+        '''
+        Return the current buffer depth (in blocks) and the resulting
+        latencies, in seconds, as a dict. The end-to-end latency is the time
+        from a block being generated to it being heard: the blocks queued
+        ahead of it in the ring buffer, plus the output stream's own latency.
+        '''
+        buffer_latency = (self.buffer_depth - 1) * self.BLOCKSIZE / self.fs
+        # The stream's latency is not known until it has been opened
+        stream_latency = self.stream.latency if self.stream is not None else 0.0
+        return {"buffer_depth": self.buffer_depth,
+                "buffer_latency": buffer_latency,
+                "stream_latency": stream_latency,
+                "total_latency": buffer_latency + stream_latency}
+    
+    
+    def get_beat_event(self, index):
+        '''
+        Return (index, beat, dac_time) for beat event number index since the
+        metronome was started, or None if that beat has not been generated
+        yet. dac_time is when the beat will be heard, on the same clock as
+        get_stream_time(). If the GUI has fallen far behind, the oldest event
+        still held is returned instead, so always carry on from the index
+        that is returned. Safe to call from the GUI thread while playing.
+        '''
+        return self.beat_log.read(index)
+    
+    
+    def get_beat_log(self):
+        '''
+        Return the beat log (see event_log.py): one record per beat played
+        since start(), with its sample position, DAC time, bar, beat, click
+        sound and tempo. Use its to_numpy(), views() or tofile() to get at
+        the records, e.g. metro.get_beat_log().tofile("beats.npy"). The log
+        is kept after stopping (or after generate_blocks has finished), so
+        it can be exported then, and is cleared by the next start.
+        '''
+        return self.beat_log
+    
+    
+    def get_stream_time(self):
+        '''
+        The output stream's clock, in seconds (see get_beat_event). This is
+        0 until the stream has been opened by start().
+        '''
+        if self.stream is None:
+            return 0.0
+        return self.stream.time
+    
+    
+    def get_stats(self):
+        '''
+        Return a snapshot of the callback statistics (see instrumentation.py).
+        Safe to call from the GUI or any other thread while playing.
+        '''
+        return self.stats.snapshot()
         
     
     def get_current_beat(self):
         return self.current_beat
 
 
-    def create_click_data_arrays(self, click_data):
+    def start_next_beat(self):
+        '''
+        Move on to the next beat. Any new bar cache is swapped in here, once
+        the beat's onset has reached the sample a change was timestamped
+        with, and the exact length of the new beat is obtained from the
+        scheduler.
         '''
-        It is quite likely that the samples of a click sound (length 400 samples)
-        will span more than one audio block of size 512 (self.BLOCKSIZE),
-        depending on which index within a block of 512 the click sound begins.
+        if (self.next_bar_cache is not self.active_bar_cache
+                and self.scheduler.next_onset >= self.change_at_sample):
+            self.apply_bar_cache(self.next_bar_cache)
         
-        For this reason, we create a "big_arr" array of zeros and place the
-        click samples at the correct indices, then chop big_arr in two so we
-        can first deliver the start of the click sound, and then the "tail"
-        of the click sound, in consecutive audio blocks sent to the stream.
+        # We can start current_beat at zero and increment at exactly 
+        # the same time as the new click data is delivered.
+        # Also means the beat number matches what we hear. If the bar has
+        # just been shortened to the current beat or less, a new bar starts.
+        if self.current_beat < self.playing_beats_per_bar:
+            self.current_beat += 1
+        else:
+            self.current_beat = 1
+        self.beats_at_tempo += 1
         
-        '''
-        # Build the array of zeros spanning two BLOCKSIZE windows
-        big_arr = np.zeros(2 * self.BLOCKSIZE)
-        # Place the click data at the correct place in the big array
-        big_arr[self.num_samples_until_next_click : self.num_samples_until_next_click + len(click_data)] = click_data
-        # Chop big_arr in half to obtain data and tail_array
-        data = big_arr[:self.BLOCKSIZE]
-        tail_array = big_arr[self.BLOCKSIZE:]
+        # Gap clicks only start, stop or move on at the start of a bar
+        if self.current_beat == 1:
+            self.bar_number += 1
+            self.active_gap_clicks = self.gap_clicks
+            if self.active_gap_clicks is not None:
+                self.active_gap_clicks.next_bar()
+        if self.active_gap_clicks is not None:
+            self.beat_silenced = self.active_gap_clicks.is_silent(self.playing_beats_per_bar, self.current_beat)
+        else:
+            self.beat_silenced = False
+        
+        # Either self.interval or self.interval + 1 samples, so that the
+        # clicks never drift away from their exact positions
+        self.beat_length = self.scheduler.next_beat_length()
+        self.num_samples_until_next_click = self.beat_length
         
-        return data, tail_array
+        # The pattern clicks in this beat, now that its length is known
+        if self.compiled_pattern is not None and not self.beat_silenced:
+            self.pattern_onsets, self.pattern_sound_ids = self.compiled_pattern.beat_onsets(self.current_beat - 1, self.beat_length)
+        else:
+            self.pattern_onsets = self.no_pattern_onsets
+        self.pattern_cursor = 0
     
     
-    def get_num_samples_until_next_click(self):
+    def mix_pattern_onsets(self, block_pos, beat_pos, num_samples):
         '''
-        Determine how many samples there should be between "now" and the start
-        of the next click sound.
+        Add the pattern clicks that start in the next num_samples samples of
+        the current beat (from beat_pos) to pattern_mix, where the block
+        being generated is at block_pos. Each click is a single vectorised
+        add of the whole sound, however many blocks it spans.
         '''
-        
-        # Find out how far through an interval we are
-        # (how far through the space between the start of clicks)
-        self.interval_samples_elapsed = self.total_samples_delivered % self.interval
-        num_samples_until_next_click = self.interval - self.interval_samples_elapsed
-        
-        # Compensate for drift error (shift future samples to the right)
-        num_samples_until_next_click += self.samples_to_shift
-        
-        # If this exceeds the interval size, we miss clicks. Compensate.
-        if num_samples_until_next_click > self.interval:
-            num_samples_until_next_click -= self.interval
-        
-        return int(num_samples_until_next_click)
+        beat_end = beat_pos + num_samples
+        sounds = self.compiled_pattern.sounds
+        while self.pattern_cursor < len(self.pattern_onsets):
+            offset = self.pattern_onsets[self.pattern_cursor]
+            if offset >= beat_end:
+                break
+            sound = sounds[self.pattern_sound_ids[self.pattern_cursor]]
+            mix_pos = block_pos + offset - beat_pos
+            self.pattern_mix[mix_pos:mix_pos + len(sound)] += sound
+            self.pattern_mix_length = max(self.pattern_mix_length, mix_pos + len(sound))
+            self.pattern_cursor += 1
     
     
-    # New version created on 28th June
-    def get_next_audio_block(self):
+    def add_pattern_mix(self, data):
+        '''
+        Add the first block of pattern_mix to data, and move the rest of it
+        (the clicks that carry on into the next blocks) to the front.
+        '''
+        data += self.pattern_mix[:self.BLOCKSIZE]
+        overhang = max(0, self.pattern_mix_length - self.BLOCKSIZE)
+        self.pattern_mix[:overhang] = self.pattern_mix[self.BLOCKSIZE:self.BLOCKSIZE + overhang]
+        self.pattern_mix[overhang:self.pattern_mix_length] = 0
+        self.pattern_mix_length = overhang
+    
+    
+    def get_next_audio_block(self, data=None):
         '''
         This is where most of the heavy lifting is done. 
         
+        The audio for each beat has already been rendered into self.bar_cache,
+        so building a block is just a matter of copying slices of the current
+        beat's row (and the start of the next beat's row, if the next click
+        begins within this block) into data. This is normally a block in the
+        ring buffer. If data is None, self.scratch_block is filled instead,
+        and will be overwritten by the next call.
+        
+        Clicks of the beat pattern, if there is one, are then mixed in on
+        top (see mix_pattern_onsets).
         '''
-        # If we do not have a tail array to deliver
-        # (true at first call and whenever we deliver zeros)
-        if self.tail_array is None:           
-            
-            # Make sure we deliver a click when we first start
-            if self.total_samples_delivered == 0:
-                self.click_is_due_in_this_block = True
-            
-            # Find out how long until the next click
-            if self.total_samples_delivered > 0:
-                
-                # Get num samples until next click scheduled to start
-                self.num_samples_until_next_click = self.get_num_samples_until_next_click()
-                
-                # Determine if a click is needed in the audio block being constructed
-                if self.num_samples_until_next_click <= self.BLOCKSIZE:
-                    self.click_is_due_in_this_block = True
-                else:
-                    self.click_is_due_in_this_block = False
-            
-            
-            if self.click_is_due_in_this_block:
-                # If we have asked for a specific number of bars, stop when finished
-                if self.bars_to_play_at_tempo is not None:                
+        if data is None:
+            data = self.scratch_block
+        
+        block_pos = 0
+        while block_pos < self.BLOCKSIZE:
+            # The previous beat has been delivered in full (true at first call)
+            if self.num_samples_until_next_click == 0:
+                # If we have asked for a specific number of bars, end the
+                # output exactly here when they have all been played
+                if self.bars_to_play_at_tempo is not None:
                     if self.beats_at_tempo == self.beats_to_play_at_tempo:
-                        self.stop()
-                        # Once we have reached the end of our desired number of bars,
-                        # return an array of all -1 values so our callback knows to abort
-                        return [np.array([-1] * self.BLOCKSIZE), self.current_beat]
-
-                
-                # We can start current_beat at zero and increment at exactly 
-                # the same time as the new click data being created.
-                # Also means the beat number matches what we hear.
-                self.current_beat = (self.current_beat % self.beats_per_bar) + 1
-                self.beats_at_tempo += 1
-
-                # Determine which sample (hi, lo, or zeros) we should hear for this beat    
-                click = self.beat_sample_dict[self.current_beat]
+                        self.end_sample = self.samples_generated + block_pos
+                # play_for_num_bars and the trainer always end on a beat boundary
+                if self.end_sample is not None and self.samples_generated + block_pos >= self.end_sample:
+                    break
                 
-                # Create the arrays containing click samples
-                data, self.tail_array = self.create_click_data_arrays(click_data=click)
-
-            else:
-                # Click doesn't start in next block, so deliver a block of zeros instead
-                data = self.zero_array
-
-        
-        # This means tail array is not None. Deliver the tail of the click samples
-        else:
-            # Assign the tail_array to the data to be returned 
-            data = self.tail_array
-            # Reset the attribute for the next call
-            self.tail_array = None
+                self.start_next_beat()
+                sound = 0 if self.beat_silenced else self.bar_click_indices[self.current_beat - 1]
+                self.beat_log.record(self.samples_generated + block_pos, self.bar_number, self.current_beat,
+                                     sound, self.scheduler.tempo)
             
-            # Set and reset some things if a new tempo has been instructed
-            # so we can start the new tempo immediately after this beat is
-            # finished being delivered
-            if self.tempo_change_pending:
-                #print("Tempo change should happen now")
-                self.tempo_change_pending = False
-                self.update_values_for_new_tempo()
+            # Copy as much of the current beat as fits in this block
+            num_samples = min(self.BLOCKSIZE - block_pos, self.num_samples_until_next_click)
+            beat_pos = self.beat_length - self.num_samples_until_next_click
+            if self.beat_silenced:
+                row = self.silent_row
+            else:
+                row = self.bar_cache[self.current_beat - 1]
+            data[block_pos:block_pos + num_samples] = row[beat_pos:beat_pos + num_samples]
+            if self.pattern_cursor < len(self.pattern_onsets):
+                self.mix_pattern_onsets(block_pos, beat_pos, num_samples)
             
-        # Once we get here, we have decided what the "data" array should contain
-        # Update counters etc here before the next call
-        self.total_samples_delivered += self.BLOCKSIZE
-        self.accumulated_drift_error += self.drift_error_per_block
+            block_pos += num_samples
+            self.num_samples_until_next_click -= num_samples
+        
+        # The last of the bars may have finished exactly at the end of the block
+        if self.bars_to_play_at_tempo is not None and self.num_samples_until_next_click == 0:
+            if self.beats_at_tempo == self.beats_to_play_at_tempo:
+                self.end_sample = self.samples_generated + block_pos
         
-        # Compare the current accumulated drift error value to that from the previous
-        # call. If the integer part of the number has changed, increment self.samples_to_shift
-        prev_drift_int, _ = divmod(self.accumulated_drift_error-self.drift_error_per_block, 1)
-        current_drift_int, _ = divmod(self.accumulated_drift_error, 1)
+        if self.pattern_mix_length:
+            self.add_pattern_mix(data)
         
-        if current_drift_int > prev_drift_int:
-            self.samples_to_shift += 1
+        if self.end_sample is not None and self.samples_generated + block_pos >= self.end_sample:
+            # The end has been reached. Any rest of the block is silent, and
+            # no more blocks will be generated.
+            data[block_pos:] = 0
+            self.bars_finished = True
+        
+        self.total_samples_delivered += self.BLOCKSIZE
+        self.samples_generated += self.BLOCKSIZE
         
         # Add the current beat to the data array so we know which beat we
-        # are actually hearing when the data is taken from queue -> speakers
-        data = [data, self.current_beat]
-                
-        return data
+        # are actually hearing when the data is taken from ring -> speakers
+        return [data, self.current_beat]
         
     
+    def generate_blocks(self, num_bars=None, duration=None):
+        '''
+        Generate the click block by block, without the output stream, for
+        sending somewhere other than an audio device (a pipe, a socket, a
+        file...). This is a generator: each block is only generated when
+        the next one is asked for, so whatever is reading sets the pace.
+        
+        Playing starts from the first beat, as with start(), and lasts for
+        num_bars bars, duration seconds, until the speed trainer ends, or
+        until stop() is called or the generator is closed. The final block
+        is cut short at the exact end.
+        
+        Each block is a float32 array of BLOCKSIZE samples, which is reused
+        for the next block, so copy it to keep it. While generating, the
+        metronome counts as running: tempo, pattern and other changes are
+        made at the next beat, as they would be while playing.
+        '''
+        if self.running:
+            raise Exception("Stop the metronome before generating blocks from it.")
+        if num_bars is not None and duration is not None:
+            raise Exception("Specify at most one of num_bars or duration.")
+        
+        self.prepare_to_play()
+        if num_bars is not None:
+            self.bars_to_play_at_tempo = num_bars
+            self.beats_to_play_at_tempo = num_bars * self.beats_per_bar
+        elif duration is not None:
+            end_sample = int(round(duration * self.fs))
+            self.end_sample = end_sample if self.end_sample is None else min(self.end_sample, end_sample)
+        
+        self.running = True
+        self.generating = True
+        try:
+            while self.running and not self.bars_finished:
+                block_start = self.samples_generated
+                block, beat = self.get_next_audio_block(self.scratch_block)
+                self.beat_to_show = beat
+                if self.bars_finished:
+                    block = block[:self.end_sample - block_start]
+                yield block
+        finally:
+            self.running = False
+            self.generating = False
+            self.reset_position()
+    
+    
+    def generate_pcm(self, dtype="int16", num_bars=None, duration=None):
+        '''
+        Like generate_blocks, but yields each block as raw little-endian
+        PCM bytes of the given dtype: a float type (samples from -1 to 1) or
+        a signed integer type such as "int16" (scaled to its full range).
+        '''
+        dtype = pcm_dtype(dtype)
+        for block in self.generate_blocks(num_bars=num_bars, duration=duration):
+            yield pcm_bytes(block, dtype)
+    
+    
     def play_for_num_bars(self, num_bars):
         # Play the click for the specified number of bars
         print(f"Number of beats required for {num_bars} bar(s) is: {num_bars * self.beats_per_bar}")
@@ -439,6 +1262,163 @@ class Metronome():
         self.start()
             
         
+    @forward_to_worker
+    def set_tempo_map(self, tempo_map):
+        '''
+        Use tempo automation: a TempoMap, or a list of (bar, tempo, curve)
+        segments to make one from (see tempo_map.py). Pass None to go back
+        to the constant tempo self.tempo. Only call this while stopped; the
+        map plays from its start the next time the metronome is started.
+        
+        Bars are counted with the beats per bar at the time of starting.
+        Changing the tempo with set_new_tempo ends the tempo map.
+        '''
+        if self.running:
+            raise Exception("Stop the metronome before setting a tempo map.")
+        
+        if tempo_map is not None:
+            tempo_map = self.check_tempo_map(tempo_map)
+            self.scheduler = tempo_map.scheduler(self.fs, self.beats_per_bar)
+        else:
+            self.scheduler = self.constant_scheduler
+            self.scheduler.reset()
+            self.scheduler.set_tempo(self.tempo)
+        self.tempo_map = tempo_map
+        
+        # The rows of the bar cache must be long enough for the slowest beat
+        self.next_bar_cache = self.render_bar_cache()
+        self.apply_bar_cache(self.next_bar_cache)
+    
+    
+    def check_tempo_map(self, tempo_map):
+        '''
+        Make a TempoMap from tempo_map if it is not one already, and check
+        that all of its tempos are in range.
+        '''
+        if not isinstance(tempo_map, TempoMap):
+            tempo_map = TempoMap(tempo_map)
+        if tempo_map.min_tempo() < self.min_tempo or tempo_map.max_tempo() > self.max_tempo:
+            raise Exception(f"Tempo must be between {self.min_tempo} and {self.max_tempo}.")
+        return tempo_map
+    
+    
+    def render(self, num_bars=None, duration=None, tempo_map=None, path=None):
+        '''
+        Render the click offline, much faster than real time, without using
+        the output stream. Exactly one of num_bars or duration (in seconds)
+        must be given.
+        
+        tempo_map is an optional TempoMap, or list of (bar, tempo) or
+        (bar, tempo, curve) segments, where bar is the zero-based bar at
+        which the segment starts (see tempo_map.py). If it is not given, the
+        tempo map set with set_tempo_map is used, or if there isn't one, the
+        whole render uses self.tempo.
+        
+        Beats silenced by gap click mode (see enable_gap_clicks) are left
+        out, as they would be from the start of playing.
+        
+        Every click onset is computed up front, and all clicks of each sound
+        are placed with a single fancy-indexed NumPy operation. The same goes
+        for the clicks of the beat pattern, if there is one. The result
+        matches the output of get_next_audio_block sample for sample.
+        
+        Returns the rendered audio, and also writes it to a WAV file if a
+        path is given.
+        '''
+        if (num_bars is None) == (duration is None):
+            raise Exception("Specify exactly one of num_bars or duration.")
+        
+        if tempo_map is None:
+            tempo_map = self.tempo_map if self.tempo_map is not None else [(0, self.tempo)]
+        tempo_map = self.check_tempo_map(tempo_map)
+        
+        # Work out the onset and beat number of every click. The tempo map
+        # uses the same exact arithmetic as the scheduler in the live engine.
+        beats_per_bar = self.beats_per_bar
+        if num_bars is not None:
+            onsets, num_samples = tempo_map.onsets(self.fs, beats_per_bar, num_beats=num_bars * beats_per_bar)
+        else:
+            onsets, num_samples = tempo_map.onsets(self.fs, beats_per_bar, num_samples=int(round(duration * self.fs)))
+        beat_indices = np.arange(len(onsets)) % beats_per_bar
+        # Beats that are not silenced by gap clicks
+        if self.gap_clicks is not None:
+            num_bars_rendered = -(-len(onsets) // beats_per_bar)
+            played = ~self.gap_clicks.bar_masks(num_bars_rendered, beats_per_bar).ravel()[:len(onsets)]
+        else:
+            played = np.ones(len(onsets), dtype=bool)
+        
+        shortest_interval = int(self.fs * 60.0 / tempo_map.max_tempo())
+        # The length of every beat, including the last, so find the onset of
+        # the beat after it too
+        _, end = tempo_map.onsets(self.fs, beats_per_bar, num_beats=len(onsets))
+        beat_lengths = np.diff(np.append(onsets, end))
+        
+        # Leave room for clicks that run past the end, then trim them off
+        max_click_length = max(max(len(click) for click in self.click_sounds), self.max_pattern_click_length)
+        output = np.zeros(num_samples + max_click_length, dtype=self.dtype)
+        
+        for beat_index, click_idx in enumerate(self.beat_click_indices[:beats_per_bar]):
+            if click_idx == 0:
+                continue
+            this_beat = (beat_indices == beat_index) & played & (onsets < num_samples)
+            beat_onsets = onsets[this_beat]
+            # Like render_bar_cache, never let a click run into the next beat
+            click = self.click_sounds[click_idx][:shortest_interval + 1]
+            # Place every click for this beat at once
+            indices = beat_onsets[:, None] + np.arange(len(click))
+            if len(click) <= shortest_interval:
+                output[indices] += click
+            else:
+                # The click is longer than some of the beats, and is cut off
+                # where each of them ends, as the live engine plays each beat
+                # for just its own length
+                in_beat = np.arange(len(click)) < beat_lengths[this_beat][:, None]
+                output[indices[in_beat]] += np.broadcast_to(click, indices.shape)[in_beat]
+        
+        compiled_pattern = self.compile_beat_pattern()
+        if compiled_pattern is not None:
+            # Pattern clicks depend on the length of each beat
+            positions, sound_ids = compiled_pattern.onsets(onsets[played], beat_lengths[played], beat_indices[played])
+            # Like the live engine, add up the pattern clicks on their own
+            # first, then add them to the beat clicks
+            pattern_output = np.zeros_like(output)
+            for sound_id, sound in enumerate(compiled_pattern.sounds):
+                sound_onsets = np.sort(positions[(sound_ids == sound_id) & (positions < num_samples)])
+                indices = sound_onsets[:, None] + np.arange(len(sound))
+                if np.all(np.diff(sound_onsets) >= len(sound)):
+                    pattern_output[indices] += sound
+                else:
+                    # Clicks of this sound overlap, so every add must count
+                    np.add.at(pattern_output, indices, np.broadcast_to(sound, indices.shape))
+            output += pattern_output
+        
+        output = output[:num_samples]
+        
+        if path is not None:
+            # Only imported when needed, as it is slow to import
+            import audiofile
+            audiofile.write(path, output, self.fs)
+        
+        return output
+    
+    
+    def export_midi(self, path, num_bars, tempo_map=None):
+        '''
+        Write num_bars bars of the click to a Standard MIDI File, with the
+        same beats per bar, click sounds, beat pattern and gap clicks as
+        render(), and a tempo event for every tempo change (see
+        midi_export.py). tempo_map defaults as it does for render().
+        '''
+        if tempo_map is None:
+            tempo_map = self.tempo_map if self.tempo_map is not None else [(0, self.tempo)]
+        tempo_map = self.check_tempo_map(tempo_map)
+        beats_per_bar = self.beats_per_bar
+        gap_masks = self.gap_clicks.bar_masks(num_bars, beats_per_bar) if self.gap_clicks is not None else None
+        return write_click_track(path, num_bars, tempo_map=tempo_map, beats_per_bar=beats_per_bar,
+                                 click_indices=self.beat_click_indices[:beats_per_bar], beat_pattern=self.beat_pattern,
+                                 gap_masks=gap_masks)
+    
+    
     def print_info(self):        
         print(f"The click sound contains {self.num_samples_in_click} samples.")
         print(f"There are {self.num_samples_until_next_click} samples until the next click should start.")
@@ -1,8 +1,7 @@
 from metronome_master_GH import Metronome
 import tkinter as tk
 import numpy as np
-import glob
-from PIL import Image, ImageTk
+from build_image_atlas import find_images, scaled_image_path
 
 
 class BeatSoundLabel(tk.Label):
@@ -62,8 +61,22 @@ class App():
         self.labels = []
         self.label_width = 80
         self.label_height = 120
+        # The (beat state, click sound index) each label is currently drawn
+        # with, so that only labels that have changed are reconfigured. See
+        # render_beat_labels.
+        self.label_render_state = []
+        self.label_render_pending = False
+        self.active_label_idx = None
+        # Number of label config calls made, for benchmark_gui.py
+        self.label_config_calls = 0
         
         self.beat_currently_shown = 0
+        # Index of the next beat event to show (see schedule_next_beat), and
+        # the stream time at which the last beat was shown
+        self.next_beat_event = 0
+        self.last_beat_time = 0.0
+        # The tempo shown on the canvas, which follows the speed trainer
+        self.tempo_shown = self.metro.tempo
         self.make_widgets()
         
         self.create_label_image_dict()
@@ -93,47 +106,58 @@ class App():
     
     
     def define_image_filepaths(self):
+        # Paths are relative to the images directory (see build_image_atlas.py)
         # Paths with multiple files for use with glob
-        self.on_img_fpath = "./images/on/*.jpg"
-        self.off_img_fpath = "./images/off/*.jpg"
+        self.on_img_fpath = "on/*.jpg"
+        self.off_img_fpath = "off/*.jpg"
         # Paths to specific individual images
-        self.play_button_path = "./images/play_button.jpg"
-        self.stop_button_path = "./images/stop_button.jpg"
-        self.plus_button_path = "./images/plus_button.jpg"
-        self.minus_button_path = "./images/minus_button.jpg"
-        
-        self.minus_5_button_path = "./images/minus_5_button.jpg"
-        self.minus_10_button_path = "./images/minus_10_button.jpg"
-        self.plus_5_button_path = "./images/plus_5_button.jpg"
-        self.plus_10_button_path = "./images/plus_10_button.jpg"
+        self.play_button_path = "play_button.jpg"
+        self.stop_button_path = "stop_button.jpg"
+        self.plus_button_path = "plus_button.jpg"
+        self.minus_button_path = "minus_button.jpg"
+        
+        self.minus_5_button_path = "minus_5_button.jpg"
+        self.minus_10_button_path = "minus_10_button.jpg"
+        self.plus_5_button_path = "plus_5_button.jpg"
+        self.plus_10_button_path = "plus_10_button.jpg"
+    
+    
+    def load_image(self, path, size=None):
+        '''
+        Load an image at the given (width, height), or at its own size if
+        size is None. Images are read from the cache of pre-scaled PNGs made
+        by build_image_atlas.py, which tkinter can load without PIL and
+        without any resampling.
+        '''
+        return tk.PhotoImage(file=scaled_image_path(path, size))
     
     
     def load_images(self):
-        self.play_button_image = ImageTk.PhotoImage(Image.open(self.play_button_path))
-        self.stop_button_image = ImageTk.PhotoImage(Image.open(self.stop_button_path))
+        self.play_button_image = self.load_image(find_images(self.play_button_path)[0])
+        self.stop_button_image = self.load_image(find_images(self.stop_button_path)[0])
         
         # Values for resizing buttons
         new_width = 80
         new_height = int(0.676 * new_width)
-        self.plus_button_image = ImageTk.PhotoImage(Image.open(self.plus_button_path).resize((new_width, new_height), Image.ANTIALIAS))
-        self.minus_button_image = ImageTk.PhotoImage(Image.open(self.minus_button_path).resize((new_width, new_height), Image.ANTIALIAS))
-        self.minus_5_button_image = ImageTk.PhotoImage(Image.open(self.minus_5_button_path).resize((new_width, new_height), Image.ANTIALIAS))
-        self.minus_10_button_image = ImageTk.PhotoImage(Image.open(self.minus_10_button_path).resize((new_width, new_height), Image.ANTIALIAS))
-        self.plus_5_button_image = ImageTk.PhotoImage(Image.open(self.plus_5_button_path).resize((new_width, new_height), Image.ANTIALIAS))
-        self.plus_10_button_image = ImageTk.PhotoImage(Image.open(self.plus_10_button_path).resize((new_width, new_height), Image.ANTIALIAS))
+        button_size = (new_width, new_height)
+        self.plus_button_image = self.load_image(find_images(self.plus_button_path)[0], button_size)
+        self.minus_button_image = self.load_image(find_images(self.minus_button_path)[0], button_size)
+        self.minus_5_button_image = self.load_image(find_images(self.minus_5_button_path)[0], button_size)
+        self.minus_10_button_image = self.load_image(find_images(self.minus_10_button_path)[0], button_size)
+        self.plus_5_button_image = self.load_image(find_images(self.plus_5_button_path)[0], button_size)
+        self.plus_10_button_image = self.load_image(find_images(self.plus_10_button_path)[0], button_size)
     
     
     def create_label_image_dict(self):
-        # Obtain filenames for images showing all possible coloured label states
-        self.on_image_filenames = glob.glob(self.on_img_fpath)        
-        self.off_image_filenames = glob.glob(self.off_img_fpath)
+        # Obtain filenames for images showing all possible coloured label states.
+        # They are sorted, so that image i is for click sound index i.
+        self.on_image_filenames = find_images(self.on_img_fpath)
+        self.off_image_filenames = find_images(self.off_img_fpath)
 
         # Create lists of PhotoImage objects for use with BeatSoundLabel objects
-        self.on_images = [Image.open(path) for path in self.on_image_filenames]
-        self.on_photos = [ImageTk.PhotoImage(image.resize((self.label_width, self.label_height), Image.ANTIALIAS)) for image in self.on_images]
-
-        self.off_images = [Image.open(path) for path in self.off_image_filenames]
-        self.off_photos = [ImageTk.PhotoImage(image.resize((self.label_width, self.label_height), Image.ANTIALIAS)) for image in self.off_images]
+        label_size = (self.label_width, self.label_height)
+        self.on_photos = [self.load_image(path, label_size) for path in self.on_image_filenames]
+        self.off_photos = [self.load_image(path, label_size) for path in self.off_image_filenames]
 
         # Place these lists in a dict
         self.img_dict = {'on': self.on_photos,
@@ -240,6 +264,7 @@ class App():
                                 beat_state=self.beat_state_array[i])
             
             l.config(image=self.img_dict[self.beat_state_array[i]][self.index_array[i]], bg="#a8a8a8")
+            self.label_render_state.append((self.beat_state_array[i], self.index_array[i]))
             
             self.labels.append(l)
             l.pack(side='left', padx=0)
@@ -360,12 +385,11 @@ class App():
         '''
         # Cyclically increment the click_sound_index for the label
         event.widget.click_sound_index = (event.widget.click_sound_index + 1) % 3
-        # Use the new click_sound_index value to retrieve the new image to be shown
-        new_image = self.img_dict[self.beat_state_array[event.widget.label_list_index]][event.widget.click_sound_index]
-        event.widget.config(image=new_image)
         
-        # Update the index_array so we can instruct the metronome to play the correct sound
+        # Update the index_array so we can instruct the metronome to play the correct sound.
+        # The label is redrawn with the new image by render_beat_labels.
         self.index_array[event.widget.label_list_index] = event.widget.click_sound_index
+        self.request_label_render()
         
         # Update the metronome's dictionary that holds the samples to play on each beat
         self.metro.update_beat_sample_dict(self.index_array)
@@ -379,72 +403,133 @@ class App():
         If idx is None, all of the labels are set to the "off" state. This is
         useful for when the metronome is not running.
         
-        '''
+        Only the beat states of the previously and newly highlighted labels
+        change. The labels themselves are redrawn by render_beat_labels.
         
-        # Set all label beat states to "off"
-        self.beat_state_array = np.array(["off" for i in range(len(self.index_array))])
+        '''
+        if self.active_label_idx is not None:
+            self.beat_state_array[self.active_label_idx] = "off"
         # Set the beat state of label at idx to "on", if specified
         if idx is not None:
             self.beat_state_array[idx] = "on"
-            
-        # For each label, obtain the correct image from the dictionary so that 
-        # it is either highlighted or not, and it has the correct number of
-        # "levels" shown, corresponding to the click sound for that beat
-        for i in range(len(self.labels)):
-            self.labels[i].config(image=self.img_dict[self.beat_state_array[i]][self.index_array[i]], bg="#a8a8a8")
+        self.active_label_idx = idx
+        self.request_label_render()
     
     
-    def increment_active_beat_label(self):
-        # Update beat labels so the label for the current beat is highlighted
-        # First, set them all to be "off"
-        self.set_coloured_beat_labels(idx=None)
-        
-        # Get the index corresponding to the current beat (only syncs without pre-filling queue)
-        # if self.metro.get_current_beat() != 0:
-        #     label_idx = self.metro.get_current_beat() - 1
-        
-        # Use beat_to_show when pre-filling the queue with audio blocks
-        if self.metro.beat_to_show != 0:
-            label_idx = self.metro.beat_to_show - 1
-        else:
-            label_idx = 0
+    def request_label_render(self):
+        '''
+        Arrange for render_beat_labels to be called once Tk has finished
+        handling the current events. Any number of changes made before then
+        (e.g. a beat and a click on a label in the same frame) are drawn in a
+        single render.
+        '''
+        if not self.label_render_pending:
+            self.label_render_pending = True
+            self.root.after_idle(self.render_beat_labels)
+    
+    
+    def render_beat_labels(self):
+        '''
+        Bring the labels up to date with beat_state_array and index_array.
         
-        # Highlight the correct label
-        self.set_coloured_beat_labels(idx=label_idx)
+        For each label, the correct image from the dictionary is the one
+        that is either highlighted or not, and has the correct number of
+        "levels" shown, corresponding to the click sound for that beat. Only
+        labels whose image has changed since they were last drawn are
+        reconfigured, which is usually just the previous and new active beat.
+        '''
+        self.label_render_pending = False
+        for i, label in enumerate(self.labels):
+            state = (self.beat_state_array[i], self.index_array[i])
+            if self.label_render_state[i] != state:
+                label.config(image=self.img_dict[state[0]][state[1]])
+                self.label_render_state[i] = state
+                self.label_config_calls += 1
+    
+    
+    def increment_active_beat_label(self, beat):
+        # Update beat labels so the label for the current beat is highlighted.
+        # Beats are numbered from 1. Labels are numbered from 0.
+        self.set_coloured_beat_labels(idx=beat - 1)
     
 
-    def update_beat_number_from_metro(self):
+    def schedule_next_beat(self):
         '''
-        Use the current beat number from the Metronome object to update the
-        text label that shows the current beat in the GUI. tkinter's "after"
-        method is used here to check for an updated beat number every 10ms.
-        There's nothing special about this duration, it just seems to work nicely.
+        Arrange for the next beat to be shown at the moment it is heard.
+        
+        The metronome records the time each beat will leave the sound card
+        (see Metronome.get_beat_event), normally well before it is heard, so
+        a single tkinter "after" call per beat is enough. If the next beat
+        has not been generated yet, check again at about the time it should
+        have been.
         '''
+        if not self.metro.running:
+            # The metronome has stopped by itself, at the end of the speed trainer
+            self.show_stopped()
+            return
         
-        #beat_to_show = self.metro.get_current_beat()
-        # Use beat_to_show when pre-filling the queue with audio blocks
-        beat_to_show = self.metro.beat_to_show
+        event = self.metro.get_beat_event(self.next_beat_event)
+        if event is None:
+            self.after_loop = self.root.after(self.beat_event_retry_delay(), self.schedule_next_beat)
+            return
         
-        # This is a bit of a hack. Don't display beat 0 - change it to 1
-        if beat_to_show == 0:
-            beat_to_show = 1
-
-        if self.beat_currently_shown != beat_to_show:
-            self.increment_active_beat_label()
-            
-        self.beat_string_var.set(beat_to_show)
-        self.after_loop = self.root.after(10, self.update_beat_number_from_metro)
+        self.next_beat_event, beat, dac_time = event
+        delay = max(0, int(round((dac_time - self.metro.get_stream_time()) * 1000)))
+        self.after_loop = self.root.after(delay, self.show_beat, beat, dac_time)
+    
+    
+    def beat_event_retry_delay(self):
+        '''
+        Time in ms until the next beat event should be available. A beat is
+        generated about get_latency()["total_latency"] before it is heard, so
+        half way through that window it will certainly be there. Never wait
+        less than 10ms, so that we don't keep Tk busy.
+        '''
+        lookahead = self.metro.get_latency()["total_latency"]
+        next_beat_time = self.last_beat_time + 60.0 / self.metro.tempo
+        wait = next_beat_time - lookahead / 2 - self.metro.get_stream_time()
+        return max(10, int(wait * 1000))
+    
+    
+    def show_beat(self, beat, dac_time):
+        '''
+        Show a beat as it is heard, then schedule the next one.
+        '''
+        if self.beat_currently_shown != beat:
+            self.increment_active_beat_label(beat)
+        self.beat_string_var.set(beat)
+        if self.metro.trainer_enabled:
+            self.show_tempo(int(round(self.metro.playing_tempo)))
         
         # Set this for comparison in the next call to check if we increment blue label
-        self.beat_currently_shown = beat_to_show
+        self.beat_currently_shown = beat
+        self.last_beat_time = dac_time
+        self.next_beat_event += 1
+        self.schedule_next_beat()
         
     
+    def show_tempo(self, tempo):
+        # Only redraw the tempo when it changes
+        if tempo != self.tempo_shown:
+            self.update_tempo_canvas_text(tempo)
+            self.tempo_shown = tempo
+    
+    
+    def show_stopped(self):
+        # Blank out the displayed beat number and the coloured labels, and
+        # go back to showing the tempo set with the slider
+        self.beat_string_var.set("")
+        self.set_coloured_beat_labels(idx=None)
+        self.show_tempo(self.metro.tempo)
+        self.start_stop_button.config(image=self.play_button_image)
+    
+    
     def set_new_tempo(self, new_val):
         # TODO - decouple GUI from metronome
         if int(new_val) > self.metro.max_tempo or int(new_val) < self.metro.min_tempo:
             return
         self.metro.set_new_tempo(new_val)
-        self.update_tempo_canvas_text(new_val)
+        self.show_tempo(int(new_val))
         # Setting the tempo slider value in this way calls this method I think
         # Could use a tk.DoubleVar to prevent this?
         self.tempo_slider.set(new_val)
@@ -466,23 +551,24 @@ class App():
             self.metro.start()
             # Update the coloured labels to show the first beat blue
             self.set_coloured_beat_labels(idx=0)
-            self.update_beat_number_from_metro()
+            self.beat_currently_shown = 1
+            self.next_beat_event = 0
+            # The first beat is due straight away
+            self.last_beat_time = self.metro.get_stream_time() - 60.0 / self.metro.tempo
+            self.schedule_next_beat()
     
     
     def stop(self):
         if self.metro.running:
             self.metro.stop()
             self.root.after_cancel(self.after_loop)
-            # Blank out the displayed beat number and the coloured labels
-            self.beat_string_var.set("")
-            self.set_coloured_beat_labels(idx=None)
+            self.show_stopped()
     
     
     def ui_start_stop(self, event=None):
         if self.metro.running:
-            # Stop the metronome and update the button image
+            # Stop the metronome (this also updates the button image)
             self.stop()
-            self.start_stop_button.config(image=self.play_button_image)
         else:
             # Start the metronome and update the button image
             self.start()
@@ -492,4 +578,7 @@ class App():
     def on_window_closing(self):
         # Stop the metronome when the user closes the window
         self.stop()
+        # Close the stream and finalise any capture file. In worker mode this
+        # also shuts down the worker process and frees the shared memory.
+        self.metro.close()
         self.root.destroy()
\ No newline at end of file
@@ -0,0 +1,249 @@
+'''
+Standard MIDI File export of the click.
+
+The click track is worked out with the same timing as the audio engine: the
+tempo of every beat comes from the TempoMap (so constant, step and linear
+tempo changes all come out as they are played), the sound of each beat from
+the click indices (hi, lo or silent), and optionally the clicks of a
+BeatPattern and the beats silenced by GapClicks.
+
+In a MIDI file, the notes are placed in musical time (ticks, PPQ to a beat)
+and the tempo is given by tempo meta events, so every note lands exactly on
+its beat or subdivision. A tempo event is written whenever the tempo
+changes, i.e. every beat of a linear ramp. MIDI tempos are whole numbers of
+microseconds per beat, which is within a microsecond per beat of the exact
+tempo.
+
+All of the events of a file are built and encoded with NumPy arrays, so
+thousands of bars take milliseconds, and write_click_tracks writes any
+number of files in one call.
+
+Notes are on the General MIDI percussion channel: a hi wood block for hi
+clicks, a low wood block for lo clicks, and claves for pattern layers with
+their own sound.
+
+Example:
+    python midi_export.py click.mid --bars 16 --tempo 120
+    python midi_export.py ramp.mid --bars 32 --tempo-map 0:100:linear 16:160 --beats-per-bar 3
+    python midi_export.py --batch jobs.json
+where jobs.json is a list of objects with the same keys as the arguments of
+write_click_track, e.g. [{"path": "a.mid", "num_bars": 8, "tempo_map": [[0, 90]]}].
+'''
+import argparse
+import json
+import numpy as np
+
+from tempo_map import TempoMap
+from beat_pattern import BeatPattern
+
+
+PPQ = 960               # ticks per beat; divisible by 2, 3, 4, 5, 6, 8, 10, 12, 15, 16...
+DRUM_CHANNEL = 9        # channel 10, the General MIDI percussion channel
+NOTE_OFF = 0x80
+NOTE_ON = 0x90
+
+# General MIDI percussion notes for each click sound index (0: no sound,
+# 1: lo, 2: hi), and for pattern layers with a sound of their own
+CLICK_NOTES = np.array([0, 77, 76])     # -, low wood block, hi wood block
+PATTERN_NOTE = 75                       # claves
+VELOCITY = 100
+
+
+def click_track_events(tempo_map, beats_per_bar, num_bars, click_indices=None, beat_pattern=None,
+                       gap_masks=None, ppq=PPQ):
+    '''
+    Work out the events of a click track of num_bars bars. tempo_map is a
+    TempoMap (or list of segments), click_indices has the click sound index
+    of each beat of the bar (by default hi then lo, like the Metronome),
+    beat_pattern is an optional BeatPattern (or list of PatternLayers), and
+    gap_masks is an optional (num_bars, beats_per_bar) array of silenced
+    beats (see GapClicks.bar_masks).
+
+    Returns (notes, tempos): notes is an array of (tick, note, velocity)
+    rows, and tempos an array of (tick, microseconds per beat) rows, one
+    for every tempo change.
+    '''
+    if not isinstance(tempo_map, TempoMap):
+        tempo_map = TempoMap(tempo_map)
+    if click_indices is None:
+        click_indices = [2] + [1] * (beats_per_bar - 1)
+    click_indices = np.asarray(click_indices)
+    if len(click_indices) != beats_per_bar:
+        raise Exception("There must be one click index for every beat in the bar.")
+
+    num_beats = num_bars * beats_per_bar
+    beat_ticks = np.arange(num_beats, dtype=np.int64) * ppq
+    beat_indices = np.arange(num_beats) % beats_per_bar
+    if gap_masks is not None:
+        played = ~np.asarray(gap_masks, dtype=bool).reshape(-1)[:num_beats]
+    else:
+        played = np.ones(num_beats, dtype=bool)
+
+    # The beat clicks. Sounds of a custom click set beyond hi and lo (see
+    # click_bank.load_click_set) are played as the pattern note.
+    beat_sounds = click_indices[beat_indices]
+    keep = played & (beat_sounds != 0)
+    beat_sounds = beat_sounds[keep]
+    beat_notes = np.where(beat_sounds < len(CLICK_NOTES),
+                          CLICK_NOTES[np.minimum(beat_sounds, len(CLICK_NOTES) - 1)], PATTERN_NOTE)
+    notes = [np.stack((beat_ticks[keep], beat_notes, np.full(keep.sum(), VELOCITY)), axis=1)]
+
+    # The pattern clicks, at their exact positions within each bar. A
+    # click's tick is rounded down, like its sample offset.
+    if beat_pattern is not None:
+        if not isinstance(beat_pattern, BeatPattern):
+            beat_pattern = BeatPattern(beat_pattern)
+        bar_ticks = np.arange(num_bars, dtype=np.int64) * beats_per_bar * ppq
+        for layer in beat_pattern.layers:
+            if isinstance(layer.sound, (int, np.integer)) and 0 < layer.sound < len(CLICK_NOTES):
+                note = CLICK_NOTES[layer.sound]
+            else:
+                note = PATTERN_NOTE
+            velocity = int(np.clip(round(VELOCITY * layer.gain), 1, 127))
+            positions = layer.positions(beats_per_bar)
+            offsets = np.array([int(position * ppq) for position in positions], dtype=np.int64)
+            beats_of_clicks = np.array([int(position) for position in positions], dtype=np.int64)
+            ticks = (bar_ticks[:, None] + offsets[None, :]).ravel()
+            # A click is silenced along with the beat it falls in
+            layer_played = played.reshape(num_bars, beats_per_bar)[:, beats_of_clicks].ravel()
+            ticks = ticks[layer_played]
+            notes.append(np.stack((ticks, np.full(len(ticks), note), np.full(len(ticks), velocity)), axis=1))
+
+    notes = np.concatenate(notes)
+
+    # A tempo event at the start, and wherever the tempo changes
+    beat_tempos = tempo_map.beat_tempos(beats_per_bar, num_beats)
+    changes = np.flatnonzero(np.concatenate(([True], beat_tempos[1:] != beat_tempos[:-1])))
+    microseconds = np.round(60e6 / beat_tempos[changes]).astype(np.int64)
+    tempos = np.stack((beat_ticks[changes], microseconds), axis=1)
+    return notes, tempos
+
+
+def variable_length_quantities(values):
+    '''
+    Encode each value as a MIDI variable-length quantity. Returns a
+    (len(values), 4) array of bytes, left-aligned, and the number of bytes
+    used in each row.
+    '''
+    values = np.asarray(values, dtype=np.int64)
+    if np.any(values >= 1 << 28):
+        raise Exception("MIDI delta times must be less than 2**28 ticks.")
+    num_bytes = 1 + (values >= 1 << 7) + (values >= 1 << 14) + (values >= 1 << 21)
+    encoded = np.zeros((len(values), 4), dtype=np.uint8)
+    for byte in range(4):
+        shift = 7 * np.maximum(num_bytes - 1 - byte, 0)
+        # Every byte but the last has its top bit set
+        continuation = np.where(byte < num_bytes - 1, 0x80, 0)
+        encoded[:, byte] = ((values >> shift) & 0x7F) | continuation
+    return encoded, num_bytes
+
+
+def encode_track(notes, tempos, beats_per_bar, ppq=PPQ, note_ticks=None):
+    '''
+    Encode the events from click_track_events as the data of an MTrk chunk.
+    '''
+    if note_ticks is None:
+        note_ticks = max(1, ppq // 16)
+
+    # Every event is a delta time followed by up to 7 bytes. Events at the
+    # same tick go in order of kind: meta events, note offs, then note ons.
+    num_notes = len(notes)
+    num_tempos = len(tempos)
+    ticks = np.concatenate(([0], tempos[:, 0], notes[:, 0] + note_ticks, notes[:, 0]))
+    kinds = np.concatenate(([0], np.zeros(num_tempos), np.ones(num_notes), np.full(num_notes, 2)))
+    bodies = np.zeros((len(ticks), 7), dtype=np.uint8)
+    body_lengths = np.concatenate(([7], np.full(num_tempos, 6), np.full(2 * num_notes, 3)))
+
+    # Time signature: beats_per_bar quarter notes, 24 MIDI clocks per click,
+    # 8 32nd notes per quarter
+    bodies[0] = [0xFF, 0x58, 0x04, beats_per_bar, 2, 24, 8]
+    tempo_bodies = bodies[1:1 + num_tempos]
+    tempo_bodies[:, :3] = [0xFF, 0x51, 0x03]
+    for byte in range(3):
+        tempo_bodies[:, 3 + byte] = (tempos[:, 1] >> (8 * (2 - byte))) & 0xFF
+    note_bodies = bodies[1 + num_tempos:]
+    note_bodies[:num_notes, 0] = NOTE_OFF | DRUM_CHANNEL
+    note_bodies[num_notes:, 0] = NOTE_ON | DRUM_CHANNEL
+    note_bodies[:, 1] = np.tile(notes[:, 1], 2)
+    note_bodies[:num_notes, 2] = 0
+    note_bodies[num_notes:, 2] = notes[:, 2]
+
+    order = np.lexsort((kinds, ticks))
+    ticks = ticks[order]
+    deltas = np.diff(ticks, prepend=0)
+    delta_bytes, delta_lengths = variable_length_quantities(deltas)
+
+    # Lay each event out as a row of delta bytes then body bytes, and keep
+    # only the bytes that are used. Rows are read in order, so this gives
+    # the events one after another.
+    rows = np.concatenate((delta_bytes, bodies[order]), axis=1)
+    used = np.concatenate((np.arange(4)[None, :] < delta_lengths[:, None],
+                           np.arange(7)[None, :] < body_lengths[order][:, None]), axis=1)
+    end_of_track = np.array([0x00, 0xFF, 0x2F, 0x00], dtype=np.uint8)
+    return np.concatenate((rows[used], end_of_track)).tobytes()
+
+
+def midi_file_bytes(track, ppq=PPQ):
+    '''
+    A format 0 Standard MIDI File holding the single track.
+    '''
+    header = b"MThd" + (6).to_bytes(4, "big") + (0).to_bytes(2, "big") + (1).to_bytes(2, "big") + ppq.to_bytes(2, "big")
+    return header + b"MTrk" + len(track).to_bytes(4, "big") + track
+
+
+def write_click_track(path, num_bars, tempo_map=None, tempo=120, beats_per_bar=4, click_indices=None,
+                      beat_pattern=None, gap_masks=None, ppq=PPQ):
+    '''
+    Write a click track of num_bars bars to a MIDI file at path. Without a
+    tempo_map, the whole track is at tempo. See click_track_events for the
+    other arguments.
+    '''
+    if tempo_map is None:
+        tempo_map = [(0, tempo)]
+    notes, tempos = click_track_events(tempo_map, beats_per_bar, num_bars, click_indices=click_indices,
+                                       beat_pattern=beat_pattern, gap_masks=gap_masks, ppq=ppq)
+    data = midi_file_bytes(encode_track(notes, tempos, beats_per_bar, ppq=ppq), ppq=ppq)
+    with open(path, "wb") as f:
+        f.write(data)
+    return path
+
+
+def write_click_tracks(jobs):
+    '''
+    Batch version of write_click_track. jobs is a list of dicts of
+    arguments to write_click_track. Returns the paths written.
+    '''
+    return [write_click_track(**job) for job in jobs]
+
+
+def parse_tempo_map(segments):
+    '''
+    Parse "bar:tempo[:curve]" strings from the command line.
+    '''
+    parsed = []
+    for segment in segments:
+        parts = segment.split(":")
+        parsed.append((int(parts[0]), float(parts[1])) + tuple(parts[2:3]))
+    return parsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write the click as a Standard MIDI File.")
+    parser.add_argument("path", nargs="?", help="MIDI file to write")
+    parser.add_argument("--bars", type=int, default=16)
+    parser.add_argument("--tempo", type=float, default=120)
+    parser.add_argument("--tempo-map", nargs="+", help='segments as "bar:tempo[:curve]"')
+    parser.add_argument("--beats-per-bar", type=int, default=4)
+    parser.add_argument("--batch", help="JSON file with a list of jobs (see write_click_tracks)")
+    args = parser.parse_args()
+
+    if args.batch:
+        with open(args.batch) as f:
+            paths = write_click_tracks(json.load(f))
+    elif args.path:
+        tempo_map = parse_tempo_map(args.tempo_map) if args.tempo_map else None
+        paths = [write_click_track(args.path, args.bars, tempo_map=tempo_map, tempo=args.tempo,
+                                   beats_per_bar=args.beats_per_bar)]
+    else:
+        parser.error("Give a path to write, or --batch")
+    print(f"Wrote {len(paths)} MIDI file(s)")
@@ -0,0 +1,76 @@
+import numpy as np
+
+
+class BlockRingBuffer():
+    '''
+    A preallocated single-producer/single-consumer ring of audio blocks,
+    used in place of a queue.Queue between block generation and the output
+    stream. A parallel array holds the beat number for each block.
+
+    There are no locks. The producer only ever moves write_index and the
+    consumer only ever moves read_index, and each side publishes its index
+    after it has finished with the block. Both indices count up forever and
+    are wrapped with % capacity when used, so full and empty are never
+    ambiguous.
+    '''
+
+    def __init__(self, capacity, blocksize, dtype=np.float32):
+        self.capacity = capacity
+        self.blocksize = blocksize
+        self.blocks = np.zeros((capacity, blocksize), dtype=dtype)
+        self.beats = np.zeros(capacity, dtype=int)
+        self.read_index = 0
+        self.write_index = 0
+
+
+    def __len__(self):
+        return self.write_index - self.read_index
+
+
+    def is_full(self):
+        return self.write_index - self.read_index >= self.capacity
+
+
+    def is_empty(self):
+        return self.write_index == self.read_index
+
+
+    def get_write_block(self):
+        '''
+        Producer side. Returns the block to fill in next, or None if the ring
+        is full. The block is not visible to the consumer until commit_write.
+        '''
+        if self.is_full():
+            return None
+        return self.blocks[self.write_index % self.capacity]
+
+
+    def commit_write(self, beat):
+        '''
+        Producer side. Publish the block returned by get_write_block.
+        '''
+        self.beats[self.write_index % self.capacity] = beat
+        self.write_index += 1
+
+
+    def read_into(self, outdata):
+        '''
+        Consumer side. Copy the oldest block into outdata and release it.
+        Returns the block's beat number, or None if the ring is empty.
+        '''
+        if self.is_empty():
+            return None
+        slot = self.read_index % self.capacity
+        outdata[:] = self.blocks[slot]
+        beat = self.beats[slot]
+        self.read_index += 1
+        return beat
+
+
+    def reset(self):
+        '''
+        Discard everything in the ring, without reallocating it. Only call
+        this when neither side is running (e.g. after the stream is stopped).
+        '''
+        self.read_index = 0
+        self.write_index = 0
@@ -0,0 +1,114 @@
+'''
+Stream the click to stdout as raw PCM or as a WAV file, without Tk or an
+audio device, e.g. to pipe it into ffmpeg or a streaming server.
+
+The audio comes straight from Metronome.generate_pcm, so nothing is
+generated faster than it is read: if the reader stops reading, the pipe
+fills up and the click waits for it. With --realtime, blocks are also
+never written faster than they would be played, for readers that take
+audio as fast as it comes.
+
+Without --bars or --duration, the click carries on until the reader goes
+away. A WAV file of unknown length has its sizes set to the maximum, which
+ffmpeg and most players accept.
+
+Example:
+    python stream_click.py --tempo 120 | ffplay -f s16le -ar 16000 -ac 1 -nodisp -
+    python stream_click.py --format wav --bars 8 > click.wav
+    python stream_click.py --fs 48000 --dtype float32 --duration 60 | ffmpeg -f f32le -ar 48000 -ac 1 -i - click.mp3
+    python stream_click.py --tempo-map 0:100:linear 16:160 --bars 32 --format wav > ramp.wav
+'''
+import argparse
+import struct
+import sys
+import time
+import numpy as np
+
+from metronome_master_GH import Metronome
+from midi_export import parse_tempo_map
+
+
+def wav_header(fs, dtype, num_samples=None):
+    '''
+    The 44-byte header of a mono WAV file of num_samples samples of dtype,
+    or of unknown length if num_samples is None.
+    '''
+    dtype = np.dtype(dtype)
+    if num_samples is None:
+        data_size = 0xFFFFFFFF - 36
+    else:
+        data_size = num_samples * dtype.itemsize
+    format_tag = 3 if dtype.kind == "f" else 1      # IEEE float or PCM
+    return (b"RIFF" + struct.pack("<I", min(0xFFFFFFFF, 36 + data_size)) + b"WAVE"
+            + b"fmt " + struct.pack("<IHHIIHH", 16, format_tag, 1, fs, fs * dtype.itemsize,
+                                    dtype.itemsize, 8 * dtype.itemsize)
+            + b"data" + struct.pack("<I", data_size))
+
+
+def num_samples_to_play(metro, num_bars=None, duration=None):
+    '''
+    The number of samples generate_blocks will produce, or None if it will
+    carry on until stopped.
+    '''
+    if duration is not None:
+        return int(round(duration * metro.fs))
+    if num_bars is not None:
+        tempo_map = metro.check_tempo_map(metro.tempo_map if metro.tempo_map is not None else [(0, metro.tempo)])
+        beats_per_bar = metro.beats_per_bar
+        _, end = tempo_map.onsets(metro.fs, beats_per_bar, num_beats=num_bars * beats_per_bar)
+        return end
+    return None
+
+
+def stream_click(output, metro, format="raw", dtype="int16", num_bars=None, duration=None, realtime=False):
+    '''
+    Write the click to the binary file object output until it ends, or
+    until output is closed by its reader.
+    '''
+    if format == "wav":
+        output.write(wav_header(metro.fs, dtype, num_samples_to_play(metro, num_bars, duration)))
+
+    start = time.perf_counter()
+    samples_written = 0
+    try:
+        for pcm in metro.generate_pcm(dtype=dtype, num_bars=num_bars, duration=duration):
+            if realtime:
+                # Wait until the audio already written has had time to play
+                delay = samples_written / metro.fs - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            output.write(pcm)
+            samples_written += len(pcm) // np.dtype(dtype).itemsize
+        output.flush()
+    except BrokenPipeError:
+        # The reader has gone away, so just stop
+        pass
+    return samples_written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stream the click to stdout as raw PCM or WAV.")
+    parser.add_argument("--tempo", type=int, default=120)
+    parser.add_argument("--beats-per-bar", type=int, default=4)
+    parser.add_argument("--tempo-map", nargs="+", help='segments as "bar:tempo[:curve]"')
+    parser.add_argument("--fs", type=int, default=16000, help="sample rate, in Hz")
+    parser.add_argument("--blocksize", type=int, default=512)
+    parser.add_argument("--dtype", default="int16", choices=["int16", "int32", "float32"])
+    parser.add_argument("--format", default="raw", choices=["raw", "wav"])
+    parser.add_argument("--bars", type=int, help="number of bars to play")
+    parser.add_argument("--duration", type=float, help="number of seconds to play")
+    parser.add_argument("--realtime", action="store_true", help="write no faster than real time")
+    args = parser.parse_args()
+
+    metro = Metronome(tempo=args.tempo, beats_per_bar=args.beats_per_bar, fs=args.fs,
+                      blocksize=args.blocksize, backend="null")
+    if args.tempo_map:
+        metro.set_tempo_map(parse_tempo_map(args.tempo_map))
+
+    output = sys.stdout.buffer
+    stream_click(output, metro, format=args.format, dtype=args.dtype, num_bars=args.bars,
+                 duration=args.duration, realtime=args.realtime)
+    try:
+        output.close()
+    except BrokenPipeError:
+        pass
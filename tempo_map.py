@@ -0,0 +1,263 @@
+import numpy as np
+from fractions import Fraction
+
+from beat_scheduler import BeatScheduler
+
+
+CURVES = ("constant", "step", "linear")
+
+
+class TempoMap():
+    '''
+    Tempo automation: a list of (bar, tempo, curve) segments, where bar is
+    the zero-based bar at which the segment starts. The curve says how the
+    tempo gets from this segment's tempo to the next segment's:
+
+        "constant"  stay at this tempo, then jump to the next tempo at the
+                    start of the next segment (the default if a segment is
+                    just (bar, tempo))
+        "step"      change tempo once per bar, in equal steps, so that the
+                    next segment's tempo is reached at its first bar
+        "linear"    ramp the tempo linearly in BPM, beat by beat, so that
+                    the next segment's tempo is reached at its first beat
+
+    The last segment has no tempo to move towards, so it always carries on
+    at a constant tempo forever.
+
+    For example, play 4 bars at 100 BPM, speed up smoothly to 140 BPM over
+    8 bars, and stay there:
+
+        TempoMap([(0, 100), (4, 100, "linear"), (12, 140)])
+
+    A TempoMap only describes the tempo. Beat onsets are worked out for a
+    given sample rate and beats per bar by scheduler() (for live playback)
+    or onsets() (for offline rendering), which give identical results.
+    '''
+
+    def __init__(self, segments):
+        self.segments = []
+        for segment in sorted(segments, key=lambda segment: segment[0]):
+            bar, tempo = segment[0], segment[1]
+            curve = segment[2] if len(segment) > 2 else "constant"
+            if curve not in CURVES:
+                raise Exception(f"Unknown tempo curve '{curve}'. Use one of {', '.join(CURVES)}.")
+            if tempo <= 0:
+                raise Exception("Tempos in a tempo map must be positive.")
+            if self.segments and bar == self.segments[-1][0]:
+                raise Exception(f"More than one tempo map segment starts at bar {bar}.")
+            self.segments.append((int(bar), tempo, curve))
+
+        if not self.segments or self.segments[0][0] != 0:
+            raise Exception("The tempo map must start at bar 0.")
+
+
+    def tempos(self):
+        return [tempo for _, tempo, _ in self.segments]
+
+
+    def min_tempo(self):
+        return min(self.tempos())
+
+
+    def max_tempo(self):
+        return max(self.tempos())
+
+
+    def scheduler(self, fs, beats_per_bar):
+        '''
+        Return a TempoMapScheduler, which can be used in place of a
+        BeatScheduler to step through the beats one at a time.
+        '''
+        return TempoMapScheduler(self, fs, beats_per_bar)
+
+
+    def onsets(self, fs, beats_per_bar, num_beats=None, num_samples=None):
+        '''
+        Vectorised version of the scheduler. Returns the onsets (in samples)
+        of the first num_beats beats, or of every beat that starts before
+        sample num_samples, and the sample at which the following beat
+        would start.
+        '''
+        return self.scheduler(fs, beats_per_bar).onsets(num_beats, num_samples)
+
+
+    def beat_tempos(self, beats_per_bar, num_beats):
+        '''
+        The tempo of each of the first num_beats beats, as an array of
+        floats. These are the tempos the scheduler plays each beat at, and
+        do not depend on the sample rate.
+        '''
+        tempos = []
+        for (bar, tempo, curve), (next_bar, next_tempo, _) in zip(self.segments[:-1], self.segments[1:]):
+            num_bars = next_bar - bar
+            if curve == "linear":
+                tempos.append(linear_tempos(tempo, next_tempo, num_bars * beats_per_bar))
+            elif curve == "step":
+                tempos.append(np.repeat([float(bar_tempo) for bar_tempo in step_tempos(tempo, next_tempo, num_bars)], beats_per_bar))
+            else:
+                tempos.append(np.full(num_bars * beats_per_bar, float(tempo)))
+        tempos = np.concatenate(tempos + [np.zeros(0)])[:num_beats]
+        # The last segment carries on for the rest of the beats
+        return np.concatenate((tempos, np.full(num_beats - len(tempos), float(self.segments[-1][1]))))
+
+
+
+def constant_offsets(fs, tempo, num_beats):
+    '''
+    Onsets of num_beats beats at a constant tempo, relative to the first,
+    followed by the onset of the beat after them.
+    '''
+    onsets, end = BeatScheduler(fs, tempo).segment_onsets(num_beats)
+    return np.append(onsets, end), np.full(num_beats, float(tempo))
+
+
+def step_tempos(start_tempo, end_tempo, num_bars):
+    '''
+    The tempo of each bar of a "step" segment, as exact fractions.
+    '''
+    return [Fraction(start_tempo) + (Fraction(end_tempo) - Fraction(start_tempo)) * bar / num_bars
+            for bar in range(num_bars)]
+
+
+def linear_tempos(start_tempo, end_tempo, num_beats):
+    '''
+    The tempo of each beat of a "linear" segment.
+    '''
+    return start_tempo + (end_tempo - start_tempo) * np.arange(num_beats) / num_beats
+
+
+def step_offsets(fs, start_tempo, end_tempo, num_bars, beats_per_bar):
+    '''
+    Like constant_offsets, with a new tempo every bar. The bar tempos are
+    exact fractions, so each bar is scheduled with exact integer arithmetic.
+    '''
+    offsets = [np.zeros(1, dtype=np.int64)]
+    tempos = []
+    bar_start = 0
+    for tempo in step_tempos(start_tempo, end_tempo, num_bars):
+        onsets, bar_start = BeatScheduler(fs, tempo).segment_onsets(beats_per_bar, bar_start)
+        offsets.append(np.append(onsets[1:], bar_start))
+        tempos.append(np.full(beats_per_bar, float(tempo)))
+    return np.concatenate(offsets), np.concatenate(tempos)
+
+
+def linear_offsets(fs, start_tempo, end_tempo, num_beats):
+    '''
+    Like constant_offsets, with the tempo changing linearly every beat. The
+    exact beat lengths are not whole numbers of samples, so the exact onset
+    positions are added up in float64, relative to the start of the ramp,
+    and each onset is the sample at or just before its exact position. This
+    keeps the rounding error many orders of magnitude below one sample.
+    '''
+    tempos = linear_tempos(start_tempo, end_tempo, num_beats)
+    positions = np.concatenate(([0.0], np.cumsum(fs * 60.0 / tempos)))
+    return np.floor(positions).astype(np.int64), tempos
+
+
+
+class TempoMapScheduler():
+    '''
+    Schedules beat onsets for a TempoMap. It has the same interface as
+    BeatScheduler (next_beat_length, reset, next_onset and tempo), so the
+    Metronome can use either.
+
+    Every segment except the last is compiled up front into an array of
+    onset offsets from the start of the segment, so finding the length of a
+    beat is an array lookup, however many segments the map has. The last
+    segment lasts forever, so it is handed over to a BeatScheduler.
+    '''
+
+    def __init__(self, tempo_map, fs, beats_per_bar):
+        self.fs = fs
+        self.beats_per_bar = beats_per_bar
+
+        segments = tempo_map.segments
+        # For each segment but the last: the onset of its first beat, the
+        # onset offsets of its beats (plus the end of the segment), and the
+        # tempo of each beat
+        self.segment_starts = []
+        self.segment_offsets = []
+        self.segment_tempos = []
+        segment_start = 0
+        for (bar, tempo, curve), (next_bar, next_tempo, _) in zip(segments[:-1], segments[1:]):
+            num_bars = next_bar - bar
+            if curve == "linear":
+                offsets, tempos = linear_offsets(fs, tempo, next_tempo, num_bars * beats_per_bar)
+            elif curve == "step":
+                offsets, tempos = step_offsets(fs, tempo, next_tempo, num_bars, beats_per_bar)
+            else:
+                offsets, tempos = constant_offsets(fs, tempo, num_bars * beats_per_bar)
+            self.segment_starts.append(segment_start)
+            self.segment_offsets.append(offsets)
+            self.segment_tempos.append(tempos)
+            segment_start += int(offsets[-1])
+
+        self.final_start = segment_start
+        self.final_tempo = segments[-1][1]
+        self.reset()
+
+
+    def reset(self):
+        '''
+        Go back to the first beat of the map, at sample zero.
+        '''
+        self.segment = 0
+        self.beat_in_segment = 0
+        self.next_onset = 0
+        self.final_scheduler = BeatScheduler(self.fs, self.final_tempo, start=self.final_start)
+        if self.segment_tempos:
+            self.tempo = self.segment_tempos[0][0]
+        else:
+            self.tempo = self.final_tempo
+
+
+    def next_beat_length(self):
+        '''
+        Advance by one beat. Returns the number of samples from the onset of
+        this beat to the onset of the next one. self.tempo is the tempo of
+        this beat.
+        '''
+        if self.segment < len(self.segment_offsets):
+            offsets = self.segment_offsets[self.segment]
+            beat = self.beat_in_segment
+            beat_length = int(offsets[beat + 1] - offsets[beat])
+            self.tempo = self.segment_tempos[self.segment][beat]
+
+            self.beat_in_segment += 1
+            if self.beat_in_segment == len(offsets) - 1:
+                self.segment += 1
+                self.beat_in_segment = 0
+        else:
+            beat_length = self.final_scheduler.next_beat_length()
+            self.tempo = self.final_tempo
+
+        self.next_onset += beat_length
+        return beat_length
+
+
+    def onsets(self, num_beats=None, num_samples=None):
+        '''
+        See TempoMap.onsets. This does not change the scheduler's position.
+        '''
+        if (num_beats is None) == (num_samples is None):
+            raise Exception("Specify exactly one of num_beats or num_samples.")
+
+        onset_list = [start + offsets[:-1] for start, offsets in zip(self.segment_starts, self.segment_offsets)]
+        num_compiled_beats = sum(len(onsets) for onsets in onset_list)
+
+        # Beats needed from the final, constant tempo segment
+        if num_beats is not None:
+            num_final_beats = max(0, num_beats - num_compiled_beats)
+        else:
+            interval = int(self.fs * 60.0 / self.final_tempo)
+            num_final_beats = max(0, (num_samples - self.final_start) // interval + 1)
+        final_onsets, end = BeatScheduler(self.fs, self.final_tempo).segment_onsets(num_final_beats, self.final_start)
+        onset_list.append(final_onsets)
+        onsets = np.concatenate(onset_list)
+
+        if num_beats is not None:
+            # The following beat's onset is the end of the last beat
+            end = int(onsets[num_beats]) if num_beats < len(onsets) else end
+            return onsets[:num_beats], end
+        onsets = onsets[onsets < num_samples]
+        return onsets, num_samples
@@ -0,0 +1,366 @@
+'''
+Tests for the Metronome engine. They use the headless "null" backend, or
+generate_blocks, so no audio device is needed.
+
+Run with:
+    python -m pytest -q test_metronome.py
+'''
+import time
+import audiofile
+from fractions import Fraction
+import numpy as np
+
+from metronome_master_GH import Metronome
+from audio_backends import NullBackend, StreamStatus, StreamTime
+from capture import WavFileCapture
+from gap_clicks import GapClicks
+from beat_pattern import PatternLayer
+from midi_export import CLICK_NOTES, NOTE_ON, PPQ
+from benchmark_metronome import float32_error
+from benchmark_bank import check_against_render
+
+
+def play_beats(metro, num_blocks):
+    '''
+    Generate num_blocks blocks as the audio thread would, and return the
+    beat number each one ends on.
+    '''
+    beats = []
+    for _ in range(num_blocks):
+        _, beat = metro.get_next_audio_block()
+        beats.append(beat)
+    return beats
+
+
+def read_midi_notes(path):
+    '''
+    Read a format 0 MIDI file as written by midi_export.py. Returns the
+    tick and note of every note on, and the tick and microseconds per beat
+    of every tempo event.
+    '''
+    with open(path, "rb") as f:
+        data = f.read()
+    assert data[:4] == b"MThd" and int.from_bytes(data[12:14], "big") == PPQ
+    assert data[14:18] == b"MTrk"
+    track = data[22:22 + int.from_bytes(data[18:22], "big")]
+    notes, tempos = [], []
+    pos = tick = 0
+    while pos < len(track):
+        # A variable-length delta time, then the event
+        delta = 0
+        while True:
+            delta = (delta << 7) | (track[pos] & 0x7F)
+            pos += 1
+            if track[pos - 1] < 0x80:
+                break
+        tick += delta
+        if track[pos] == 0xFF:
+            kind, length = track[pos + 1], track[pos + 2]
+            if kind == 0x51:
+                tempos.append((tick, int.from_bytes(track[pos + 3:pos + 6], "big")))
+            pos += 3 + length
+        else:
+            if track[pos] & 0xF0 == NOTE_ON:
+                notes.append((tick, track[pos + 1]))
+            pos += 3
+    return notes, tempos
+
+
+def test_click_indices_for_every_beat_the_gui_can_show():
+    # The GUI always passes 8 click indices, whatever the beats per bar
+    metro = Metronome(tempo=120, beats_per_bar=4, backend="null")
+    index_array = np.array([2, 1, 0, 1, 2, 2, 2, 2])
+    metro.update_beat_sample_dict(index_array)
+    assert list(metro.bar_click_indices) == list(index_array[:4])
+    assert len(metro.bar_cache) == 4
+
+    # The bar is still 4 beats long while playing, with gap clicks on too
+    metro.enable_gap_clicks(probability=0.5, seed=1)
+    metro.prepare_to_play()
+    metro.running = True
+    assert max(play_beats(metro, 200)) == 4
+
+    # One more beat per bar makes a 5 beat bar, not a 9 beat one, and the
+    # new beat plays the sound the GUI shows for it
+    metro.increase_beats_per_bar()
+    assert len(metro.next_bar_cache[0]) == 5
+    assert max(play_beats(metro, 200)) == 5
+    assert list(metro.bar_click_indices) == list(index_array[:5])
+    metro.running = False
+
+
+def test_hidden_beats_keep_their_click_sounds():
+    # Set beat 4 to silent in the GUI, then drop it from the bar and add it
+    # back: it is still silent, as the GUI still shows
+    metro = Metronome(tempo=120, beats_per_bar=4, backend="null")
+    index_array = np.array([2, 1, 1, 0, 1, 1, 1, 1])
+    metro.update_beat_sample_dict(index_array)
+    metro.decrease_beats_per_bar()
+    assert list(metro.bar_click_indices) == list(index_array[:3])
+    metro.increase_beats_per_bar()
+    assert list(metro.bar_click_indices) == list(index_array[:4])
+    assert not np.any(metro.bar_cache[3])
+
+    # The engine has its own copy of the GUI's array
+    index_array[0] = 0
+    assert metro.bar_click_indices[0] == 2
+
+    # Without the GUI, an added beat is lo
+    metro = Metronome(tempo=120, beats_per_bar=4, backend="null")
+    metro.increase_beats_per_bar()
+    assert list(metro.bar_click_indices) == [2, 1, 1, 1, 1]
+
+
+def test_beat_log_can_be_exported_after_stopping(tmp_path):
+    metro = Metronome(tempo=240, beats_per_bar=3, backend=NullBackend(realtime=True))
+    metro.start()
+    deadline = time.perf_counter() + 10
+    while len(metro.get_beat_log()) < 6 and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    metro.stop()
+
+    records = np.load(metro.get_beat_log().tofile(tmp_path / "beats.npy"))
+    assert len(records) >= 6
+    # The GUI's beat events are read from the same records
+    index, beat, dac_time = metro.get_beat_event(0)
+    assert (index, beat, dac_time) == (0, records["beat"][0], records["dac_time"][0])
+    assert list(records["beat"][:6]) == [1, 2, 3, 1, 2, 3]
+    assert list(records["bar"][:6]) == [0, 0, 0, 1, 1, 1]
+    assert np.all(np.diff(records["sample"]) == 4000)
+
+    # generate_blocks keeps its log too, until the next start
+    for _ in metro.generate_blocks(num_bars=2):
+        pass
+    assert list(metro.get_beat_log().to_numpy()["beat"]) == [1, 2, 3, 1, 2, 3]
+
+
+def test_render_matches_live_output_for_clicks_longer_than_a_beat():
+    # A sustained click, much longer than a beat, at a tempo with beats of
+    # both interval and interval + 1 samples
+    for tempo in (120, 140):
+        metro = Metronome(tempo=tempo, beats_per_bar=4, backend="null")
+        long_click = np.full(20000, 0.5, dtype=np.float32)
+        metro.update_beat_sample_dict([2, 1, 1, 1], click_set=[None, long_click, "hi"])
+
+        rendered = metro.render(num_bars=4)
+        live = np.concatenate([block.copy() for block in metro.generate_blocks(num_bars=4)])
+        assert np.array_equal(rendered, live)
+
+
+def test_file_backend_by_name(tmp_path):
+    path = str(tmp_path / "click.wav")
+    metro = Metronome(tempo=150, backend="file", backend_options={"path": path})
+    metro.play_for_num_bars(2)
+    assert metro.event.wait(10)
+    metro.close()
+
+    written, fs = audiofile.read(path)
+    assert fs == metro.fs
+    assert np.array_equal(written, metro.render(num_bars=2))
+
+
+def test_float32_output_matches_float64_within_precision():
+    for fs in (16000, 44100):
+        for tempo in (60, 140, 350):
+            max_error, tolerance = float32_error(tempo, fs, 512, 300)
+            assert max_error <= tolerance
+
+
+def test_restart_after_the_stream_finishes_by_itself():
+    # The stream ends by itself after 20 blocks, without stop() being called
+    metro = Metronome(tempo=120, backend=NullBackend(max_blocks=20))
+    for _ in range(2):
+        metro.start()
+        assert metro.event.wait(10)
+        assert not metro.running
+        # This session played, and was logged
+        assert len(metro.get_beat_log()) > 0
+    metro.close()
+
+    # play_for_num_bars can be waited on again each time
+    metro = Metronome(tempo=240, backend="null")
+    for _ in range(2):
+        metro.play_for_num_bars(1)
+        assert metro.event.wait(10)
+        assert metro.samples_output == 0 and not metro.running
+    metro.close()
+
+
+def test_tempo_change_replaced_or_cancelled_before_it_is_made():
+    metro = Metronome(tempo=120, beats_per_bar=4, backend="null")
+    metro.prepare_to_play()
+    metro.running = True
+    play_beats(metro, 3)
+    # Back to the tempo being played before the first change is made
+    metro.set_new_tempo(200)
+    metro.set_new_tempo(120)
+    play_beats(metro, 100)
+    assert metro.tempo == 120 and metro.scheduler.tempo == 120
+    # A second new tempo replaces the first
+    metro.set_new_tempo(200)
+    metro.set_new_tempo(150)
+    play_beats(metro, 100)
+    assert metro.tempo == 150 and metro.scheduler.tempo == 150
+    metro.running = False
+
+
+def test_tempo_change_ends_tempo_map_with_the_same_scheduler():
+    metro = Metronome(tempo=120, beats_per_bar=4, backend="null")
+    constant_scheduler = metro.scheduler
+    metro.set_tempo_map([(0, 100, "linear"), (4, 200)])
+    metro.prepare_to_play()
+    metro.running = True
+    play_beats(metro, 50)
+    onset = metro.scheduler.next_onset
+    metro.set_new_tempo(160)
+    play_beats(metro, 100)
+    metro.running = False
+    # The change was made on the audio thread without making a scheduler,
+    # and the beats carried on from where the map had got to
+    assert metro.tempo_map is None
+    assert metro.scheduler is constant_scheduler and metro.scheduler.tempo == 160
+    assert metro.scheduler.segment_start >= onset
+
+
+def test_low_latency_buffer_depth_is_fixed_without_a_worker():
+    # The callback generates the blocks it plays, so a deeper buffer could
+    # not prevent an underflow
+    metro = Metronome(tempo=120, backend="null", low_latency=True, min_buffer_depth=2)
+    metro.prepare_to_play()
+    metro.pre_fill_queue()
+    metro.running = True
+    outdata = np.zeros((metro.BLOCKSIZE, 1), dtype=np.float32)
+    status = StreamStatus()
+    status.output_underflow = True
+    for _ in range(20):
+        samples_generated = metro.samples_generated
+        metro.callback(outdata, metro.BLOCKSIZE, StreamTime(), status)
+        # One block generated per callback, however late the callback is
+        assert metro.samples_generated - samples_generated == metro.BLOCKSIZE
+    assert metro.buffer_depth == 2
+    assert metro.get_stats()["output_underflows"] == 20
+    metro.running = False
+
+
+def test_wav_capture_across_chunks(tmp_path):
+    # Chunks of 1000 samples, so the blocks keep crossing into new ones
+    path = str(tmp_path / "capture.wav")
+    capture = WavFileCapture(path, 16000, chunk_seconds=1000 / 16000)
+    audio = np.random.default_rng(1).uniform(-1, 1, 20 * 512).astype(np.float32)
+    for block in audio.reshape(20, 512):
+        capture.write(block)
+    assert np.array_equal(capture.get_audio(), audio)
+    capture.close()
+
+    written, fs = audiofile.read(path)
+    assert fs == 16000
+    assert np.array_equal(written, audio)
+
+
+def test_midi_notes_match_render(tmp_path):
+    # Single-sample clicks, so every onset in the render can be found, hi
+    # and lo apart, with a silent beat and a tempo ramp
+    metro = Metronome(tempo=120, beats_per_bar=4, backend="null")
+    metro.update_beat_sample_dict([2, 1, 0, 1], click_set=[None, np.array([0.5]), np.array([1.0])])
+    tempo_map = [(0, 90, "linear"), (4, 150), (6, 75)]
+    rendered = metro.render(num_bars=8, tempo_map=tempo_map)
+    onsets = np.flatnonzero(rendered)
+    sounds = np.where(rendered[onsets] == 1.0, 2, 1)
+
+    notes, tempos = read_midi_notes(metro.export_midi(str(tmp_path / "click.mid"), 8, tempo_map=tempo_map))
+    assert [note for _, note in notes] == list(CLICK_NOTES[sounds])
+
+    # The time of each note, from the tempo events before it
+    tempo_ticks = np.array([tick for tick, _ in tempos])
+    microseconds = np.array([us for _, us in tempos], dtype=np.float64)
+    start_seconds = np.concatenate(([0], np.cumsum(np.diff(tempo_ticks) * microseconds[:-1] / 1e6 / PPQ)))
+    note_ticks = np.array([tick for tick, _ in notes])
+    segment = np.searchsorted(tempo_ticks, note_ticks, side="right") - 1
+    seconds = start_seconds[segment] + (note_ticks - tempo_ticks[segment]) * microseconds[segment] / 1e6 / PPQ
+    # The engine starts each beat on a whole sample, and MIDI tempos are
+    # whole microseconds per beat, so the times agree to within a sample
+    assert np.max(np.abs(seconds * metro.fs - onsets)) < 1
+
+
+def test_bank_sessions_match_render():
+    # Random tempos and click indices, checked sample for sample
+    rng = np.random.default_rng(1)
+    for fs, blocksize in ((16000, 512), (44100, 256)):
+        assert check_against_render(fs, blocksize, 20, 3, rng) == 20
+
+
+def test_gap_clicks_replay_from_the_seed():
+    for probability, count in ((0.4, None), (None, 1)):
+        masks = GapClicks(probability=probability, count=count, seed=7).bar_masks(40, 4)
+        if count is not None:
+            assert np.all(masks.sum(axis=1) == count)
+        assert 0 < masks.sum() < masks.size
+
+        # Every beat has a click, so the silent beats in the log are the
+        # ones gap clicks silenced. Playing again, and another metronome
+        # with the same seed, silence the same beats.
+        for _ in range(2):
+            metro = Metronome(tempo=240, beats_per_bar=4, backend="null")
+            metro.update_beat_sample_dict([2, 1, 1, 1])
+            metro.enable_gap_clicks(probability=probability, count=count, seed=7)
+            for _ in range(2):
+                live = np.concatenate([block.copy() for block in metro.generate_blocks(num_bars=40)])
+                records = metro.get_beat_log().to_numpy()
+                assert np.array_equal(records["sound"].reshape(40, 4) == 0, masks)
+            assert np.array_equal(metro.render(num_bars=40), live)
+
+
+def test_pattern_clicks_at_exact_fractions_of_each_beat():
+    # Single-sample clicks of different levels, so each layer's onsets can
+    # be picked out of the output, over a tempo ramp
+    metro = Metronome(tempo=120, beats_per_bar=4, backend="null")
+    metro.update_beat_sample_dict([2, 1, 1, 1], click_set=[None, np.array([0.5]), np.array([1.0])])
+    metro.set_beat_pattern([PatternLayer(3, gain=0.5), PatternLayer(5, beats=4, sound=2, gain=0.125)])
+    metro.set_tempo_map([(0, 90, "linear"), (4, 150)])
+    live = np.concatenate([block.copy() for block in metro.generate_blocks(num_bars=8)])
+    assert np.array_equal(metro.render(num_bars=8), live)
+
+    # Triplets in every beat, and five clicks over each bar of four beats,
+    # each at the exact fraction of its beat rounded down
+    beat_onsets = metro.get_beat_log().to_numpy()["sample"]
+    beat_lengths = np.diff(np.append(beat_onsets, len(live)))
+    triplets = np.concatenate([beat_onsets + (pulse * beat_lengths) // 3 for pulse in (1, 2)])
+    quintuplets = []
+    for bar_start in range(0, len(beat_onsets), 4):
+        for pulse in range(1, 5):
+            beat, fraction = divmod(Fraction(4 * pulse, 5), 1)
+            beat = bar_start + int(beat)
+            quintuplets.append(beat_onsets[beat] + (fraction.numerator * beat_lengths[beat]) // fraction.denominator)
+    assert np.array_equal(np.flatnonzero(live == 0.25), np.sort(triplets))
+    assert np.array_equal(np.flatnonzero(live == 0.125), np.sort(quintuplets))
+    assert len(np.flatnonzero(live)) == len(beat_onsets) + len(triplets) + len(quintuplets)
+
+
+def test_onsets_exact_over_hours_of_playing():
+    # Every onset, heard in the output, is on the exact sample, including
+    # after many tempo changes made while playing
+    rng = np.random.default_rng(4)
+    for fs, blocksize, hours, change_every in ((16000, 4096, 3, None), (44100, 4096, 3, None), (44100, 1024, 1, 100)):
+        metro = Metronome(tempo=97, beats_per_bar=4, fs=fs, blocksize=blocksize, backend="null")
+        metro.update_beat_sample_dict([2, 1, 1, 1], click_set=[None, np.array([0.5]), np.array([1.0])])
+        heard = []
+        position = 0
+        for block_num, block in enumerate(metro.generate_blocks(duration=hours * 60 * 60)):
+            heard.append(np.flatnonzero(block) + position)
+            position += len(block)
+            if change_every is not None and block_num % change_every == 0:
+                metro.set_new_tempo(int(rng.integers(metro.min_tempo, metro.max_tempo + 1)))
+        heard = np.concatenate(heard)
+
+        # The exact onsets, segment by segment, from each beat's tempo
+        tempos = metro.get_beat_log().to_numpy()["tempo"].astype(np.int64)
+        segment_starts = np.flatnonzero(np.diff(tempos, prepend=0))
+        segment_lengths = np.diff(np.append(segment_starts, len(tempos)))
+        if change_every is not None:
+            assert len(segment_starts) > 100
+        exact = []
+        start = 0
+        for tempo, length in zip(tempos[segment_starts], segment_lengths):
+            exact.append(start + (np.arange(length, dtype=np.int64) * fs * 60) // tempo)
+            start += (int(length) * fs * 60) // int(tempo)
+        assert np.array_equal(heard, np.concatenate(exact))